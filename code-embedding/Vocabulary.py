@@ -2,6 +2,9 @@ from collections import Counter
 import numpy as np
 import pickle
 
+# negative sampler is shared with graph-network, the directory graph-network should be in the import path
+from AliasSampler import AliasSampler
+
 class Vocabulary:
     """
     Vocabulary stores the mapping from words to IDs in word2id,
@@ -26,11 +29,9 @@ class Vocabulary:
         self.word_count = Counter() # used temporary to simplify the process of counting
         self.id_count = Counter()
         self.id2word = {}
-        self.negative_buffer = []
+        self.negative_sampler = None
         self.top = set()
 
-        self.negative_buffer_position = 0
-
     def _update(self):
         """
         Called before executing operations with vocabulary. Make sure all variables are up to date
@@ -46,6 +47,7 @@ class Vocabulary:
             self.unigram_weights = counts / sum(counts)
             noise_weight = self.unigram_weights**(3/4)
             self.noise_weight = noise_weight / sum(noise_weight)
+            self.negative_sampler = AliasSampler(np.array(sorted(self.id_count.keys())), self.noise_weight)
 
     def get_id(self, word):
         """
@@ -141,15 +143,11 @@ class Vocabulary:
         """
         self._update()
 
-        # calling np.random is slow. bufferize 100000 random samples and get slices every time the method is called
-        if self.negative_buffer_position + k > len(self.negative_buffer):
-            self.negative_buffer = np.random.choice(np.array(list(self.id_count.keys())), 100000, p=self.noise_weight)
-            self.negative_buffer_position = 0
-
-        sample = self.negative_buffer[self.negative_buffer_position : self.negative_buffer_position + k].tolist()
-        self.negative_buffer_position += k
+        if getattr(self, "negative_sampler", None) is None:
+            # vocabulary saved before the sampler was introduced
+            self.negative_sampler = AliasSampler(np.array(sorted(self.id_count.keys())), self.noise_weight)
 
-        return sample
+        return self.negative_sampler.sample(k).tolist()
 
 
 if __name__ == "__main__":
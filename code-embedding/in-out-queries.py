@@ -17,6 +17,12 @@ with open(allowed_list) as al:
             func = func.split("\t")[0]
             f_names.append(func)
 
+# row of every function name, replaces linear search with f_names.index. Like index, the first row of a duplicated
+# name is used
+f_rows = {}
+for row, name in enumerate(f_names):
+    f_rows.setdefault(name, row)
+
 in_vectors = np.loadtxt(in_vects, delimiter="\t")
 out_vectors = np.loadtxt(out_vects, delimiter="\t")
 # in_vectors -= in_vectors.mean(axis=0)
@@ -43,14 +49,16 @@ out_vectors = np.loadtxt(out_vects, delimiter="\t")
 while True:
     f_n = input("Enter function name: ")
     f_n = f_n.strip()
-    if f_n in f_names:
-        f_v = in_vectors[f_names.index(f_n), :]
+    if f_n in f_rows:
+        f_v = in_vectors[f_rows[f_n], :]
         score = out_vectors @ f_v
-        ind = np.flip(np.argsort(score))[:20]
+        # only the top 20 are sorted
+        ind = np.argpartition(-score, 19)[:20] if score.size > 20 else np.arange(score.size)
+        ind = ind[np.argsort(-score[ind])]
         # for d, i in zip(dist[0], ind[0]):
         #     print("%s\t%.4f" % (f_names[i], d))
         # print(dist, ind)
         for i in ind:
-            print("%s\t%.4f" % (f_names[i], in_vectors[f_names.index(f_n)].dot(out_vectors[i])))
+            print("%s\t%.4f" % (f_names[i], score[i]))
     else:
         print("Nothing found")
\ No newline at end of file
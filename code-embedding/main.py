@@ -1,5 +1,9 @@
 import tensorflow as tf
 import sys
+from os.path import abspath, dirname, join
+
+# Vocabulary uses the negative sampler of graph-network
+sys.path.append(join(dirname(abspath(__file__)), "..", "graph-network"))
 from Vocabulary import Vocabulary
 from Reader import Reader
 
@@ -0,0 +1,109 @@
+import numpy as np
+
+
+def build_alias_table(prob):
+    """
+    Build tables for the alias method with a vectorized version of Vose's algorithm. Instead of pairing one small
+    and one large column at a time, all small columns are distributed between large columns in one pass: deficits of
+    small columns and surpluses of large columns are laid out with cumulative sums, and every small column is aliased
+    to the large column whose surplus covers the beginning of its deficit. Large columns that are overdrawn become
+    small and are distributed in the next round. The number of rounds is usually small.
+    :param prob: array of probabilities that sum to 1
+    :return: accept - probability of keeping the column, alias - column that is used otherwise
+    """
+    n = prob.size
+    scaled = prob.astype(np.float64) * n
+    accept = np.ones(n, dtype=np.float64)
+    alias = np.arange(n, dtype=np.int64)
+
+    small = np.flatnonzero(scaled < 1.)
+    large = np.flatnonzero(scaled >= 1.)
+
+    while small.size > 0 and large.size > 0:
+        deficit_start = np.concatenate([[0.], np.cumsum(1. - scaled[small])[:-1]])
+        surplus_end = np.cumsum(scaled[large] - 1.)
+
+        # index of the large column whose surplus interval contains the start of the deficit
+        donor = np.minimum(np.searchsorted(surplus_end, deficit_start, side="right"), large.size - 1)
+
+        accept[small] = scaled[small]
+        alias[small] = large[donor]
+        scaled[large] -= np.bincount(donor, weights=1. - scaled[small], minlength=large.size)
+
+        overdrawn = scaled[large] < 1.
+        small = large[overdrawn]
+        large = large[~overdrawn]
+
+    # columns that are left are equal to 1 up to rounding errors
+    accept[small] = 1.
+    alias[small] = small
+    return accept, alias
+
+
+class AliasSampler:
+    """
+    Samples from a discrete distribution in O(1) per sample with the alias method. Building the tables takes O(n),
+    after that every sample takes one uniform integer and one uniform float, regardless of the number of values.
+    Samples are generated in large batches and served from a buffer, since small calls to the random generator are
+    dominated by overhead.
+    """
+    def __init__(self, values, weights, power=1., buffer_size=100000, seed=None):
+        """
+
+        :param values: array of values to sample from
+        :param weights: non-negative weights of values, not necessarily normalized
+        :param power: weights are raised to this power before normalization, 3/4 gives word2vec noise distribution
+        :param buffer_size: number of samples generated at once
+        :param seed: seed or numpy Generator
+        """
+        weights = np.asarray(weights, dtype=np.float64) ** power
+        if weights.size == 0 or weights.sum() <= 0:
+            raise ValueError("Weights should contain at least one positive value")
+
+        self.values = np.asarray(values)
+        self.accept, self.alias = build_alias_table(weights / weights.sum())
+        self.rng = np.random.default_rng(seed)
+
+        self.buffer_size = buffer_size
+        self.buffer = self.values[:0]
+        self.buffer_position = 0
+
+    @classmethod
+    def from_occurrences(cls, occurrences, power=3/4, **kwargs):
+        """
+        Create sampler for the unigram distribution of elements raised to the given power
+        :param occurrences: array with one entry for every occurrence of an element
+        :param power: power of unigram distribution
+        :param kwargs: other arguments of AliasSampler
+        """
+        values, counts = np.unique(np.asarray(occurrences), return_counts=True)
+        return cls(values, counts, power=power, **kwargs)
+
+    def draw(self, size):
+        """
+        Generate new samples without using the buffer
+        :param size: number of samples
+        :return: array of values
+        """
+        columns = self.rng.integers(0, self.accept.size, size=size)
+        keep = self.rng.random(size) < self.accept[columns]
+        return self.values[np.where(keep, columns, self.alias[columns])]
+
+    def sample(self, size):
+        """
+        :param size: number of samples
+        :return: array of values
+        """
+        if size > self.buffer_size:
+            return self.draw(size)
+
+        if self.buffer_position + size > self.buffer.size:
+            self.buffer = self.draw(self.buffer_size)
+            self.buffer_position = 0
+
+        sample = self.buffer[self.buffer_position: self.buffer_position + size]
+        self.buffer_position += size
+        return sample
+
+    def __len__(self):
+        return self.values.size
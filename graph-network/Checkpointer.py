@@ -0,0 +1,96 @@
+import os
+from threading import Thread
+
+import torch
+
+
+def snapshot(state):
+    """
+    Copy all tensors in the state to CPU memory. The copy is independent of the training parameters, so that the
+    parameters can be updated while the snapshot is written to disk.
+    :param state: tensor, dictionary, list or tuple with tensors, e.g. state_dict of a module or optimizer
+    :return: state with copies of tensors
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    elif isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    elif isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def rotated_path(path, index):
+    return path if index == 0 else "{}.{}".format(path, index)
+
+
+class AsyncCheckpointer:
+    """
+    Writes checkpoints in a background thread. Saving takes a CPU snapshot of the state and returns, serialization
+    and writing overlap with the next epoch. At most one write is in progress, saving the next checkpoint waits for
+    the previous one to finish. Checkpoints are written to a temporary file and renamed, so the checkpoint on disk is
+    never partially written. Previous checkpoints are rotated as path.1, path.2, ... up to keep_last files.
+
+        checkpointer = AsyncCheckpointer("saved_state.pt")
+        for epoch in range(epochs):
+            ...
+            checkpointer.save({'m': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': epoch})
+        checkpointer.close()
+    """
+    def __init__(self, path="saved_state.pt", keep_last=2):
+        """
+
+        :param path: path of the latest checkpoint, compatible with torch.load
+        :param keep_last: number of latest checkpoints that are kept on disk
+        """
+        assert keep_last >= 1, "At least one checkpoint should be kept"
+        self.path = path
+        self.keep_last = keep_last
+        self.worker = None
+        self.error = None
+
+    def write(self, state):
+        try:
+            temp_path = self.path + ".tmp"
+            torch.save(state, temp_path)
+            for index in range(self.keep_last - 1, 0, -1):
+                if os.path.isfile(rotated_path(self.path, index - 1)):
+                    os.replace(rotated_path(self.path, index - 1), rotated_path(self.path, index))
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+        Wait until the last checkpoint is written
+        """
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state):
+        """
+        Schedule writing of the checkpoint
+        :param state: dictionary with state_dicts and other values
+        """
+        self.wait()
+        # the snapshot is taken before returning, training can modify parameters after this call
+        state = snapshot(state)
+        # not a daemon thread, the interpreter waits for the pending write before exiting
+        self.worker = Thread(target=self.write, args=(state,))
+        self.worker.start()
+
+    def close(self):
+        self.wait()
+
+
+def load_checkpoint(path="saved_state.pt"):
+    """
+    Load the latest checkpoint to CPU memory
+    :param path: path of the checkpoint
+    :return: dictionary with the saved state
+    """
+    return torch.load(path, map_location="cpu")
@@ -2,6 +2,9 @@ import pandas
 import dgl
 import numpy
 import pickle
+import torch
+
+from DatasetCache import DatasetCache
 
 
 def load_data(node_path, edge_path):
@@ -36,6 +39,136 @@ def compact_property(values):
     return prop2pid
 
 
+def compact_codes(values):
+    """
+    Vectorized version of compact_property. Instead of a dictionary returns sorted unique values and
+    compact ids for every element, so that uniq[codes] == values.
+    :param values: 1d array-like
+    :return: tuple (uniq, codes)
+    """
+    uniq, codes = numpy.unique(numpy.asarray(values), return_inverse=True)
+    return uniq, codes.reshape(-1)
+
+
+def lookup_codes(uniq, values):
+    """
+    Find compact ids for values given sorted unique values returned by compact_codes. Behaves as a lookup
+    into the dictionary returned by compact_property and raises KeyError for unknown values.
+    :param uniq: sorted array of unique values
+    :param values: 1d array-like
+    :return: array of compact ids
+    """
+    values = numpy.asarray(values)
+    pos = numpy.searchsorted(uniq, values)
+    if uniq.size == 0:
+        if values.size > 0:
+            raise KeyError(values[0])
+        return pos
+    missing = uniq[numpy.minimum(pos, uniq.size - 1)] != values
+    if numpy.any(missing):
+        raise KeyError(values[missing][0])
+    return pos
+
+
+def compact_graph_ids(nodes, edges):
+    """
+    Assign all compact ids in one vectorized pass. Adds columns compact_label, graph_id and typed_id to nodes, and
+    src_type, dst_type, src_type_graph_id, dst_type_graph_id, src_type_typed_id, dst_type_typed_id to edges.
+    Ids are assigned in the same order as with compact_property: graph_id is the position of the node id among
+    sorted node ids, typed_id is the position of the node id among sorted ids of nodes with the same type.
+    :param nodes: DataFrame with columns "id", "type", "label"
+    :param edges: DataFrame with columns "src", "dst"
+    :return: nodes, edges, label_map, id_map, typed_id_map
+    """
+    nodes = nodes.copy()
+    edges = edges.copy()
+
+    node_ids = nodes['id'].values
+    node_types = nodes['type'].values
+
+    labels, nodes['compact_label'] = compact_codes(nodes['label'])
+    graph_ids, nodes['graph_id'] = compact_codes(node_ids)
+    types, type_codes = compact_codes(node_types)
+
+    # sort nodes by type, then by id. position inside the type group gives typed id
+    order = numpy.lexsort((node_ids, type_codes))
+    type_counts = numpy.bincount(type_codes, minlength=types.size)
+    type_starts = numpy.cumsum(type_counts) - type_counts
+    typed_id = numpy.empty(node_ids.size, dtype=numpy.int64)
+    typed_id[order] = numpy.arange(node_ids.size) - numpy.repeat(type_starts, type_counts)
+    nodes['typed_id'] = typed_id
+
+    # per graph id lookup tables for remapping edges
+    type_of = numpy.empty(graph_ids.size, dtype=node_types.dtype)
+    type_of[nodes['graph_id'].values] = node_types
+    typed_id_of = numpy.empty(graph_ids.size, dtype=numpy.int64)
+    typed_id_of[nodes['graph_id'].values] = typed_id
+
+    src = lookup_codes(graph_ids, edges['src'].values)
+    dst = lookup_codes(graph_ids, edges['dst'].values)
+
+    edges['src_type'] = type_of[src]
+    edges['dst_type'] = type_of[dst]
+    edges['src_type_graph_id'] = src
+    edges['dst_type_graph_id'] = dst
+    edges['src_type_typed_id'] = typed_id_of[src]
+    edges['dst_type_typed_id'] = typed_id_of[dst]
+
+    label_map = dict(zip(labels, range(labels.size)))
+    id_map = dict(zip(graph_ids, range(graph_ids.size)))
+
+    sorted_ids = node_ids[order]
+    typed_id_map = {}
+    for type, start, count in zip(types, type_starts, type_counts):
+        typed_id_map[str(type)] = dict(zip(sorted_ids[start: start + count], range(count)))
+
+    return nodes, edges, label_map, id_map, typed_id_map
+
+
+def maps_from_compact_ids(nodes):
+    """
+    Recover dictionaries returned by compact_graph_ids from the columns of compacted nodes
+    :param nodes: DataFrame with columns "id", "type", "label", "compact_label", "graph_id", "typed_id"
+    :return: label_map, id_map, typed_id_map
+    """
+    labels = nodes[['label', 'compact_label']].drop_duplicates('compact_label').sort_values('compact_label')
+    label_map = dict(zip(labels['label'].values, range(labels.shape[0])))
+
+    by_graph_id = nodes.sort_values('graph_id')
+    id_map = dict(zip(by_graph_id['id'].values, range(by_graph_id.shape[0])))
+
+    typed_id_map = {}
+    for type, group in nodes.sort_values('typed_id').groupby('type'):
+        typed_id_map[str(type)] = dict(zip(group['id'].values, range(group.shape[0])))
+
+    return label_map, id_map, typed_id_map
+
+
+def build_hetero_graph(edges, typed_node_counts):
+    """
+    Create heterogeneous graph from edges with compacted typed ids. Edges are grouped by
+    (src_type, type, dst_type) signature in a single pass and every relation receives index tensors
+    with typed ids of its source and destination nodes.
+    :param edges: DataFrame with columns "src_type", "type", "dst_type", "src_type_typed_id", "dst_type_typed_id"
+    :param typed_node_counts: dictionary with the number of nodes for every node type
+    :return: DGLHeteroGraph
+    """
+    src = edges['src_type_typed_id'].values.astype(numpy.int64)
+    dst = edges['dst_type_typed_id'].values.astype(numpy.int64)
+
+    # typed_subgraphs is a dictionary with subgraph signature as a key,
+    # the dictionary stores tensors with source and destination typed ids
+    typed_subgraphs = {}
+
+    signatures = edges.groupby(['src_type', 'type', 'dst_type'], sort=False).indices
+
+    for (src_type, type, dst_type), ind in signatures.items():
+        subgraph_signature = (str(src_type), str(type), str(dst_type))
+        typed_subgraphs[subgraph_signature] = (torch.from_numpy(src[ind]), torch.from_numpy(dst[ind]))
+
+    return dgl.heterograph(typed_subgraphs, typed_node_counts)
+
+
 def get_train_test_val_indices(labels):
     # numpy.random.seed(42)
 
@@ -53,7 +186,8 @@ def get_train_test_val_indices(labels):
 class SourceGraphDataset:
     def __init__(self, nodes_path, edges_path,
                  label_from, node_types=False,
-                 edge_types=False, filter=None, holdout_frac=0.001, restore_state=False):
+                 edge_types=False, filter=None, holdout_frac=0.001, restore_state=False, cache_dir=None,
+                 holdout_seed=42):
         """
         Prepares the data for training GNN model. The graph is prepared in the following way:
             1. Edges are split into the train set and holdout set. Holdout set is used in the future experiments.
@@ -77,6 +211,10 @@ class SourceGraphDataset:
                 (edge-heterogeneous graph}
         :param filter: list[str], the types of edges to filter from graph
         :param holdout_frac: float in [0, 1]
+        :param restore_state: restore edge splits and node splits from temporary files in the working directory
+        :param cache_dir: directory for binary dataset cache. When the cache contains an entry for the same input
+                files and parameters, the preprocessed dataset is loaded from it instead of being recomputed.
+        :param holdout_seed: random seed for the holdout split, the same seed gives the same split
         """
         # TODO
         # 1. test with node types and RGCN
@@ -89,6 +227,21 @@ class SourceGraphDataset:
         # self.edges = pandas.read_csv(edges_path)
 
         self.holdout_frac = holdout_frac
+        self.nodes_have_types = node_types
+        self.edges_have_types = edge_types
+        self.labels_from = label_from
+
+        self.g = None
+
+        if cache_dir is not None:
+            cache = DatasetCache(cache_dir, nodes_path, edges_path, label_from=label_from, node_types=node_types,
+                                 edge_types=edge_types, filter=filter, holdout_frac=holdout_frac,
+                                 holdout_seed=holdout_seed)
+            if cache.exists() and not restore_state:
+                self.load_from_cache(cache)
+                return
+        else:
+            cache = None
 
         self.nodes, self.edges = load_data(nodes_path, edges_path)
 
@@ -97,7 +250,8 @@ class SourceGraphDataset:
             print("Restored graph from saved state")
         else:
             # the next line will delete isolated nodes
-            self.nodes, self.edges, self.held = SourceGraphDataset.holdout(self.nodes, self.edges, self.holdout_frac)
+            self.nodes, self.edges, self.held = SourceGraphDataset.holdout(self.nodes, self.edges, self.holdout_frac,
+                                                                           seed=holdout_seed)
             pickle.dump((self.nodes, self.edges, self.held), open("tmp_edgesplits.pkl", "wb"))
 
         # ablation
@@ -111,12 +265,6 @@ class SourceGraphDataset:
         self.edges = self.edges.query("type != 16")
         print("Edges after filtering", self.edges.shape[0])
 
-        self.nodes_have_types = node_types
-        self.edges_have_types = edge_types
-        self.labels_from = label_from
-
-        self.g = None
-
         # compact labels
         self.nodes['label'] = self.nodes[label_from]
         self.label_map = compact_property(self.nodes['label'])
@@ -127,10 +275,8 @@ class SourceGraphDataset:
         if not self.nodes_have_types:
             self.nodes['type'] = 0
 
-        self.nodes, self.label_map = self.add_compact_labels()
-        self.nodes, self.id_map = self.add_graph_ids()
-        self.nodes, self.typed_id_map = self.add_typed_ids()
-        self.edges = self.add_compact_edges()
+        self.nodes, self.edges, self.label_map, self.id_map, self.typed_id_map = \
+            compact_graph_ids(self.nodes, self.edges)
 
         self.create_graph()
 
@@ -145,83 +291,35 @@ class SourceGraphDataset:
             self.splits = get_train_test_val_indices(self.labels)
             pickle.dump(self.splits, open("tmp_splits.pkl", "wb"))
 
+        if cache is not None:
+            cache.save(self)
+            print("Saved dataset to cache", cache.path)
 
-    def add_graph_ids(self):
-
-        nodes = self.nodes.copy()
-
-        id_map = compact_property(nodes['id'])
-
-        nodes['graph_id'] = nodes['id'].apply(lambda old_id: id_map[old_id])
-
-        return nodes, id_map
-
-    def add_typed_ids(self):
-        nodes = self.nodes.copy()
-
-        typed_id_map = {}
-
-        for type in nodes['type'].unique():
-            type_ind = nodes[nodes['type'] == type].index
-
-            id_map = compact_property(nodes.loc[type_ind, 'id'])
-
-            nodes.loc[type_ind, 'typed_id'] = nodes.loc[type_ind, 'id'].apply(lambda old_id: id_map[old_id])
-
-            typed_id_map[str(type)] = id_map
-
-        assert any(pandas.isna(nodes['typed_id'])) == False
-
-        return nodes, typed_id_map
-
-    def add_compact_labels(self):
-
-        nodes = self.nodes.copy()
-
-        label_map = compact_property(nodes['label'])
+    def load_from_cache(self, cache):
+        self.nodes, self.edges, self.held, self.splits, self.g = cache.load()
+        self.label_map, self.id_map, self.typed_id_map = maps_from_compact_ids(self.nodes)
 
-        nodes['compact_label'] = nodes['label'].apply(lambda old_id: label_map[old_id])
+        if self.g is None:
+            self.create_graph()
 
-        return nodes, label_map
-
-    def add_compact_edges(self):
-
-        edges = self.edges.copy()
-
-        node_type_map = dict(zip(self.nodes['id'].values, self.nodes['type']))
-
-        edges['src_type'] = edges['src'].apply(lambda src_id: node_type_map[src_id])
-        edges['dst_type'] = edges['dst'].apply(lambda dst_id: node_type_map[dst_id])
-
-        typed_map = dict(zip(self.nodes['id'].values, self.nodes['typed_id']))
-
-        edges['src_type_graph_id'] = edges['src'].apply(lambda src_id: self.id_map[src_id])
-        edges['dst_type_graph_id'] = edges['dst'].apply(lambda dst_id: self.id_map[dst_id])
-        edges['src_type_typed_id'] = edges['src'].apply(lambda src_id: typed_map[src_id])
-        edges['dst_type_typed_id'] = edges['dst'].apply(lambda dst_id: typed_map[dst_id])
-
-        return edges
+        print("Restored dataset from cache", cache.path)
 
     def update_global_id(self):
         if self.edges_have_types:
-            orig_id = [];
-            graph_id = [];
+            # global id is typed id shifted by the number of nodes of preceding types in the graph
+            type_offset = {}
             prev_offset = 0
 
-            # typed_node_id_maps = self.typed_node_id_maps
-            typed_node_id_maps = self.typed_id_map
-
             for type in self.g.ntypes:
-                from_id, to_id = zip(*typed_node_id_maps[type].items())
-                orig_id.extend(from_id)
-                graph_id.extend([t + prev_offset for t in to_id])
+                type_offset[type] = prev_offset
                 prev_offset += self.g.number_of_nodes(type)
 
-            global_map = dict(zip(orig_id, graph_id))
-        else:
-            global_map = self.id_map
+            types, type_codes = compact_codes(self.nodes['type'].values)
+            offsets = numpy.array([type_offset[str(type)] for type in types], dtype=numpy.int64)
 
-        self.nodes['global_graph_id'] = self.nodes['id'].apply(lambda old_id: global_map[old_id])
+            self.nodes['global_graph_id'] = self.nodes['typed_id'].values + offsets[type_codes]
+        else:
+            self.nodes['global_graph_id'] = self.nodes['graph_id'].values
 
     @property
     def global_id_map(self):
@@ -337,15 +435,9 @@ class SourceGraphDataset:
     @property
     def typed_node_counts(self):
 
-        typed_node_counts = dict()
-
-        unique_types = self.nodes['type'].unique()
-
-        for type_id, type in enumerate(unique_types):
-            nodes_of_type = self.nodes[self.nodes['type'] == type]
-            typed_node_counts[str(type)] = nodes_of_type.shape[0]
+        type_counts = self.nodes['type'].value_counts(sort=False)
 
-        return typed_node_counts
+        return {str(type): int(count) for type, count in type_counts.items()}
 
     def create_directed_graph(self):
         # nodes = self.nodes.copy()
@@ -369,7 +461,8 @@ class SourceGraphDataset:
 
         g = dgl.DGLGraph()
         g.add_nodes(self.nodes.shape[0])
-        g.add_edges(self.edges['src_type_graph_id'].values.tolist(), self.edges['dst_type_graph_id'].values.tolist())
+        g.add_edges(torch.from_numpy(self.edges['src_type_graph_id'].values.astype(numpy.int64)),
+                    torch.from_numpy(self.edges['dst_type_graph_id'].values.astype(numpy.int64)))
 
         self.g = g
 
@@ -377,58 +470,11 @@ class SourceGraphDataset:
         # TODO
         # arguments are still not used
 
-        nodes = self.nodes.copy()
-        edges = self.edges.copy()
-
-        # from graphtools import create_hetero_graph
-        # g, labels, id_maps = create_hetero_graph(nodes, edges)
-        # self.g = g
-        # self.het_labels = labels
-        # self.het_id_maps = id_maps
-        # return
-
         # TODO
         # this is a hack when where are only outgoing connections from this node type
         # nodes, edges = Dataset.assess_need_for_self_loops(nodes, edges)
 
-        typed_node_id = dict(zip(nodes['id'], nodes['typed_id']))
-
-        # typed_node_id_maps = self.typed_node_id_maps
-        # typed_node_id_maps = self.typed_id_map
-
-        # node2type = dict(zip(nodes['id'].values, nodes['type'].values))
-
-        # def graphid_lookup(nid):
-        #     for type, maps in typed_node_id_maps.items():
-        #         if nid in maps:
-        #             return maps[nid]
-        #
-        # type_lookup = lambda id: node2type[id]
-
-        # edges['src_type'] = edges['src'].apply(type_lookup)
-        # edges['dst_type'] = edges['dst'].apply(type_lookup)
-
-        possible_edge_signatures = edges[['src_type', 'type', 'dst_type']].drop_duplicates(
-            ['src_type', 'type', 'dst_type']
-        )
-
-        # typed_subgraphs is a dictionary with subset_signature as a key,
-        # the dictionary stores directed edge lists
-        typed_subgraphs = {}
-
-        for ind, row in possible_edge_signatures.iterrows():
-            subgraph_signature = (str(row.src_type), str(row.type), str(row.dst_type))
-
-            subset = edges.query('src_type == %s and type==%s and dst_type==%s' % subgraph_signature)
-
-            typed_subgraphs[(subgraph_signature)] = list(
-                zip(
-                    map(lambda old_id: typed_node_id[old_id], subset['src'].values),
-                    map(lambda old_id: typed_node_id[old_id], subset['dst'].values)
-                )
-            )
-
-        self.g = dgl.heterograph(typed_subgraphs, self.typed_node_counts)
+        self.g = build_hetero_graph(self.edges, self.typed_node_counts)
 
         # self.typed_labels_ = typed_labels
         # self.typed_id_maps_ = typed_id_maps
@@ -499,8 +545,8 @@ class SourceGraphDataset:
         return nodes, edges
 
     @classmethod
-    def holdout(cls, nodes, edges, HOLDOUT_FRAC):
-        train, test = split(edges, HOLDOUT_FRAC)
+    def holdout(cls, nodes, edges, HOLDOUT_FRAC, seed=42):
+        train, test = split(edges, HOLDOUT_FRAC, seed=seed)
 
         nodes, train_edges = ensure_connectedness(nodes, train)
 
@@ -509,15 +555,73 @@ class SourceGraphDataset:
         return nodes, train_edges, test_edges
 
 
-def split(edges, HOLDOUT_FRAC):
-    edges_shuffled = edges.sample(frac=1., random_state=42)
+def holdout_mask(positions, holdout_frac, seed=42):
+    """
+    Decide which edges go into the holdout set. The decision for every edge depends only on its position in the
+    edge table and the seed, so the split is the same whether the table is processed at once or in chunks.
+    Positions are hashed with splitmix64, and the edge is held out when the hash, mapped to [0, 1), is below
+    holdout_frac.
+    :param positions: array of edge positions (row numbers) in the edge table
+    :param holdout_frac: expected fraction of held out edges
+    :param seed: random seed
+    :return: boolean mask, True for held out edges
+    """
+    x = numpy.asarray(positions, dtype=numpy.uint64) + numpy.uint64(seed * 0x9E3779B97F4A7C15 % (1 << 64))
+    x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    x = x ^ (x >> numpy.uint64(31))
+    return (x >> numpy.uint64(11)) * (1. / (1 << 53)) < holdout_frac
 
-    train_frac = int(edges_shuffled.shape[0] * (1. - HOLDOUT_FRAC))
 
-    train = edges_shuffled \
-                .iloc[:train_frac]
-    test = edges_shuffled \
-               .iloc[train_frac:]
+def id_bitmap(ids, size=None):
+    """
+    Boolean array where positions of ids are set, used for membership tests of non-negative integer ids
+    :param ids: array of non-negative integer ids
+    :param size: size of the bitmap, by default the largest id + 1
+    """
+    if size is None:
+        size = int(ids.max()) + 1 if ids.size > 0 else 0
+    bitmap = numpy.zeros(size, dtype=numpy.bool_)
+    bitmap[ids] = True
+    return bitmap
+
+
+def is_in(values, bitmap):
+    """
+    Vectorized membership test with bitmap created by id_bitmap
+    """
+    values = numpy.asarray(values)
+    in_range = (values >= 0) & (values < bitmap.size)
+    if bitmap.size == 0:
+        return in_range
+    return in_range & bitmap[numpy.where(in_range, values, 0)]
+
+
+# bitmaps are used for membership tests when the largest id is at most this many times larger than the number of ids
+BITMAP_MAX_RATIO = 8
+
+
+def isin_ids(values, pool):
+    """
+    Same as numpy.isin, but uses bitmap when ids are non-negative integers that are not too sparse
+    :param values: array of ids
+    :param pool: array of ids that are tested for
+    :return: boolean mask for values
+    """
+    values = numpy.asarray(values)
+    pool = numpy.asarray(pool)
+    if pool.size > 0 and numpy.issubdtype(pool.dtype, numpy.integer) and \
+            numpy.issubdtype(values.dtype, numpy.integer) and pool.min() >= 0 and \
+            pool.max() < BITMAP_MAX_RATIO * (pool.size + values.size):
+        return is_in(values, id_bitmap(pool))
+    return numpy.isin(values, pool)
+
+
+def split(edges, HOLDOUT_FRAC, seed=42):
+    held = holdout_mask(numpy.arange(edges.shape[0]), HOLDOUT_FRAC, seed=seed)
+
+    train = edges[~held]
+    test = edges[held]
     print("Splitting edges into train and test set. Train: {}. Test: {}. Fraction: {}". \
           format(train.shape[0], test.shape[0], HOLDOUT_FRAC))
     return train, test
@@ -533,12 +637,8 @@ def ensure_connectedness(nodes: pandas.DataFrame, edges: pandas.DataFrame):
 
     print("Filtering isolated nodes. Starting from {} nodes and {} edges...".format(nodes.shape[0], edges.shape[0]),
           end="")
-    unique_nodes = set(edges['src'].values.tolist() +
-                       edges['dst'].values.tolist())
 
-    nodes = nodes[
-        nodes['id'].apply(lambda nid: nid in unique_nodes)
-    ]
+    nodes = nodes[isin_ids(nodes['id'].to_numpy(), numpy.concatenate([edges['src'].to_numpy(), edges['dst'].to_numpy()]))]
 
     print("ending up with {} nodes and {} edges".format(nodes.shape[0], edges.shape[0]))
 
@@ -556,16 +656,67 @@ def ensure_valid_edges(nodes, edges):
                                                                                             edges.shape[0]),
           end="")
 
-    unique_nodes = set(nodes['id'].values.tolist())
-
-    edges = edges[
-        edges['src'].apply(lambda nid: nid in unique_nodes)
-    ]
-
-    edges = edges[
-        edges['dst'].apply(lambda nid: nid in unique_nodes)
-    ]
+    valid = nodes['id'].to_numpy()
+    edges = edges[isin_ids(edges['src'].to_numpy(), valid) & isin_ids(edges['dst'].to_numpy(), valid)]
 
     print("ending up with {} nodes and {} edges".format(nodes.shape[0], edges.shape[0]))
 
     return nodes, edges
+
+
+def holdout_from_file(nodes, edges_path, train_path, held_path, holdout_frac, seed=42, chunksize=1000000):
+    """
+    Same as SourceGraphDataset.holdout, but edges are read from file and written to train_path and held_path chunk
+    by chunk, so that only the nodes and the held out edges are kept in memory. The output is identical to the
+    output of SourceGraphDataset.holdout with the same seed. Node ids should be non-negative integers, connected
+    nodes are tracked with a bitmap.
+    :param nodes: nodes DataFrame as returned by load_data
+    :param edges_path: path to the file with edges in the format accepted by load_data
+    :param train_path: path to the output csv with train edges
+    :param held_path: path to the output csv with held out edges
+    :param holdout_frac: expected fraction of held out edges
+    :param seed: random seed
+    :param chunksize: number of edges in one chunk
+    :return: nodes that are connected to at least one train edge
+    """
+    connected = numpy.zeros(0, dtype=numpy.bool_)
+    held = []
+    offset = 0
+    num_train = 0
+    columns = {
+        'source_node_id': 'src',
+        'target_node_id': 'dst'
+    }
+
+    for chunk in pandas.read_csv(edges_path, chunksize=chunksize):
+        chunk = chunk.rename(mapper=columns, axis=1)
+
+        mask = holdout_mask(numpy.arange(offset, offset + chunk.shape[0]), holdout_frac, seed=seed)
+        offset += chunk.shape[0]
+
+        train = chunk[~mask]
+        held.append(chunk[mask])
+
+        ids = numpy.concatenate([train['src'].to_numpy(), train['dst'].to_numpy()]).astype(numpy.int64)
+        if ids.size > 0 and ids.max() >= connected.size:
+            connected = numpy.concatenate([connected, numpy.zeros(ids.max() + 1 - connected.size, dtype=numpy.bool_)])
+        connected[ids] = True
+
+        train.to_csv(train_path, mode="w" if num_train == 0 else "a", header=num_train == 0, index=False)
+        num_train += train.shape[0]
+
+    if len(held) == 0:
+        # the file has no edges, outputs only have the header
+        held.append(pandas.read_csv(edges_path, nrows=0).rename(mapper=columns, axis=1))
+        held[0].to_csv(train_path, index=False)
+    held = pandas.concat(held)
+    print("Splitting edges into train and test set. Train: {}. Test: {}. Fraction: {}". \
+          format(num_train, held.shape[0], holdout_frac))
+
+    nodes = nodes[is_in(nodes['id'].to_numpy(), connected)]
+    print("Filtered isolated nodes, {} nodes left".format(nodes.shape[0]))
+
+    nodes, held = ensure_valid_edges(nodes, held)
+    held.to_csv(held_path, index=False)
+
+    return nodes
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import shutil
+from os.path import abspath, getmtime, getsize, isdir, isfile, join
+
+import dgl
+import numpy
+import pandas
+
+# increment when the layout of the cache or the preprocessing in SourceGraphDataset changes
+CACHE_VERSION = 2
+
+
+def save_table(table, path):
+    """
+    Store every column of the table in a separate .npy file in the directory path
+    :return: list of column names, needed to load the table
+    """
+    os.mkdir(path)
+    columns = []
+    for ind, column in enumerate(table.columns):
+        values = table[column].to_numpy()
+        numpy.save(join(path, "{}.npy".format(ind)), values, allow_pickle=True)
+        columns.append(column)
+    return columns
+
+
+def load_table(path, columns, mmap=True):
+    """
+    Load the table written by save_table
+    :param columns: column names returned by save_table
+    :param mmap: whether to memory-map numeric columns. Columns are mapped copy-on-write, in-place changes are
+        allowed and are not written back to the cache
+    """
+    data = {}
+    for ind, column in enumerate(columns):
+        file_path = join(path, "{}.npy".format(ind))
+        try:
+            data[column] = numpy.load(file_path, mmap_mode="c" if mmap else None)
+        except ValueError:
+            # object arrays can not be memory-mapped
+            data[column] = numpy.load(file_path, allow_pickle=True)
+    # without copy=False the frame copies mapped columns into memory
+    return pandas.DataFrame(data, columns=columns, copy=False)
+
+
+class DatasetCache:
+    """
+    Binary on-disk cache for preprocessed SourceGraphDataset. Every column of nodes, edges and held tables is stored
+    in a separate .npy file. Numeric columns are memory-mapped on load, columns with python objects (e.g. names) are
+    unpickled. The graph is stored with dgl.save_graphs. Cache entries are stored in subdirectories of cache_dir
+    named after the hash of input files and preprocessing parameters, so that changing any of them creates a new entry.
+    """
+    def __init__(self, cache_dir, nodes_path, edges_path, **params):
+        """
+
+        :param cache_dir: directory where cache entries are stored
+        :param nodes_path: path to nodes file, the path, size and modification time of the file are included into key
+        :param edges_path: path to edges file, the path, size and modification time of the file are included into key
+        :param params: preprocessing parameters that affect the content of the dataset, must be json serializable
+        """
+        self.cache_dir = cache_dir
+        self.key = DatasetCache.make_key(nodes_path, edges_path, **params)
+        self.path = join(cache_dir, self.key)
+
+    @staticmethod
+    def make_key(nodes_path, edges_path, **params):
+        description = {
+            "version": CACHE_VERSION,
+            "files": [
+                [abspath(path), getsize(path), getmtime(path)] for path in [nodes_path, edges_path]
+            ],
+            "params": params
+        }
+        return hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode("utf8")).hexdigest()
+
+    def exists(self):
+        return isfile(join(self.path, "manifest.json"))
+
+    def save(self, dataset):
+        """
+        Store preprocessed dataset. The entry is written into a temporary directory and renamed when complete,
+        so interrupted runs do not leave partial entries.
+        :param dataset: SourceGraphDataset
+        :return: None
+        """
+        if not isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        tmp_path = self.path + ".tmp"
+        if isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.mkdir(tmp_path)
+
+        manifest = {
+            "version": CACHE_VERSION,
+            "tables": {
+                name: save_table(getattr(dataset, name), join(tmp_path, name))
+                for name in ["nodes", "edges", "held"]
+            },
+            "graph": None
+        }
+
+        for ind, split in enumerate(dataset.splits):
+            numpy.save(join(tmp_path, "split_{}.npy".format(ind)), split)
+
+        try:
+            dgl.save_graphs(join(tmp_path, "graph.bin"), [dataset.g])
+            manifest["graph"] = "graph.bin"
+        except Exception as e:
+            # older versions of DGL do not serialize heterographs, the graph is rebuilt on load in this case
+            print("Graph is not cached:", e)
+
+        with open(join(tmp_path, "manifest.json"), "w") as manifest_file:
+            manifest_file.write(json.dumps(manifest, indent=4))
+
+        if isdir(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp_path, self.path)
+
+    def load(self, mmap=True):
+        """
+        Load preprocessed dataset
+        :param mmap: whether to memory-map numeric columns
+        :return: nodes, edges, held, splits, graph. graph is None if it was not cached.
+        """
+        with open(join(self.path, "manifest.json")) as manifest_file:
+            manifest = json.loads(manifest_file.read())
+
+        nodes, edges, held = (
+            load_table(join(self.path, name), manifest["tables"][name], mmap=mmap)
+            for name in ["nodes", "edges", "held"]
+        )
+
+        splits = tuple(numpy.load(join(self.path, "split_{}.npy".format(ind))) for ind in range(3))
+
+        if manifest["graph"] is not None:
+            graphs, _ = dgl.load_graphs(join(self.path, manifest["graph"]))
+            g = graphs[0]
+        else:
+            g = None
+
+        return nodes, edges, held, splits, g
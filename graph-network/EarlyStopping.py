@@ -0,0 +1,148 @@
+from time import perf_counter
+
+
+class EarlyStopping:
+    """
+    Decides when training stops before the epoch budget is exhausted: when the monitored metric has not improved by
+    more than min_delta for patience consecutive epochs, or when the wall-clock budget is spent. Keeps the epoch and
+    value of the best result, and estimates the time saved from the average duration of completed epochs.
+
+        stopping = EarlyStopping(patience=10, mode="max", max_epochs=EPOCHS)
+        stopping.start()
+        for epoch in range(EPOCHS):
+            ...
+            if stopping.step(epoch, val_acc):
+                break
+        stopping.finish()
+        print(stopping.summary())
+    """
+    def __init__(self, patience=None, min_delta=0., mode="max", time_budget=None, max_epochs=None):
+        """
+
+        :param patience: number of epochs without improvement after which training stops, None disables
+        :param min_delta: improvements smaller than this are ignored
+        :param mode: "max" for metrics like accuracy, "min" for metrics like loss
+        :param time_budget: wall-clock time in seconds that training may take, measured from the first epoch. None
+            disables
+        :param max_epochs: epoch budget of training, used to estimate the time saved
+        """
+        if mode not in {"max", "min"}:
+            raise ValueError("Unknown mode:", mode)
+        if patience is not None and patience < 1:
+            raise ValueError("Patience should be at least 1")
+        self.patience = patience
+        self.min_delta = min_delta
+        self.mode = mode
+        self.time_budget = time_budget
+        self.max_epochs = max_epochs
+        self.reset()
+
+    def reset(self):
+        """
+        Prepare for a new training run
+        """
+        self.start_time = None
+        self.end_time = None
+        self.last_epoch = None
+        self.epochs_run = 0
+        self.best_epoch = None
+        self.best_value = None
+        self.wait = 0
+        self.reason = None
+
+    def start(self):
+        """
+        Start measuring time, called right before the first epoch. If it was not called, time is measured from the
+        end of the first epoch
+        """
+        self.start_time = perf_counter()
+        self.end_time = None
+
+    def finish(self):
+        """
+        Stop measuring time, called when training ends. Called by the step that stops training
+        """
+        if self.end_time is None and self.start_time is not None:
+            self.end_time = perf_counter()
+
+    def improved(self, value):
+        if self.best_value is None:
+            return True
+        if self.mode == "max":
+            return value > self.best_value + self.min_delta
+        return value < self.best_value - self.min_delta
+
+    def step(self, epoch, value):
+        """
+        Record the metric at the end of the epoch
+        :param epoch: index of the epoch
+        :param value: monitored metric
+        :return: True if training should stop
+        """
+        if self.start_time is None:
+            self.start()
+        self.last_epoch = epoch
+        self.epochs_run += 1
+        value = float(value)
+
+        if self.improved(value):
+            self.best_epoch = epoch
+            self.best_value = value
+            self.wait = 0
+        else:
+            self.wait += 1
+
+        if self.patience is not None and self.wait >= self.patience:
+            self.reason = "no improvement for {} epochs".format(self.patience)
+        elif self.time_budget is not None and self.elapsed >= self.time_budget:
+            self.reason = "time budget of {} s".format(self.time_budget)
+        if self.stopped:
+            self.finish()
+        return self.stopped
+
+    @property
+    def stopped(self):
+        return self.reason is not None
+
+    @property
+    def elapsed(self):
+        """
+        Training time, up to the end of training once it is finished
+        """
+        if self.start_time is None:
+            return 0.
+        return (self.end_time if self.end_time is not None else perf_counter()) - self.start_time
+
+    @property
+    def epochs_saved(self):
+        if not self.stopped or self.max_epochs is None:
+            return 0
+        return max(0, self.max_epochs - (self.last_epoch + 1))
+
+    @property
+    def time_saved(self):
+        """
+        Estimated time of the epochs that were not run
+        """
+        if self.epochs_run == 0:
+            return 0.
+        return self.elapsed / self.epochs_run * self.epochs_saved
+
+    def report(self):
+        """
+        :return: dictionary with the epoch where training stopped, the best epoch and the time saved
+        """
+        return {
+            "stop_epoch": self.last_epoch,
+            "best_epoch": self.best_epoch,
+            "best_value": self.best_value,
+            "stop_reason": self.reason or "epoch budget",
+            "epochs_saved": self.epochs_saved,
+            "time_saved": self.time_saved,
+        }
+
+    def summary(self):
+        if not self.stopped:
+            return "Trained for {} epochs, best epoch {}".format(self.epochs_run, self.best_epoch)
+        return "Stopped at epoch {} ({}), best epoch {}, saved {} epochs, about {:.1f} s".format(
+            self.last_epoch, self.reason, self.best_epoch, self.epochs_saved, self.time_saved)
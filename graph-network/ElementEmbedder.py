@@ -53,7 +53,8 @@ class ElementEmbedder(ElementEmbedderBase, nn.Module):
     #     return np.random.choice(self.idxs, size, replace=True, p=self.neg_prob)
 
     def __getitem__(self, ids):
-        return torch.LongTensor(ElementEmbedderBase.__getitem__(self, ids=ids))
+        # sampled int64 array is shared with the tensor without copying
+        return torch.from_numpy(self.sample_elements(ids))
         # return torch.LongTensor(np.array([rnd.choice(self.element_lookup[id]) for id in ids]))
 
     # def __len__(self):
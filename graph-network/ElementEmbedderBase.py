@@ -1,5 +1,9 @@
 import numpy as np
-import random as rnd
+
+from AliasSampler import AliasSampler
+
+# lookup table for node ids is used when the largest id is at most this many times larger than the number of nodes
+DENSE_LOOKUP_MAX_RATIO = 4
 
 def compact_property(values):
     uniq = np.unique(values)
@@ -8,45 +12,95 @@ def compact_property(values):
     return prop2pid
 
 class ElementEmbedderBase:
+    """
+    Stores elements (e.g. names or called functions) adjacent to every node and samples one of them per node.
+    Elements of all nodes are stored in CSR format: elements of the node with key keys[i] are
+    indices[indptr[i]: indptr[i + 1]].
+    """
     def __init__(self, elements, compact_dst=True):
 
         self.elements = elements.copy()
 
         if compact_dst:
-            elem2id = compact_property(elements['dst'])
-            self.elements['emb_id'] = self.elements['dst'].apply(lambda x: elem2id[x])
+            # same ids as compact_property
+            _, self.elements['emb_id'] = np.unique(self.elements['dst'].to_numpy(), return_inverse=True)
         else:
             self.elements['emb_id'] = self.elements['dst']
 
-        self.element_lookup = {}
-        for name, group in self.elements.groupby('id'):
-            self.element_lookup[name] = group['emb_id'].tolist()
+        self.init_csr()
 
         self.init_neg_sample()
 
+    def init_csr(self):
+        self.keys, key_codes = np.unique(self.elements['id'].to_numpy(), return_inverse=True)
+        key_codes = key_codes.ravel()
+
+        order = np.argsort(key_codes, kind="stable")
+        self.indices = self.elements['emb_id'].to_numpy().astype(np.int64)[order]
+        self.indptr = np.zeros(self.keys.size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(key_codes, minlength=self.keys.size), out=self.indptr[1:])
+
+        # node ids are usually compact graph ids, in this case rows are found with a lookup table
+        if self.keys.size > 0 and np.issubdtype(self.keys.dtype, np.number) and \
+                self.keys[0] >= 0 and self.keys[-1] < DENSE_LOOKUP_MAX_RATIO * self.keys.size:
+            self.key_lookup = np.full(int(self.keys[-1]) + 1, -1, dtype=np.int64)
+            self.key_lookup[self.keys.astype(np.int64)] = np.arange(self.keys.size)
+        else:
+            self.key_lookup = None
+
+    def key_rows(self, ids):
+        """
+        Find rows of CSR structure for node ids
+        :param ids: array of node ids
+        :return: array of row indices
+        :raises KeyError: if some nodes do not have elements
+        """
+        ids = np.asarray(ids)
+        if self.key_lookup is not None:
+            in_range = (ids >= 0) & (ids < self.key_lookup.size)
+            rows = self.key_lookup[np.where(in_range, ids, 0).astype(np.int64)]
+            rows[rows < 0] = 0
+        else:
+            rows = np.searchsorted(self.keys, ids)
+            rows[rows == self.keys.size] = 0
+        # also catches ids that are not integer when the lookup table is used
+        missing = self.keys[rows] != ids
+        if missing.any():
+            raise KeyError(ids[missing][0])
+        return rows
+
     def init_neg_sample(self):
         WORD2VEC_SAMPLING_POWER = 3 / 4
 
-        # compute distribution of dst elements
-        counts = self.elements['emb_id'].value_counts(normalize=True)
-        # idxs = list(map(lambda x: self.elem2id[x], counts.index))
-        self.idxs = counts.index
-        self.neg_prob = counts.to_numpy()
-        self.neg_prob **= WORD2VEC_SAMPLING_POWER
-        # ind_freq = list(zip(idxs, freq))
-        # ind_freq = sorted(ind_freq, key=lambda x:x[0])
-        # _, self.elem_probs = zip(*ind_freq)
-        # self.elem_probs = np.power(self.elem_probs, WORD2VEC_SAMPLING_POWER)
-        self.neg_prob /= sum(self.neg_prob)
-        # self.random_indices = np.arange(0, len(self.elem2id))
+        # negative samples are drawn from the distribution of dst elements raised to the power
+        self.negative_sampler = AliasSampler.from_occurrences(
+            self.elements['emb_id'].values, power=WORD2VEC_SAMPLING_POWER
+        )
 
     def sample_negative(self, size):
         # TODO
         # Try other distributions
-        return np.random.choice(self.idxs, size, replace=True, p=self.neg_prob)
+        return self.negative_sampler.sample(size)
+
+    def sample_positions(self, rows):
+        """
+        Pick one random element for every row of CSR structure
+        :param rows: array of rows, see key_rows
+        :return: positions of elements in indices
+        """
+        start = self.indptr[rows]
+        return start + (np.random.random(rows.shape) * (self.indptr[rows + 1] - start)).astype(np.int64)
+
+    def sample_elements(self, ids):
+        """
+        Pick one random element for every node id
+        :param ids: array of node ids
+        :return: int64 array of element ids
+        """
+        return self.indices[self.sample_positions(self.key_rows(ids))]
 
     def __getitem__(self, ids):
-        return np.fromiter((rnd.choice(self.element_lookup[id]) for id in ids), dtype=np.int32)
+        return self.sample_elements(ids).astype(np.int32)
 
     def __len__(self):
-        return len(self.element_lookup)
\ No newline at end of file
+        return self.keys.size
@@ -1,20 +1,329 @@
+import json
+import os
+import pickle
+import re
+from os.path import isdir, isfile, join
+
 import numpy as np
 
+# dense lookup table is used when the largest id is at most this many times larger than the number of ids
+DENSE_LOOKUP_MAX_RATIO = 4
+
+
 class Embedder:
+    """
+    Maps original node ids to rows of the embedding table. The id index is stored as numpy arrays: a dense lookup
+    table when ids are compact enough, and sorted ids otherwise. Batches of ids are resolved with fancy indexing or
+    searchsorted instead of per-element dictionary lookups.
+    """
     def __init__(self, id_map, embeddings):
+        """
+
+        :param id_map: dictionary that maps original node ids to rows of embeddings
+        :param embeddings: array with embeddings, can be memory-mapped
+        """
+        ids = np.fromiter(id_map.keys(), dtype=np.int64, count=len(id_map))
+        rows = np.fromiter(id_map.values(), dtype=np.int64, count=len(id_map))
+        self._set_index(embeddings, ids, rows)
+
+    @classmethod
+    def from_arrays(cls, ids, rows, embeddings):
+        """
+        Create Embedder without building a dictionary
+        :param ids: array of original node ids
+        :param rows: array of the same size, rows[i] is the row of embeddings for the node ids[i]
+        :param embeddings: array with embeddings
+        """
+        embedder = cls.__new__(cls)
+        embedder._set_index(embeddings, np.asarray(ids, dtype=np.int64), np.asarray(rows, dtype=np.int64))
+        return embedder
+
+    def _set_index(self, embeddings, ids, rows):
         self.e = embeddings
-        self.ind = id_map
-        aid, iid = zip(*id_map.items())
-        self.inv = dict(zip(iid, aid))
 
+        order = np.argsort(ids, kind="stable")
+        self.ids = ids[order]
+        self.rows = rows[order]
+
+        if self.ids.size > 0 and self.ids[0] >= 0 and self.ids[-1] < DENSE_LOOKUP_MAX_RATIO * self.ids.size:
+            self.lookup = np.full(self.ids[-1] + 1, -1, dtype=np.int64)
+            self.lookup[self.ids] = self.rows
+        else:
+            self.lookup = None
+
+        self._ind = None
+        self._inv = None
+
+    def _positions(self, keys):
+        """
+        Find rows for keys
+        :param keys: array of original node ids
+        :return: rows and boolean mask of keys that are present in the index
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if self.lookup is not None:
+            in_range = (keys >= 0) & (keys < self.lookup.size)
+            rows = self.lookup[np.where(in_range, keys, 0)]
+            found = in_range & (rows >= 0)
+        else:
+            # searchsorted is considerably faster for sorted keys, because they are located with fewer cache misses
+            order = np.argsort(keys, axis=None)
+            pos = np.empty(keys.size, dtype=np.int64)
+            pos[order] = np.searchsorted(self.ids, keys.ravel()[order])
+            pos = pos.reshape(keys.shape)
+            pos[pos == self.ids.size] = 0
+            rows = self.rows[pos] if self.ids.size > 0 else np.zeros_like(keys)
+            found = self.ids[pos] == keys if self.ids.size > 0 else np.zeros(keys.shape, dtype=np.bool_)
+        return rows, found
+
+    def to_rows(self, keys):
+        """
+        Translate original node ids into rows of embeddings
+        :param keys: array of original node ids
+        :return: array of rows
+        :raises KeyError: if some of the ids are not in the index
+        """
+        rows, found = self._positions(keys)
+        if not found.all():
+            raise KeyError(np.asarray(keys)[~found][0])
+        return rows
+
+    def contains(self, keys):
+        """
+        :param keys: array of original node ids
+        :return: boolean mask of ids that have embeddings
+        """
+        return self._positions(keys)[1]
+
+    @property
+    def ind(self):
+        """
+        Dictionary from original node ids to rows, built on first access
+        """
+        if self._ind is None:
+            self._ind = dict(zip(self.ids.tolist(), self.rows.tolist()))
+        return self._ind
+
+    @property
+    def inv(self):
+        """
+        Dictionary from rows to original node ids, built on first access
+        """
+        if self._inv is None:
+            self._inv = dict(zip(self.rows.tolist(), self.ids.tolist()))
+        return self._inv
+
+    def __getstate__(self):
+        return {"e": self.e, "ids": self.ids, "rows": self.rows}
+
+    def __setstate__(self, state):
+        if "ind" in state:
+            # pickled before the index was stored in arrays
+            id_map = state["ind"]
+            ids = np.fromiter(id_map.keys(), dtype=np.int64, count=len(id_map))
+            rows = np.fromiter(id_map.values(), dtype=np.int64, count=len(id_map))
+        else:
+            ids, rows = state["ids"], state["rows"]
+        self._set_index(state["e"], ids, rows)
 
     def __getitem__(self, key):
-        # if not hasattr(self, "map_id"):
-        #     self.map_id = np.vectorize(lambda id: self.ind[id])
-        if type(key) == int:
-            return self.e[self.ind[key], :]
+        if isinstance(key, (int, np.integer)):
+            vectors = self.e[self.to_rows(np.array([key]))[0], :]
         elif type(key) == np.ndarray:
-            # return self.e[self.map_id(key), :]
-            return self.e[np.array([self.ind[k] for k in key], dtype=np.int32), :]
+            vectors = self.e[self.to_rows(key), :]
         else:
-            raise TypeError("Unknown type:", type(key))
\ No newline at end of file
+            raise TypeError("Unknown type:", type(key))
+        # layers can be stored in half precision, computations are done in single precision
+        return vectors.astype(np.float32) if vectors.dtype == np.float16 else vectors
+
+
+LAYER_FILE = re.compile(r"layer(\d+)\.npy")
+MANIFEST_FILE = "manifest.json"
+IDS_FILE = "ids.npy"
+
+
+def layer_path(path, layer):
+    """
+    Path of the file with embeddings of the given layer, written by write_layers of GNN models
+    """
+    return join(path, "layer{}.npy".format(layer))
+
+
+def resolve_layers(layers, num_layers):
+    """
+    Convert layer indices into sorted non-negative indices
+    :param layers: list of layer indices, negative indices count from the last layer. None selects all layers
+    :param num_layers: number of layers in the model
+    :return: sorted list of unique layer indices
+    """
+    if layers is None:
+        return list(range(num_layers))
+    resolved = set()
+    for layer in layers:
+        if not -num_layers <= layer < num_layers:
+            raise IndexError("Layer {} does not exist, the model has {} layers".format(layer, num_layers))
+        resolved.add(layer % num_layers)
+    return sorted(resolved)
+
+
+def count_layers(path):
+    """
+    Number of layers in the directory, determined by the last written layer
+    """
+    written = [int(match.group(1)) for match in map(LAYER_FILE.fullmatch, os.listdir(path)) if match is not None]
+    return max(written) + 1 if written else 0
+
+
+def load_embedders(path, id_map=None, layers=None, mmap=True):
+    """
+    Load embedding layers written by write_layers. Layers are memory-mapped by default, so only the rows that are
+    accessed are read from disk.
+    :param path: directory with layer files
+    :param id_map: dictionary that maps original node ids to rows of embedding tables (global graph ids), or a tuple
+        of arrays (ids, rows). None uses the ids written by export_embeddings
+    :param layers: indices of layers to load, negative indices count from the last written layer. None loads all
+        layers
+    :param mmap: whether to memory-map layer files
+    :return: list of Embedder
+    """
+    if id_map is None:
+        ids = np.load(join(path, IDS_FILE))
+        # rows without nodes have id -1
+        rows = np.flatnonzero(ids >= 0)
+        ids = ids[rows]
+    elif isinstance(id_map, dict):
+        ids = np.fromiter(id_map.keys(), dtype=np.int64, count=len(id_map))
+        rows = np.fromiter(id_map.values(), dtype=np.int64, count=len(id_map))
+    else:
+        ids, rows = id_map
+    return [
+        Embedder.from_arrays(ids, rows, np.load(layer_path(path, layer), mmap_mode="r" if mmap else None))
+        for layer in resolve_layers(layers, count_layers(path))
+    ]
+
+
+def ids_by_row(ids, rows, num_rows=None):
+    """
+    :return: array where element i is the original id of the node stored in row i, -1 for rows without nodes
+    """
+    ids, rows = np.asarray(ids, dtype=np.int64), np.asarray(rows, dtype=np.int64)
+    by_row = np.full(rows.max() + 1 if num_rows is None else num_rows, -1, dtype=np.int64)
+    by_row[rows] = ids
+    return by_row
+
+
+def convert_layer(file_path, dtype, chunk_size=1000000):
+    """
+    Convert the layer file into another dtype chunk by chunk, without loading it into memory
+    """
+    source = np.load(file_path, mmap_mode="r")
+    if source.dtype == dtype:
+        return
+    temp_path = file_path + ".tmp.npy"
+    target = np.lib.format.open_memmap(temp_path, mode="w+", dtype=dtype, shape=source.shape)
+    for start in range(0, source.shape[0], chunk_size):
+        target[start: start + chunk_size] = source[start: start + chunk_size]
+    target.flush()
+    del source, target
+    os.replace(temp_path, file_path)
+
+
+def export_embeddings(path, ids, dtype="float32"):
+    """
+    Complete the embeddings directory written by write_layers: store original node ids of rows in ids.npy, convert
+    layers into dtype and write manifest.json. Afterwards, the directory can be loaded without nodes.csv with
+    load_embedders(path).
+    :param path: directory with layer files
+    :param ids: array where element i is the original id of the node in row i, see ids_by_row
+    :param dtype: "float32" or "float16". Half precision halves the size, loaded embeddings are converted into
+        float32 on access
+    """
+    np.save(join(path, IDS_FILE), np.asarray(ids, dtype=np.int64))
+    layers = []
+    for layer in range(count_layers(path)):
+        if not isfile(layer_path(path, layer)):
+            continue
+        convert_layer(layer_path(path, layer), np.dtype(dtype))
+        shape = np.load(layer_path(path, layer), mmap_mode="r").shape
+        layers.append({"layer": layer, "file": os.path.basename(layer_path(path, layer)), "dim": shape[1],
+                       "dtype": dtype})
+    with open(join(path, MANIFEST_FILE), "w") as manifest:
+        json.dump({"ids": IDS_FILE, "num_rows": len(ids), "layers": layers}, manifest, indent=4)
+
+
+def convert_pickled_embedders(pickle_path, path, dtype="float32"):
+    """
+    Convert a list of Embedder pickled into embeddings.pkl into the embeddings directory format
+    :param pickle_path: path to embeddings.pkl
+    :param path: output directory
+    :param dtype: dtype of layer files
+    """
+    embedders = pickle.load(open(pickle_path, "rb"))
+    if not isdir(path):
+        os.mkdir(path)
+    for layer, embedder in enumerate(embedders):
+        np.save(layer_path(path, layer), np.asarray(embedder.e, dtype=dtype))
+    export_embeddings(path, ids_by_row(embedders[0].ids, embedders[0].rows, embedders[0].e.shape[0]), dtype=dtype)
+
+
+def load_model_embedders(model_path, layers=None, mmap=True):
+    """
+    Load embeddings of a trained model in any of the formats: embeddings directory with manifest, embeddings
+    directory with ids in nodes.csv, or embeddings.pkl of older models
+    :param model_path: directory of the trained model
+    :param layers: indices of layers to load, negative indices count from the last layer. None loads all layers
+    :return: list of Embedder
+    """
+    path = join(model_path, "embeddings")
+    if isfile(join(path, MANIFEST_FILE)):
+        return load_embedders(path, layers=layers, mmap=mmap)
+    elif isdir(path):
+        import pandas
+        nodes = pandas.read_csv(join(model_path, "nodes.csv"), usecols=['id', 'global_graph_id'])
+        return load_embedders(path, (nodes['id'].values, nodes['global_graph_id'].values), layers=layers, mmap=mmap)
+    embedders = pickle.load(open(join(model_path, "embeddings.pkl"), "rb"))
+    return [embedders[layer] for layer in resolve_layers(layers, len(embedders))]
+
+
+def share_embedder(embedder):
+    """
+    Describe Embedder so that other processes can attach its embeddings without copying them. Memory-mapped layers are
+    shared through their file, other arrays are copied into shared memory once.
+    :param embedder: Embedder
+    :return: picklable description for attach_embedder, and SharedMemory or None. Shared memory should stay open
+        while other processes use it, and be unlinked afterwards
+    """
+    e = embedder.e
+    description = {"ids": embedder.ids, "rows": embedder.rows, "shape": e.shape, "dtype": e.dtype.str}
+    if isinstance(e, np.memmap) and e.filename is not None and e.flags.c_contiguous:
+        description.update(file=e.filename, offset=e.offset)
+        return description, None
+
+    from multiprocessing import shared_memory
+    e = np.ascontiguousarray(e)
+    memory = shared_memory.SharedMemory(create=True, size=max(e.nbytes, 1))
+    np.ndarray(e.shape, dtype=e.dtype, buffer=memory.buf)[...] = e
+    description["shared_memory"] = memory.name
+    return description, memory
+
+
+def attach_embedder(description):
+    """
+    Create Embedder over embeddings shared with share_embedder
+    :return: Embedder and SharedMemory or None. Shared memory should stay open while the embedder is used
+    """
+    if "file" in description:
+        e = np.memmap(description["file"], dtype=description["dtype"], mode="r", offset=description["offset"],
+                      shape=description["shape"])
+        memory = None
+    else:
+        from multiprocessing import shared_memory
+        memory = shared_memory.SharedMemory(name=description["shared_memory"])
+        e = np.ndarray(description["shape"], dtype=description["dtype"], buffer=memory.buf)
+    return Embedder.from_arrays(description["ids"], description["rows"], e), memory
+
+
+def remove_layer(path, layer):
+    file_path = layer_path(path, layer)
+    if isfile(file_path):
+        os.remove(file_path)
@@ -0,0 +1,241 @@
+import json
+import os
+from os.path import join
+
+import numpy as np
+
+METRICS = {"ip", "cosine"}
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """
+    Select k largest scores in every row
+    :param scores: 2d array
+    :return: columns of the top k scores sorted in decreasing order of scores
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        columns = np.tile(np.arange(k), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, columns, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(columns, order, axis=1)
+
+
+def brute_force_search(vectors, queries, k=10, metric="ip", ids=None, chunk_size=1024):
+    """
+    Exact search by scoring queries against all vectors. Used as the reference for IVFIndex.
+    :param vectors: array with indexed vectors, shape (num_vectors, dim)
+    :param queries: array with queries, shape (num_queries, dim)
+    :param k: number of neighbors
+    :param metric: "ip" for inner product, "cosine" for cosine similarity
+    :param ids: ids of vectors that are returned instead of row indices
+    :param chunk_size: number of vectors that are scored at once
+    :return: scores and ids of neighbors, both of shape (num_queries, k), sorted by decreasing score
+    """
+    if metric not in METRICS:
+        raise ValueError("Unknown metric:", metric)
+    queries = np.asarray(queries, dtype=np.float32)
+    if metric == "cosine":
+        queries = normalize_rows(queries)
+
+    k = min(k, vectors.shape[0])
+    best_scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+    best_rows = np.zeros((queries.shape[0], k), dtype=np.int64)
+    for start in range(0, vectors.shape[0], chunk_size):
+        chunk = np.asarray(vectors[start: start + chunk_size], dtype=np.float32)
+        if metric == "cosine":
+            chunk = normalize_rows(chunk)
+        scores = np.hstack([best_scores, queries @ chunk.T])
+        rows = np.hstack([best_rows, np.broadcast_to(np.arange(start, start + chunk.shape[0]), scores[:, k:].shape)])
+        columns = top_k(scores, k)
+        best_scores = np.take_along_axis(scores, columns, axis=1)
+        best_rows = np.take_along_axis(rows, columns, axis=1)
+
+    return best_scores, best_rows if ids is None else np.asarray(ids)[best_rows]
+
+
+def kmeans(vectors, n_clusters, n_iter=10, seed=42):
+    """
+    Lloyd's k-means where points are assigned to the centroid with the largest inner product with the point
+    (spherical k-means for normalized vectors)
+    :return: centroids, shape (n_clusters, dim)
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(vectors.shape[0], n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = assign_lists(centroids, vectors)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        non_empty = counts > 0
+        # vectors of a cluster are summed as a contiguous segment of vectors sorted by cluster
+        order = np.argsort(assignment, kind="stable")
+        starts = np.cumsum(counts)[non_empty] - counts[non_empty]
+        centroids[non_empty] = np.add.reduceat(vectors[order], starts, axis=0) / counts[non_empty, None]
+        # empty clusters are restarted from random points
+        centroids[~non_empty] = vectors[rng.choice(vectors.shape[0], (~non_empty).sum())]
+    return centroids
+
+
+def assign_lists(centroids, vectors, chunk_size=65536):
+    """
+    Assign every vector to the list of the centroid with the largest inner product
+    """
+    return np.concatenate([
+        np.argmax(vectors[start: start + chunk_size] @ centroids.T, axis=1)
+        for start in range(0, vectors.shape[0], chunk_size)
+    ]) if vectors.shape[0] > 0 else np.zeros(0, dtype=np.int64)
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate nearest neighbor search over node embeddings. Vectors are clustered with
+    k-means, vectors of every cluster (inverted list) are stored contiguously. A query is scored only against the
+    lists of its nprobe closest centroids. Queries are processed in batches: all queries that probe the same list are
+    scored with one matrix multiplication.
+
+    The index is saved as .npy files and memory-mapped when loaded, so only the probed lists are read from disk.
+
+        index = IVFIndex.from_embedder(embedder, metric="cosine")
+        index.save("index")
+        index = IVFIndex.load("index")
+        scores, ids = index.search(embedder[query_ids], k=10, nprobe=8)
+    """
+    def __init__(self, centroids, vectors, ids, offsets, metric="ip"):
+        """
+
+        :param centroids: centroids of lists, shape (n_lists, dim)
+        :param vectors: indexed vectors ordered by list, vectors of list i are vectors[offsets[i]: offsets[i + 1]].
+            Normalized for cosine metric
+        :param ids: ids of vectors, in the same order
+        :param offsets: array of size n_lists + 1
+        :param metric: "ip" for inner product, "cosine" for cosine similarity
+        """
+        if metric not in METRICS:
+            raise ValueError("Unknown metric:", metric)
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.metric = metric
+
+    @classmethod
+    def build(cls, vectors, ids=None, n_lists=None, metric="ip", n_iter=10, train_size=100000, seed=42):
+        """
+        :param vectors: array with vectors, shape (num_vectors, dim), e.g. Embedder.e or in/out matrix of word2vec
+        :param ids: ids that are returned by search, row indices by default
+        :param n_lists: number of inverted lists, 4 * sqrt(num_vectors) by default
+        :param metric: "ip" for inner product, "cosine" for cosine similarity
+        :param n_iter: number of k-means iterations
+        :param train_size: number of vectors that are sampled for k-means
+        :param seed: random seed
+        """
+        if metric not in METRICS:
+            raise ValueError("Unknown metric:", metric)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if metric == "cosine":
+            vectors = normalize_rows(vectors)
+        ids = np.arange(vectors.shape[0]) if ids is None else np.asarray(ids, dtype=np.int64)
+        rng = np.random.default_rng(seed)
+        train = vectors[rng.choice(vectors.shape[0], min(train_size, vectors.shape[0]), replace=False)]
+
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(vectors.shape[0]))
+        n_lists = max(1, min(n_lists, train.shape[0]))
+        centroids = kmeans(train, n_lists, n_iter=n_iter, seed=seed)
+
+        assignment = assign_lists(centroids, vectors)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=offsets[1:])
+        return cls(centroids, vectors[order], ids[order], offsets, metric=metric)
+
+    @classmethod
+    def from_embedder(cls, embedder, **kwargs):
+        """
+        Index all nodes of Embedder, search returns original node ids
+        :param kwargs: arguments of build
+        """
+        return cls.build(embedder.e[embedder.rows], ids=embedder.ids, **kwargs)
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def search(self, queries, k=10, nprobe=8):
+        """
+        :param queries: array with queries, shape (num_queries, dim)
+        :param k: number of neighbors
+        :param nprobe: number of lists that are scored for every query
+        :return: scores and ids of neighbors, both of shape (num_queries, k), sorted by decreasing score. If the
+            probed lists contain fewer than k vectors, missing neighbors have score -inf and id -1
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries.reshape(1, -1)
+        if self.metric == "cosine":
+            queries = normalize_rows(queries)
+
+        n_lists = self.centroids.shape[0]
+        nprobe = min(nprobe, n_lists)
+        probes = top_k(queries @ self.centroids.T, nprobe)
+
+        # every probe of a query contributes its top k candidates into its own slot
+        candidate_scores = np.full((queries.shape[0], nprobe * k), -np.inf, dtype=np.float32)
+        candidate_ids = np.full((queries.shape[0], nprobe * k), -1, dtype=np.int64)
+
+        flat_probes = probes.ravel()
+        order = np.argsort(flat_probes, kind="stable")
+        bounds = np.searchsorted(flat_probes[order], np.arange(n_lists + 1))
+        for list_ind in np.flatnonzero(bounds[1:] > bounds[:-1]):
+            start, end = self.offsets[list_ind], self.offsets[list_ind + 1]
+            if start == end:
+                continue
+            query_ind, slot = np.divmod(order[bounds[list_ind]: bounds[list_ind + 1]], nprobe)
+            scores = queries[query_ind] @ np.asarray(self.vectors[start: end]).T
+            columns = top_k(scores, k)
+            target = slot[:, None] * k + np.arange(columns.shape[1])
+            candidate_scores[query_ind[:, None], target] = np.take_along_axis(scores, columns, axis=1)
+            candidate_ids[query_ind[:, None], target] = self.ids[start + columns]
+
+        columns = top_k(candidate_scores, k)
+        return np.take_along_axis(candidate_scores, columns, axis=1), np.take_along_axis(candidate_ids, columns, axis=1)
+
+    def save(self, path):
+        """
+        Write the index into the directory
+        """
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        np.save(join(path, "centroids.npy"), self.centroids)
+        np.save(join(path, "vectors.npy"), self.vectors)
+        np.save(join(path, "ids.npy"), self.ids)
+        np.save(join(path, "offsets.npy"), self.offsets)
+        with open(join(path, "index.json"), "w") as meta:
+            json.dump({"type": "ivf", "metric": self.metric, "size": len(self), "dim": self.vectors.shape[1],
+                       "n_lists": self.centroids.shape[0]}, meta)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load the index written by save. Vectors and ids are memory-mapped by default
+        """
+        with open(join(path, "index.json")) as meta:
+            metric = json.load(meta)["metric"]
+        mmap_mode = "r" if mmap else None
+        return cls(np.load(join(path, "centroids.npy")),
+                   np.load(join(path, "vectors.npy"), mmap_mode=mmap_mode),
+                   np.load(join(path, "ids.npy"), mmap_mode=mmap_mode),
+                   np.load(join(path, "offsets.npy")), metric=metric)
+
+
+def recall(found_ids, true_ids):
+    """
+    Fraction of true neighbors that are found, averaged over queries
+    """
+    hits = [np.intersect1d(found, true).size for found, true in zip(found_ids, true_ids)]
+    return float(np.sum(hits) / true_ids.size) if true_ids.size > 0 else 0.
@@ -0,0 +1,140 @@
+import numpy as np
+
+# number of rows that are gathered at once, batches are assembled in a buffer of this size
+DEFAULT_BLOCK_ROWS = 65536
+
+
+def sample_counts(n, size, whole=False):
+    """
+    Number of samples in every batch of an epoch
+    :param n: number of samples
+    :param size: batch size
+    :param whole: put all samples into one batch
+    :return: array of batch sizes
+    """
+    if whole or n <= size:
+        return np.array([n], dtype=np.int64)
+    counts = np.full(n // size, size, dtype=np.int64)
+    return np.append(counts, n % size) if n % size > 0 else counts
+
+
+def epoch_order(n, size, whole=False):
+    """
+    Random order of samples for one epoch with n // size + 1 batches of size distinct samples. Every sample is used
+    once, the last batch is completed with random samples that are not in it yet.
+    :param n: number of samples
+    :param size: batch size
+    :param whole: put all samples into one batch
+    :return: positions of samples in the order of batches, and the number of samples in every batch
+    """
+    order = np.random.permutation(n)
+    if whole:
+        return order, np.array([n], dtype=np.int64)
+    remainder = n % size
+    fill = order[np.random.choice(n - remainder, size - remainder, replace=False)]
+    return np.concatenate([order, fill]), np.full(n // size + 1, size, dtype=np.int64)
+
+
+def epoch_layout(counts, K):
+    """
+    Rows of an epoch are laid out batch by batch, positives of a batch are followed by K negatives per positive
+    :param counts: number of positives in every batch
+    :param K: negative oversampling factor
+    :return: bounds - batch i takes rows bounds[i]: bounds[i + 1], is_positive - mask of positive rows
+    """
+    bounds = np.zeros(counts.size + 1, dtype=np.int64)
+    np.cumsum(counts * (1 + K), out=bounds[1:])
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    is_positive = np.zeros(bounds[-1], dtype=np.bool_)
+    is_positive[np.repeat(bounds[:-1], counts) + within] = True
+    return bounds, is_positive
+
+
+def interleave(positive, negative, is_positive):
+    """
+    Merge values of positive and negative rows into one array with the layout of epoch_layout
+    """
+    merged = np.empty(is_positive.size, dtype=np.result_type(positive, negative))
+    merged[is_positive] = positive
+    merged[~is_positive] = negative
+    return merged
+
+
+def negative_sources(counts, K):
+    """
+    Draw K sources for negatives of every positive, uniformly from positives of the same batch
+    :param counts: number of positives in every batch
+    :return: positions of positives in the epoch, in the order of negative rows
+    """
+    starts = np.cumsum(counts) - counts
+    batch = np.repeat(np.arange(counts.size), counts * K)
+    return starts[batch] + (np.random.random(batch.size) * counts[batch]).astype(np.int64)
+
+
+class EpochBatcher:
+    """
+    Assembles batches of an epoch from tables of embeddings that were looked up once. Rows of all batches are
+    described with positions into the tables, computed for the whole epoch with a few vectorized calls. Embeddings
+    are gathered in blocks of several batches into a preallocated buffer, and batches are yielded as slices of the
+    buffer. A batch is valid until the next batch is requested, consumers that keep batches should copy them.
+
+        batcher = EpochBatcher()
+        for batch in batcher.batches([src_embeddings, dst_embeddings], [src_positions, dst_positions], bounds, y=y):
+            train_step(batch)
+    """
+    def __init__(self, block_rows=DEFAULT_BLOCK_ROWS):
+        """
+
+        :param block_rows: number of rows that are gathered at once. Blocks always contain at least one batch
+        """
+        self.block_rows = block_rows
+        self.buffer = None
+
+    def get_buffer(self, rows, width, dtype):
+        if self.buffer is None or self.buffer.shape[0] < rows or self.buffer.shape[1] != width or \
+                self.buffer.dtype != dtype:
+            self.buffer = np.empty((rows, width), dtype=dtype)
+        return self.buffer
+
+    def batches(self, tables, positions, bounds, **columns):
+        """
+        :param tables: list of 2d arrays, rows of x are concatenations of rows of these tables
+        :param positions: list with an array for every table, with the row of the table for every row of the epoch.
+            None when rows of the table are rows of the epoch. Batches of a single such table are its slices
+        :param bounds: batch i consists of rows bounds[i]: bounds[i + 1] of the epoch
+        :param columns: arrays with one entry for every row of the epoch, e.g. labels. Batches contain their slices
+            under the same names
+        :return: generator of dictionaries with "x" and columns
+        """
+        if len(tables) == 1 and positions[0] is None:
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                out = {"x": tables[0][start: end]}
+                out.update({name: values[start: end] for name, values in columns.items()})
+                yield out
+            return
+
+        width = sum(table.shape[1] for table in tables)
+        n_batches = bounds.size - 1
+        largest = int(np.max(bounds[1:] - bounds[:-1])) if n_batches > 0 else 0
+        buffer = self.get_buffer(max(self.block_rows, largest), width, np.result_type(*tables))
+
+        batch = 0
+        while batch < n_batches:
+            block_start = bounds[batch]
+            # all batches that fit into the buffer are gathered together
+            block_last = max(batch + 1, np.searchsorted(bounds, block_start + buffer.shape[0], side="right") - 1)
+            block_end = bounds[block_last]
+
+            column = 0
+            for table, table_positions in zip(tables, positions):
+                buffer[:block_end - block_start, column: column + table.shape[1]] = \
+                    table[block_start: block_end] if table_positions is None else \
+                    table[table_positions[block_start: block_end]]
+                column += table.shape[1]
+
+            for ind in range(batch, block_last):
+                start, end = bounds[ind], bounds[ind + 1]
+                out = {"x": buffer[start - block_start: end - block_start]}
+                out.update({name: values[start: end] for name, values in columns.items()})
+                yield out
+            batch = block_last
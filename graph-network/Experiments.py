@@ -6,17 +6,31 @@ from sklearn.model_selection import train_test_split
 import numpy as np
 
 # from graphtools import Embedder
-from Embedder import Embedder
+from Embedder import Embedder, load_model_embedders
+from DatasetCache import DatasetCache, load_table, save_table
+from AliasSampler import AliasSampler
+from EpochBatcher import EpochBatcher, epoch_layout, epoch_order, interleave, negative_sources, sample_counts
 import pickle
 import random as rnd
 import torch
 import os
+import json
+import shutil
+import tempfile
+
+
+# subdirectory of the model directory with cached target tables
+TARGET_CACHE_DIR = "experiment_cache"
 
 
 def keep_from_set(table, pool):
-    table['src'] = table['src'].apply(lambda nid: nid if nid in pool else None)
-    table['dst'] = table['dst'].apply(lambda nid: nid if nid in pool else None)
-    return table.dropna(axis=0)
+    """
+    Keep rows where both src and dst are in pool
+    :param pool: array or set of node ids
+    """
+    if isinstance(pool, (set, frozenset)):
+        pool = np.fromiter(pool, dtype=np.int64)
+    return table[table['src'].isin(pool) & table['dst'].isin(pool)].dropna(axis=0)
 
 
 class Experiments:
@@ -35,7 +49,9 @@ class Experiments:
                  node_type_path=None,
                  variable_use_path=None,
                  function_name_path=None,
-                 gnn_layer=-1):
+                 gnn_layer=-1,
+                 cache_targets=False,
+                 embedder=None):
         """
 
         :param base_path: path tp trained gnn model
@@ -45,6 +61,10 @@ class Experiments:
         :param variable_use_path: path to variable use edges
         :param function_name_path: path to function name edges
         :param gnn_layer: which gnn layer is used for node embeddings
+        :param cache_targets: store filtered target tables in the model directory, so that later runs do not read and
+            filter the source files again
+        :param embedder: Embedder that is used instead of loading gnn_layer from the model directory, e.g. embeddings
+            shared between processes
         """
 
         self.experiments = {
@@ -56,13 +76,22 @@ class Experiments:
         }
 
         self.base_path = base_path
+        self.cache_targets = cache_targets
+
+        # model files are read once and shared by all experiments
+        self._nodes = None
+        self._held = None
+        self._targets = {}
 
         # TODO
         # load splits for state dict and use them for training
         self.splits = torch.load(os.path.join(self.base_path, "state_dict.pt"))["splits"]
 
-        if base_path is not None:
-            self.embed = pickle.load(open(join(self.base_path, "embeddings.pkl"), "rb"))[gnn_layer]
+        if embedder is not None:
+            self.embed = embedder
+        elif base_path is not None:
+            # only the requested layer is loaded, and it is memory-mapped unless the model has only embeddings.pkl
+            self.embed = load_model_embedders(self.base_path, [gnn_layer])[0]
             # alternative_nodes = pickle.load(open("nodes.pkl", "rb"))
             # self.embed.e = alternative_nodes
             # self.embed.e = np.random.randn(self.embed.e.shape[0], self.embed.e.shape[1])
@@ -81,117 +110,164 @@ class Experiments:
         :param keys: iterable with original node ids (as opposed to compacted graph node ids)
         :return: ids that have gnn embeddings
         """
-        return np.fromiter(filter(lambda id: id in self.embed.ind, keys), dtype=np.int32)
+        keys = np.fromiter(keys, dtype=np.int64)
+        return keys[self.embed.contains(keys)].astype(np.int32)
         # return np.fromiter((key for key in keys if key in self.embed.ind), dtype=np.int32)
 
 
-    def __getitem__(self, type: str):
+    @property
+    def nodes(self):
         """
-        Return object that allows creating batches for the choosen experiment. Several experiments available
-        link - experiment that tries to predict function call edges based on heldout set
-        apicall - experiment that tries to predict which function is called after the current function
-        typeuse - experimen that tries to predict typeuse edges based on heldout set
-        varuse - experiment that tries to predict which variable names are used in the current function
-        fname - experiment that tries to predict the name of a function. valid only for function nodes. information is extracted from training data
-        :param type: str description of the experiment
-        :return: Experiment object
+        Nodes of the model, read from nodes.csv on first access
         """
-        nodes = pandas.read_csv(join(self.base_path, "nodes.csv"))
-        edges = pandas.read_csv(join(self.base_path, "held.csv"))
-        if type == "link":
-            # nodes = pandas.read_csv(join(self.base_path, "nodes.csv"))
-            held = pandas.read_csv(join(self.base_path, "held.csv"))
-
-            held = held.query('type == 8')[['src', 'dst']]
+        if self._nodes is None:
+            self._nodes = pandas.read_csv(join(self.base_path, "nodes.csv"))
+        return self._nodes
 
-            # node_pool = set(self.splits[2])
-            # held = keep_from_set(held, node_pool)
-
-            return Experiment(self.embed, nodes, edges, held, split_on="nodes", neg_sampling_strategy="word2vec", compact_dst=False)
+    @property
+    def held(self):
+        """
+        Heldout edges of the model, read from held.csv on first access
+        """
+        if self._held is None:
+            self._held = pandas.read_csv(join(self.base_path, "held.csv"))
+        return self._held
 
-        elif type == "apicall":
-            api_seq = pandas.read_csv(self.experiments['apicall'])
+    def target_cache_path(self, type):
+        """
+        Directory for the cached target table of the experiment. The name includes the hash of the model files and
+        the experiment source file, so that changing any of them invalidates the entry.
+        """
+        source = self.experiments.get(type)
+        key = DatasetCache.make_key(
+            join(self.base_path, "nodes.csv"), join(self.base_path, "held.csv"),
+            experiment=type, splits=os.path.getmtime(join(self.base_path, "state_dict.pt")),
+            source=[os.path.abspath(source), os.path.getsize(source), os.path.getmtime(source)]
+            if source is not None and os.path.isfile(source) else None
+        )
+        return join(self.base_path, TARGET_CACHE_DIR, "{}-{}".format(type, key))
+
+    def target_table(self, type):
+        """
+        Filtered target table of the experiment. The table is computed once and kept in memory. When cache_targets is
+        set, the table is also stored in the model directory and loaded from there by later runs.
+        :param type: str description of the experiment
+        :return: DataFrame with src and dst columns. Shared between calls, should not be modified
+        """
+        if type in self._targets:
+            return self._targets[type]
 
-            # unique_nodes = set(nodes['id'].values.tolist())
+        cache_path = self.target_cache_path(type) if self.cache_targets else None
+        table = self.load_cached_target(cache_path) if cache_path is not None else None
+        if table is None:
+            table = self.make_target_table(type)
+            if cache_path is not None:
+                table = self.save_cached_target(table, cache_path)
 
-            # api_seq_test = api_seq.copy()
-            # api_seq_test['src'] = api_seq_test['src'].apply(lambda nid: nid if nid in unique_nodes else None)
-            # api_seq_test['dst'] = api_seq_test['dst'].apply(lambda nid: nid if nid in unique_nodes else None)
-            # api_seq_test.dropna(axis=0, inplace=True)
+        self._targets[type] = table
+        return table
 
-            # disabled for testing
-            # api_seq = api_seq[
-            #     api_seq['src'].apply(lambda nid: nid in unique_nodes)
-            # ]
-            #
-            # api_seq = api_seq[
-            #     api_seq['dst'].apply(lambda nid: nid in unique_nodes)
-            # ]
+    @staticmethod
+    def load_cached_target(cache_path):
+        """
+        :return: target table stored by save_cached_target, None if the entry does not exist
+        """
+        if not os.path.isfile(join(cache_path, "columns.json")):
+            return None
+        with open(join(cache_path, "columns.json")) as columns_file:
+            columns = json.load(columns_file)
+        return load_table(join(cache_path, "table"), columns, mmap=False)
+
+    @staticmethod
+    def save_cached_target(table, cache_path):
+        """
+        Store the target table. The entry is written into a temporary directory of its own and renamed when complete,
+        because workers of the experiment suite can compute the same table at the same time. If another writer has
+        created the entry first, the entry of that writer is used.
+        :return: the stored table
+        """
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=os.path.basename(cache_path) + ".", suffix=".tmp", dir=cache_dir)
+        try:
+            columns = save_table(table, join(tmp_path, "table"))
+            with open(join(tmp_path, "columns.json"), "w") as columns_file:
+                json.dump(columns, columns_file)
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            existing = Experiments.load_cached_target(cache_path)
+            if existing is None:
+                raise
+            return existing
+        return table
+
+    def make_target_table(self, type):
+        """
+        Read and filter target table of the experiment. Filtering by the node pool uses vectorized lookups.
+        :param type: str description of the experiment
+        :return: DataFrame with src and dst columns, without duplicate pairs
+        """
+        node_pool = np.asarray(self.splits[2])
 
-            node_pool = set(self.splits[2])
-            api_seq = keep_from_set(api_seq, node_pool)
+        if type == "link":
+            target = self.held.query('type == 8')[['src', 'dst']]
+            # target = keep_from_set(target, node_pool)
 
-            return Experiment(self.embed, nodes, edges, api_seq, split_on="nodes", neg_sampling_strategy="word2vec", compact_dst=False)
+        elif type == "apicall":
+            target = keep_from_set(pandas.read_csv(self.experiments['apicall']), node_pool)[['src', 'dst']]
 
         elif type == "typeuse":
-            held = pandas.read_csv(join(self.base_path, "held.csv"))
-
-            held = held.query('type == 2')[['src', 'dst']]
-
-            # node_pool = set(self.splits[2])
-            # held = keep_from_set(held, node_pool)
-
-            return Experiment(self.embed, nodes, edges, held, split_on="nodes", neg_sampling_strategy="word2vec", compact_dst=False)
+            target = self.held.query('type == 2')[['src', 'dst']]
+            # target = keep_from_set(target, node_pool)
 
         elif type == "varuse":
             var_use = pandas.read_csv(self.experiments['varuse'])
-
-            # unique_nodes = set(nodes['id'].values.tolist())
-            node_pool = set(self.splits[2])
-
-            var_use = var_use[
-                var_use['src'].apply(lambda nid: nid in node_pool)
-            ]
-
-            return Experiment2(self.embed, nodes, edges, var_use, split_on="nodes", neg_sampling_strategy="word2vec")
+            target = var_use[var_use['src'].isin(node_pool)][['src', 'dst']]
 
         elif type == "fname":
-
             # fname = pandas.read_csv(self.experiments['fname'])
-            functions = nodes.query('label == 4096')
-            functions['fname'] = functions['name'].apply(lambda name: name.split(".")[-1])
-
-            functions['src'] = functions['id']
-            functions['dst'] = functions['fname']
-
-            # unique_nodes = set(nodes['id'].values.tolist())
-            node_pool = set(self.splits[2])
-
-            functions = functions[
-                functions['src'].apply(lambda nid: nid in node_pool)
-            ]
-
-            # use edge splits when outgoing degree is 1
-
-            return Experiment2(self.embed, nodes, edges, functions[['src', 'dst']], split_on="edges", neg_sampling_strategy="word2vec")
+            functions = self.nodes.query('label == 4096')
+            functions = functions[functions['id'].isin(node_pool)]
+            target = pandas.DataFrame({
+                'src': functions['id'],
+                'dst': functions['name'].str.rsplit(".", n=1).str[-1]
+            })
 
         elif type == "nodetype":
+            types = self.nodes[self.nodes['id'].isin(node_pool)].dropna(axis=0)
+            target = pandas.DataFrame({'src': types['id'], 'dst': types['label']})
 
-            types = nodes.copy()
-            types['src'] = nodes['id']
-            types['dst'] = nodes['label']
-
-            print("WARNING: Make sure that you target label is stored in the field: label")
-            # raise Warning("Make sure that you target label is stored in the field: label")
+        else:
+            raise ValueError(f"Unknown experiment: {type}. The following experiments are available: [apicall|link|typeuse|varuse|fname|nodetype].")
 
-            node_pool = set(self.splits[2])
+        return target.drop_duplicates(['src', 'dst'], ignore_index=True)
 
-            types['src'] = types['src'].apply(lambda nid: nid if nid in node_pool else None)
-            types = types.dropna(axis=0)
+    def __getitem__(self, type: str):
+        """
+        Return object that allows creating batches for the choosen experiment. Several experiments available
+        link - experiment that tries to predict function call edges based on heldout set
+        apicall - experiment that tries to predict which function is called after the current function
+        typeuse - experimen that tries to predict typeuse edges based on heldout set
+        varuse - experiment that tries to predict which variable names are used in the current function
+        fname - experiment that tries to predict the name of a function. valid only for function nodes. information is extracted from training data
+        :param type: str description of the experiment
+        :return: Experiment object
+        """
+        # experiments modify their target tables, cached tables are copied
+        target = self.target_table(type).copy()
 
-            return Experiment3(self.embed, nodes, edges, types[['src', 'dst']], split_on="edges", neg_sampling_strategy="word2vec")
+        if type in {"link", "apicall", "typeuse"}:
+            return Experiment(self.embed, self.nodes, self.held, target, split_on="nodes", neg_sampling_strategy="word2vec", compact_dst=False)
+        elif type == "varuse":
+            return Experiment2(self.embed, self.nodes, self.held, target, split_on="nodes", neg_sampling_strategy="word2vec")
+        elif type == "fname":
+            # use edge splits when outgoing degree is 1
+            return Experiment2(self.embed, self.nodes, self.held, target, split_on="edges", neg_sampling_strategy="word2vec")
         else:
-            raise ValueError(f"Unknown experiment: {type}. The following experiments are available: [apicall|link|typeuse|varuse|fname|nodetype].")
+            print("WARNING: Make sure that you target label is stored in the field: label")
+            # raise Warning("Make sure that you target label is stored in the field: label")
+            return Experiment3(self.embed, self.nodes, self.held, target, split_on="edges", neg_sampling_strategy="word2vec")
 
 
 class Experiment:
@@ -215,6 +291,15 @@ class Experiment:
         self.neg_smpl_strategy = neg_sampling_strategy
         self.K = K
         self.TEST_FRAC = test_frac
+        self.compact_dst = compact_dst
+        # batches are assembled for the whole epoch from embeddings that are looked up once
+        self.batcher = EpochBatcher()
+        self._node_ids = None
+        self._node_embeddings = None
+        self._element_positions = None
+        self._element_sampler = None
+        self._edge_sets = {}
+        self._per_array = {}
 
         # make sure to drop duplicate edges to prevent leakage into the test set
         # do it before creating experiment?
@@ -259,11 +344,8 @@ class Experiment:
         :return: np array of dst nodes (as given in self.target table)
         """
         if strategy == "word2vec":
-            counts = self.target['dst'].value_counts(normalize=True)
-            freq = counts.values ** unigram_power
-            self.freq = freq / sum(freq)
-            self.dst_idxs = counts.index
-            self.dst_neg_sampling = lambda size: np.random.choice(self.dst_idxs, size, replace=True, p=self.freq)
+            self.dst_neg_sampler = AliasSampler.from_occurrences(self.target['dst'].values, power=unigram_power)
+            self.dst_neg_sampling = self.dst_neg_sampler.sample
         elif strategy == "uniform":
             self.dst_neg_sampling = lambda size: np.random.choice(self.unique_dst, size, replace=True)
 
@@ -284,6 +366,24 @@ class Experiment:
     #     """
     #     return np.random.randint(low=0, high=set_size, size=num)
 
+    def rank_test_nodes(self, **kwargs):
+        """
+        Rank true targets of every test node among all targets of the experiment by dot product of node embeddings.
+        Available for experiments where targets are nodes (link, apicall, typeuse), and does not require training
+        a classifier.
+        :param kwargs: arguments of RankingEvaluator.rank_targets, e.g. threads
+        :return: dictionary with mrr, hits@k and the number of ranked targets
+        """
+        if self.split_on != "nodes" or self.compact_dst:
+            raise ValueError("Ranking requires targets that are nodes and split on nodes")
+        from RankingEvaluator import element_queries, evaluate_ranking
+
+        candidate_ids = np.unique(self.ee.indices)
+        indptr, targets = element_queries(self.ee, self.test_nodes, candidate_ids)
+        return evaluate_ranking(np.asarray(self.embed[self.test_nodes], dtype=np.float32),
+                                np.asarray(self.embed[candidate_ids], dtype=np.float32),
+                                indptr, targets, **kwargs)
+
     def get_negative_edges(self, src_set, dst_set, num):
         """
         Sample negative edges.
@@ -382,12 +482,12 @@ class Experiment:
 
     def batch_edges(self, X, size=128, K=15):
         """
-        Generate batch
+        Generate batches of one epoch
         :param X: input edge list in 2d numpy array
-        :param y: labels
         :param size: number of positive samples in the batch
         :param K: negative oversampling factor
-        :return: dictionary ready to be fed to classifier model
+        :return: generator of dictionaries ready to be fed to classifier model. Batches are slices of a buffer
+            that is reused, see EpochBatcher
         """
 
         # def encode_binary(y):
@@ -409,31 +509,16 @@ class Experiment:
         # y_b = y[X.shape[0] // size * size:]
         # yield {"x": X_b, "y": y_b}
 
-        for i in range(0, X.shape[0], size):
-            if i + size >= X.shape[0]: continue
-
-            neg = self.get_negative_edges(X[i: i + size, 0], self.unique_dst, size * K)
-            # neg = self.get_negative_edges(self.unique_src, self.unique_dst, size * K)
-            X_b = np.vstack([X[i: i+size], neg])
-
-            X_b_e = self._embed(X_b)
-            y_b = np.concatenate([np.ones(size,), np.zeros(size * K,)])
-
-            assert np.average(y_b) == 1/(1+K)
-            assert y_b.shape[0] == X_b.shape[0] == size * (1 + K)
-
-            yield {"x": X_b_e, "y": y_b}
+        # negative sources are drawn from sources of the same batch, negative targets from the unigram distribution
+        counts = sample_counts(X.shape[0], size)
+        bounds, is_positive = epoch_layout(counts, K)
+        src = self.per_array(X, "src", lambda X: self.node_positions(X[:, 0]))
+        src = interleave(src, src[negative_sources(counts, K)], is_positive)
+        dst = interleave(self.per_array(X, "dst", lambda X: self.node_positions(X[:, 1])),
+                         self.node_positions(self.dst_neg_sampling(X.shape[0] * K)), is_positive)
 
-        last_piece = X[X.shape[0] // size * size:, :]
-        neg = self.get_negative_edges(last_piece[:, 0], self.unique_dst, last_piece.shape[0] * K)
-        # neg = self.get_negative_edges(self.unique_src, self.unique_dst, last_piece.shape[0] * K)
-        X_b = np.vstack([last_piece, neg])
-        y_b = np.concatenate([np.ones(last_piece.shape[0], ), np.zeros(last_piece.shape[0] * K, )])
-
-        assert np.average(y_b) == 1 / (1 + K)
-        assert y_b.shape[0] == X_b.shape[0] == last_piece.shape[0] * (1 + K)
-
-        yield {"x": self._embed(X_b), "y": y_b}
+        _, embeddings = self.node_embeddings()
+        return self.batcher.batches([embeddings, embeddings], [src, dst], bounds, y=is_positive.astype(np.float64))
 
     def test_batches(self):
         # if self.X_test is None:
@@ -441,7 +526,7 @@ class Experiment:
         if self.split_on == "nodes":
             return self.batch_nodes(self.test_nodes, K=1, test=True)
         elif self.split_on == "edges":
-            return self.batch_edges(self.target.iloc[self.test_edge_ind][['src', 'dst']].values, K=1)
+            return self.batch_edges(self.edge_set("test"), K=1)
 
     def train_batches(self):
         # if self.X_train is None:
@@ -449,41 +534,94 @@ class Experiment:
         if self.split_on == "nodes":
             return self.batch_nodes(self.train_nodes, K=1)
         elif self.split_on == "edges":
-            return self.batch_edges(self.target.iloc[self.train_edge_ind][['src', 'dst']].values, K=1)
+            return self.batch_edges(self.edge_set("train"), K=1)
 
 
     def batch_nodes(self, indices, size=128, K=15, test=False):
-
+        """
+        Generate batches of one epoch. Every node is paired with one of its targets and with K negative targets.
+        :param indices: nodes
+        :param size: number of positive samples in the batch
+        :param K: negative oversampling factor
+        :param test: put all nodes into one batch
+        :return: generator of dictionaries ready to be fed to classifier model
+        """
         if not test and indices.shape[0] < size:
             raise ValueError("The amount of training data is too small")
 
-        if test:
-            n_batches = 1
-            sample_size = indices.shape[0]
-        else:
-            n_batches = indices.shape[0] // size + 1
-            sample_size = size
+        order, counts = epoch_order(indices.shape[0], size, whole=test)
+        bounds, is_positive = epoch_layout(counts, K)
+        src = self.per_array(indices, "src", self.node_positions)[order]
+        src = interleave(src, np.repeat(src, K), is_positive)
+
+        element_positions, element_sampler = self.element_positions()
+        rows = self.per_array(indices, "rows", self.ee.key_rows)[order]
+        dst = interleave(element_positions[self.ee.sample_positions(rows)], element_sampler.sample(order.size * K),
+                         is_positive)
+
+        _, embeddings = self.node_embeddings()
+        return self.batcher.batches([embeddings, embeddings], [src, dst], bounds, y=is_positive.astype(np.float64))
+
+    def batch_node_ids(self):
+        """
+        :return: ids of all nodes that can appear in batches
+        """
+        if self.split_on == "nodes":
+            return np.concatenate([self.target['src'].values, self.ee.indices])
+        return self.target[['src', 'dst']].values.ravel()
+
+    def node_embeddings(self):
+        """
+        Embeddings of all nodes that can appear in batches, looked up once on the first batch
+        :return: sorted node ids and their embeddings
+        """
+        if self._node_ids is None:
+            self._node_ids = np.unique(np.asarray(self.batch_node_ids(), dtype=np.int64))
+            self._node_embeddings = self.embed[self._node_ids]
+        return self._node_ids, self._node_embeddings
 
-        for _ in range(n_batches):
-            batch_ind = np.random.choice(indices, sample_size, replace=False)
-            positive_in = self.embed[batch_ind]
-            positive_out = self.embed[self.ee[batch_ind]]
+    def node_positions(self, nodes):
+        """
+        :param nodes: array of node ids
+        :return: rows of embeddings returned by node_embeddings
+        """
+        ids, _ = self.node_embeddings()
+        return np.searchsorted(ids, np.asarray(nodes, dtype=np.int64))
 
-            negative_in = np.repeat(positive_in, K, axis=0)
-            negative_out = self.embed[self.ee.sample_negative(sample_size * K)]
-            # negative_out = self.embed[np.random.choice(self.unique_dst, size=size * K)]
-            X_b = np.concatenate([
-                np.concatenate([
-                    positive_in, positive_out
-                ], axis=1),
-                np.concatenate([
-                    negative_in, negative_out
-                ], axis=1)
-            ], axis=0)
+    def element_positions(self):
+        """
+        Used when targets are nodes
+        :return: rows of node_embeddings for elements of ElementEmbedderBase, and the sampler of negative targets that
+            returns rows of node_embeddings
+        """
+        if self._element_positions is None:
+            self._element_positions = self.node_positions(self.ee.indices)
+            self._element_sampler = AliasSampler.from_occurrences(self._element_positions, power=3/4)
+        return self._element_positions, self._element_sampler
 
-            y_b = np.concatenate([np.ones(sample_size,), np.zeros(sample_size*K,)])
+    def edge_set(self, part):
+        """
+        :param part: "train" or "test"
+        :return: 2d array with edges of the part, created once
+        """
+        if part not in self._edge_sets:
+            ind = self.train_edge_ind if part == "train" else self.test_edge_ind
+            self._edge_sets[part] = self.target.iloc[ind][['src', 'dst']].values
+        return self._edge_sets[part]
 
-            yield {"x": X_b, "y": y_b}
+    def per_array(self, array, name, compute):
+        """
+        Values derived from an array that is batched in every epoch, e.g. train nodes. Values are computed on the first
+        epoch and reused while the same array is passed
+        :param array: numpy array
+        :param name: name of the value
+        :param compute: function that computes the value from the array
+        """
+        key = (id(array), name)
+        cached = self._per_array.get(key)
+        if cached is None or cached[0] is not array:
+            cached = self._per_array[key] = (array, compute(array))
+        return cached[1]
 
 
 def compact_property(values):
@@ -527,67 +665,40 @@ class Experiment2(Experiment):
         # return np.hstack([self.embed[src], self.embed[dst]])
 
     def batch_nodes(self, indices, size=256, K=15, test=False):
-
+        """
+        Generate batches of one epoch. Every node is paired with one of its elements and with K negative elements.
+        Arguments are the same as in Experiment.batch_nodes
+        """
         if not test and indices.shape[0] < size:
             raise ValueError("The amount of training data is too small")
 
-        if test:
-            n_batches = 1
-            sample_size = indices.shape[0]
-        else:
-            n_batches = indices.shape[0] // size + 1
-            sample_size = size
-
-        for _ in range(n_batches):
-            batch_ind = np.random.choice(indices, sample_size)
-            positive_in = self.embed[batch_ind]
-            positive_out = self.ee[batch_ind]
-
-            negative_in = np.repeat(positive_in, K, axis=0)
-            negative_out = self.ee.sample_negative(sample_size * K)
-            # negative_out = self.embed[np.random.choice(self.unique_dst, size=size * K)]
-            in_ = np.concatenate([
-                positive_in, negative_in
-            ], axis=0)
-            dst_ = np.concatenate([
-                positive_out, negative_out
-            ], axis=0)
+        order, counts = epoch_order(indices.shape[0], size, whole=test)
+        bounds, is_positive = epoch_layout(counts, K)
+        src = self.per_array(indices, "src", self.node_positions)[order]
+        src = interleave(src, np.repeat(src, K), is_positive)
 
-            y_b = np.concatenate([np.ones(sample_size, ), np.zeros(sample_size * K, )])
+        rows = self.per_array(indices, "rows", self.ee.key_rows)[order]
+        elements = interleave(self.ee.indices[self.ee.sample_positions(rows)], self.ee.sample_negative(order.size * K),
+                              is_positive)
 
-            yield {"x": in_, 'elements': dst_ , "y": y_b}
+        _, embeddings = self.node_embeddings()
+        return self.batcher.batches([embeddings], [src], bounds, elements=elements, y=is_positive.astype(np.float64))
 
     def batch_edges(self, X, size=256, K=15):
-        for i in range(0, X.shape[0], size):
-            if i + size >= X.shape[0]: continue
-
-            neg = self.get_negative_edges(X[i: i + size, 0], self.unique_dst, size * K)
-            X_ = np.vstack([X[i: i+size], neg])
-
-            src = X_[:, 0]
-            dst = X_[:, 1]
-
-            X_src = self.embed[src]
-
-            y_b = np.concatenate([np.ones(size, ), np.zeros(size * K, )])
-
-            assert y_b.shape[0] == X_src.shape[0] == dst.shape[0] == size * (1 + K)
-            yield {"x": X_src, "elements": dst, "y": y_b}
-
-        last_piece = X[X.shape[0] // size * size:]
-        neg = self.get_negative_edges(last_piece[:, 0], self.unique_dst, last_piece.shape[0] * K)
-        X_ = np.vstack([last_piece, neg])
-
-        src = X_[:, 0]
-        dst = X_[:, 1]
-
-        X_src = self.embed[src]
-
-        y_b = np.concatenate([np.ones(last_piece.shape[0], ), np.zeros(last_piece.shape[0] * K, )])
+        """
+        Generate batches of one epoch. Arguments are the same as in Experiment.batch_edges
+        """
+        counts = sample_counts(X.shape[0], size)
+        bounds, is_positive = epoch_layout(counts, K)
+        src = self.per_array(X, "src", lambda X: self.node_positions(X[:, 0]))
+        src = interleave(src, src[negative_sources(counts, K)], is_positive)
+        elements = interleave(X[:, 1], self.dst_neg_sampling(X.shape[0] * K), is_positive)
 
-        assert y_b.shape[0] == X_src.shape[0] == dst.shape[0] == last_piece.shape[0] * (1 + K)
+        _, embeddings = self.node_embeddings()
+        return self.batcher.batches([embeddings], [src], bounds, elements=elements, y=is_positive.astype(np.float64))
 
-        yield {"x": X_src, "elements": dst, "y": y_b}
+    def batch_node_ids(self):
+        return self.target['src'].values
 
 
 class Experiment3(Experiment2):
@@ -622,16 +733,10 @@ class Experiment3(Experiment2):
 
 
     def batch(self, X, y, size=256, **kwargs):
-        for i in range(0, X.shape[0], size):
-            if i + size >= X.shape[0]: continue
-
-            X_src = self.embed[X[i: i+size, 0]]
-
-            yield {"x": X_src, "y": y[i: i+size, :]}
-
-        X_src = self.embed[X[X.shape[0] // size * size:, 0]]
-        yield {"x": X_src, "y": y[X.shape[0] // size * size: , :]}
-
+        # embeddings of X are gathered on the first epoch, batches are their slices
+        embeddings = self.per_array(X, "embeddings", lambda X: self.node_embeddings()[1][self.node_positions(X[:, 0])])
+        bounds = np.concatenate([[0], np.cumsum(sample_counts(X.shape[0], size))])
+        return self.batcher.batches([embeddings], [None], bounds, y=y)
 
     def train_batches(self):
         if not hasattr(self, "X_train"):
@@ -0,0 +1,160 @@
+import json
+import resource
+from os.path import dirname, join
+from time import perf_counter
+
+import torch
+
+
+class NoPhase:
+    """
+    Context manager that does nothing. Returned by phase when instrumentation is not active.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NO_PHASE = NoPhase()
+
+# instrumentation that receives measurements from training procedures, None when measurements are not collected
+_active = None
+
+
+class Phase:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        if self.instrumentation.profiler is not None:
+            # phases are shown as named ranges in the trace
+            self.record = torch.autograd.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.instrumentation.add_time(self.name, perf_counter() - self.start)
+        if self.record is not None:
+            self.record.__exit__(exc_type, exc_val, exc_tb)
+        return False
+
+
+class Instrumentation:
+    """
+    Collects wall time of training phases, number of processed samples and peak memory for every epoch and appends
+    them as json lines to the metrics file. Training procedures report measurements through module functions phase,
+    add_samples, start_epoch and end_epoch, which do nothing unless an Instrumentation is active:
+
+        with Instrumentation("metrics.jsonl"):
+            training_procedure(...)
+
+    Phases can be nested, the time of the nested phase is also included into the time of the outer one.
+    """
+    def __init__(self, metrics_path, profile=False, profile_epochs=1):
+        """
+
+        :param metrics_path: path to jsonl file with metrics, one line per epoch
+        :param profile: whether to record torch.autograd.profiler trace. Traces are written next to metrics file
+            in chrome trace format (open in chrome://tracing)
+        :param profile_epochs: number of first epochs that are profiled, profiling slows down training
+        """
+        self.metrics_path = metrics_path
+        self.profile = profile
+        self.profile_epochs = profile_epochs
+
+        self.metrics_file = None
+        self.profiler = None
+        self.reset()
+
+    def reset(self):
+        self.phase_times = {}
+        self.samples = 0
+        self.epoch_start = perf_counter()
+
+    def __enter__(self):
+        global _active
+        self.metrics_file = open(self.metrics_path, "a")
+        _active = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _active
+        self.stop_profiler(None)
+        self.metrics_file.close()
+        _active = None
+        return False
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add_time(self, name, duration):
+        self.phase_times[name] = self.phase_times.get(name, 0.) + duration
+
+    def add_samples(self, count):
+        self.samples += count
+
+    def start_epoch(self, epoch):
+        self.reset()
+        if self.profile and epoch < self.profile_epochs:
+            self.profiler = torch.autograd.profiler.profile()
+            self.profiler.__enter__()
+
+    def stop_profiler(self, epoch):
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        if epoch is not None:
+            self.profiler.export_chrome_trace(join(dirname(self.metrics_path), "trace_epoch{}.json".format(epoch)))
+        self.profiler = None
+
+    def end_epoch(self, epoch, **values):
+        """
+        Write metrics of the epoch
+        :param epoch: epoch number
+        :param values: additional values that are stored with the metrics, e.g. loss and accuracy
+        """
+        epoch_time = perf_counter() - self.epoch_start
+        self.stop_profiler(epoch)
+
+        record = {
+            "epoch": epoch,
+            "epoch_time": epoch_time,
+            "samples": self.samples,
+            "samples_per_sec": self.samples / epoch_time if epoch_time > 0 else 0.,
+            # ru_maxrss is in kilobytes on linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "phases": self.phase_times,
+        }
+        record.update(values)
+
+        self.metrics_file.write(json.dumps(record) + "\n")
+        self.metrics_file.flush()
+
+
+def phase(name):
+    """
+    Measure the time of the code inside with block as the phase with the given name
+    """
+    if _active is None:
+        return NO_PHASE
+    return _active.phase(name)
+
+
+def add_samples(count):
+    if _active is not None:
+        _active.add_samples(count)
+
+
+def start_epoch(epoch):
+    if _active is not None:
+        _active.start_epoch(epoch)
+
+
+def end_epoch(epoch, **values):
+    if _active is not None:
+        _active.end_epoch(epoch, **values)
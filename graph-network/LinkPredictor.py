@@ -14,4 +14,114 @@ class LinkPredictor(nn.Module):
 
     def forward(self, x, **kwargs):
         x = F.relu(self.l1(x))
-        return self.logits(x)
\ No newline at end of file
+        return self.logits(x)
+
+    def forward_split(self, src, dst):
+        """
+        Compute logits for pairs without concatenating their embeddings. The first layer is split into the part that
+        is applied to src and the part that is applied to dst. The src part is computed once for every source and
+        broadcast to all its pairs. Equivalent to forward(torch.cat([src.repeat(n, 1), dst], 1))
+        :param src: embeddings of sources, shape (batch_size, src_dim)
+        :param dst: embeddings of targets, shape (n * batch_size, dst_dim). Row i is paired with src[i % batch_size]
+        :return: logits for pairs
+        """
+        src_dim = src.shape[1]
+        h_src = F.linear(src, self.l1.weight[:, :src_dim])
+        h_dst = F.linear(dst, self.l1.weight[:, src_dim:], self.l1.bias)
+        h = (h_dst.view(-1, *h_src.shape) + h_src).view(h_dst.shape)
+        return self.logits(F.relu(h))
+
+    def score_candidates(self, src, candidates):
+        """
+        Score every source against every candidate with the log-odds of the link. Hidden activations are computed
+        for every pair, memory grows as batch_size * num_candidates * hidden size
+        :param src: embeddings of sources, shape (batch_size, src_dim)
+        :param candidates: embeddings of targets, shape (num_candidates, dst_dim)
+        :return: scores, shape (batch_size, num_candidates)
+        """
+        src_dim = src.shape[1]
+        h_src = F.linear(src, self.l1.weight[:, :src_dim])
+        h_dst = F.linear(candidates, self.l1.weight[:, src_dim:], self.l1.bias)
+        h = F.relu(h_src.unsqueeze(1) + h_dst.unsqueeze(0))
+        return h @ (self.logits.weight[1] - self.logits.weight[0]) + (self.logits.bias[1] - self.logits.bias[0])
+
+
+class PairScorer(nn.Module):
+    """
+    Scores pairs with a similarity function instead of MLP. Scores of one source against many candidates are
+    computed with one matrix multiplication, which makes in-batch and shared negatives cheap. Can be used in place
+    of LinkPredictor: forward and forward_split return logits for two classes, where the score is the logit of the
+    positive class.
+    """
+    def __init__(self, src_dim, dst_dim, mode="dot"):
+        """
+
+        :param src_dim: dimensionality of source embeddings
+        :param dst_dim: dimensionality of target embeddings
+        :param mode: "dot" - dot product, "distmult" - dot product weighted with a learned diagonal, "bilinear" -
+            src^T W dst with a learned matrix W
+        """
+        super(PairScorer, self).__init__()
+        self.src_dim = src_dim
+        self.dst_dim = dst_dim
+        self.mode = mode
+
+        if mode in {"dot", "distmult"} and src_dim != dst_dim:
+            raise ValueError("Source and target embeddings should have the same size for mode:", mode)
+
+        if mode == "distmult":
+            self.relation = nn.Parameter(torch.ones(src_dim))
+        elif mode == "bilinear":
+            self.weight = nn.Parameter(torch.Tensor(src_dim, dst_dim))
+            nn.init.xavier_uniform_(self.weight)
+        elif mode != "dot":
+            raise ValueError("Unknown scoring mode:", mode)
+
+    def transform(self, src):
+        """
+        Map sources into the space of targets, the score is the dot product of the result with the target
+        """
+        if self.mode == "distmult":
+            return src * self.relation
+        elif self.mode == "bilinear":
+            return src @ self.weight
+        return src
+
+    def score(self, src, dst):
+        """
+        :return: score for every pair of rows of src and dst
+        """
+        return (self.transform(src) * dst).sum(1)
+
+    def score_candidates(self, src, candidates):
+        """
+        :param src: embeddings of sources, shape (batch_size, src_dim)
+        :param candidates: embeddings of targets, shape (num_candidates, dst_dim)
+        :return: scores of every source against every candidate, shape (batch_size, num_candidates)
+        """
+        return self.transform(src) @ candidates.t()
+
+    @staticmethod
+    def to_logits(scores):
+        return torch.stack([torch.zeros_like(scores), scores], 1)
+
+    def forward(self, x, **kwargs):
+        return self.to_logits(self.score(x[:, :self.src_dim], x[:, self.src_dim:]))
+
+    def forward_split(self, src, dst):
+        """
+        Same as LinkPredictor.forward_split
+        """
+        scores = (dst.view(-1, *src.shape) * self.transform(src)).sum(2)
+        return self.to_logits(scores.view(-1))
+
+
+def create_link_predictor(scorer, src_dim, dst_dim):
+    """
+    :param scorer: "mlp" for LinkPredictor, otherwise mode of PairScorer
+    :param src_dim: dimensionality of source embeddings
+    :param dst_dim: dimensionality of target embeddings
+    """
+    if scorer == "mlp":
+        return LinkPredictor(src_dim + dst_dim)
+    return PairScorer(src_dim, dst_dim, mode=scorer)
@@ -0,0 +1,114 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+
+import numpy as np
+
+# interval in seconds at which blocked threads check whether the prefetcher is closed
+POLL_INTERVAL = 0.1
+
+
+def copy_batch(batch):
+    """
+    Copy numpy arrays of the batch, so that the batch does not share memory with buffers of the generator
+    """
+    return {key: np.array(value) if isinstance(value, np.ndarray) else value for key, value in batch.items()}
+
+
+class _End:
+    def __init__(self, error=None):
+        self.error = error
+
+
+class Prefetcher:
+    """
+    Iterates over batches that are produced in a background thread, so that the preparation of the next batches
+    overlaps with training on the current one. Up to depth batches are prepared ahead. Optionally, every batch is
+    passed through transform (e.g. conversion into framework tensors) by a pool of worker threads, batches are
+    returned in the original order. Numpy releases GIL in indexing and copying, and frameworks release it during
+    computation, so the threads run in parallel with training.
+
+        for batch in Prefetcher(experiment.train_batches, depth=4):
+            train_step(batch)
+    """
+    def __init__(self, batches, depth=2, workers=0, transform=None, copy=True):
+        """
+
+        :param batches: iterable of batches, or a function that returns it. The function is called in the background
+            thread, so the work it does before returning the iterable is overlapped as well
+        :param depth: maximal number of batches that are prepared ahead
+        :param workers: number of threads that apply transform. When 0, transform is applied in the background thread
+        :param transform: function that is applied to every batch
+        :param copy: copy numpy arrays of batches before reading the next one. Needed for generators that reuse
+            buffers, e.g. EpochBatcher
+        """
+        if depth < 1:
+            raise ValueError("Prefetch depth should be at least 1")
+        self.batches = batches
+        self.transform = transform
+        self.copy = copy
+        self.queue = Queue(maxsize=depth)
+        self.closed = Event()
+        self.pool = ThreadPoolExecutor(workers) if workers > 0 and transform is not None else None
+
+        self.worker = Thread(target=self.produce, daemon=True)
+        self.worker.start()
+
+    def put(self, item):
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce(self):
+        try:
+            batches = self.batches() if callable(self.batches) else self.batches
+            for batch in batches:
+                if self.copy:
+                    batch = copy_batch(batch)
+                if self.pool is not None:
+                    batch = self.pool.submit(self.transform, batch)
+                elif self.transform is not None:
+                    batch = self.transform(batch)
+                if not self.put(batch):
+                    return
+            self.put(_End())
+        except Exception as e:
+            self.put(_End(e))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed.is_set():
+            raise StopIteration
+        item = self.queue.get()
+        if isinstance(item, _End):
+            self.close()
+            if item.error is not None:
+                raise item.error
+            raise StopIteration
+        return item.result() if isinstance(item, Future) else item
+
+    def close(self):
+        """
+        Stop the background thread, e.g. when iteration is interrupted. Batches that are prepared are dropped
+        """
+        self.closed.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+        self.worker.join()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
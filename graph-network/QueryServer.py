@@ -0,0 +1,456 @@
+"""
+HTTP service that answers nearest neighbor and egonet queries for a trained model. Model artifacts are loaded once at
+start, responses are cached, connections are kept alive, and concurrent nearest neighbor requests are searched
+together in one batch.
+
+Usage:
+    python QueryServer.py models/RGCN-2020-05-11-10-14-50-783337 --port 8081
+
+Endpoints (ids are original node ids, several ids or names are separated with commas):
+    GET /neighbors?id=10,20&k=10            nearest neighbors of nodes by embedding similarity
+    GET /neighbors?name=module.function
+    POST /neighbors {"ids": [10, 20], "names": ["module.function"], "k": 10}
+    GET /egonet?id=10&limit=100              node, its in and out neighbors, and edges between them
+    GET /egonet?name=module.function
+    GET /stats                               number of nodes and cache statistics
+"""
+import argparse
+import asyncio
+import json
+from collections import OrderedDict
+from os.path import join
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import pandas
+
+from Embedder import load_model_embedders
+from EmbeddingIndex import IVFIndex, brute_force_search
+
+INT64_MIN, INT64_MAX = np.iinfo(np.int64).min, np.iinfo(np.int64).max
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               500: "Internal Server Error"}
+
+
+class QueryError(Exception):
+    def __init__(self, status, message):
+        super(QueryError, self).__init__(message)
+        self.status = status
+
+
+class ResponseCache:
+    """
+    Least recently used cache of encoded responses
+    """
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+
+
+def adjacency(rows, columns, num_nodes):
+    """
+    CSR adjacency: neighbors of node i are columns[order[indptr[i]: indptr[i + 1]]]
+    :return: indptr and order of edges
+    """
+    order = np.argsort(rows, kind="stable")
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+    return indptr, order
+
+
+class ModelStore:
+    """
+    Artifacts of a trained model that are needed to answer queries: embeddings of one layer, node names, and the
+    graph in CSR format
+    """
+    def __init__(self, model_path, layer=-1, metric="cosine", index_path=None, nprobe=8):
+        """
+
+        :param model_path: directory of the trained model
+        :param layer: index of the embedding layer
+        :param metric: similarity for nearest neighbors, "ip" or "cosine". Ignored when the index is used
+        :param index_path: directory with IVFIndex written by build_index.py. Exact search is used when None
+        :param nprobe: number of probed lists of the index
+        """
+        nodes = pandas.read_csv(join(model_path, "nodes.csv"), usecols=lambda column: column in {'id', 'name'})
+        edges = pandas.read_csv(join(model_path, "edges.csv"), usecols=['src', 'dst', 'type'])
+
+        self.embedder = load_model_embedders(model_path, [layer])[0]
+
+        self.metric = metric
+        self.nprobe = nprobe
+        if index_path is not None:
+            self.index = IVFIndex.load(index_path)
+            self.vectors = None
+        else:
+            self.index = None
+            # rows ordered as embedder.ids
+            self.vectors = np.asarray(self.embedder.e[self.embedder.rows], dtype=np.float32)
+
+        # nodes are addressed by positions in the sorted array of ids
+        order = np.argsort(nodes['id'].values, kind="stable")
+        self.node_ids = nodes['id'].values[order].astype(np.int64)
+        names = nodes['name'].values[order] if 'name' in nodes.columns else self.node_ids
+        self.node_names = np.array([str(name) for name in names], dtype=object)
+        self.name_to_id = {}
+        for node_id, name in zip(self.node_ids.tolist(), self.node_names.tolist()):
+            self.name_to_id.setdefault(name, node_id)
+
+        edge_src = self.positions(edges['src'].values)
+        edge_dst = self.positions(edges['dst'].values)
+        known = (edge_src >= 0) & (edge_dst >= 0)
+        self.edge_src, self.edge_dst = edge_src[known], edge_dst[known]
+        self.edge_type = edges['type'].values[known]
+        self.out_indptr, self.out_order = adjacency(self.edge_src, self.edge_dst, self.node_ids.size)
+        self.in_indptr, self.in_order = adjacency(self.edge_dst, self.edge_src, self.node_ids.size)
+
+    def __len__(self):
+        return self.node_ids.size
+
+    def positions(self, ids):
+        """
+        :param ids: array of original node ids
+        :return: positions of nodes, -1 for unknown ids
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        pos = np.searchsorted(self.node_ids, ids)
+        pos[pos == self.node_ids.size] = 0
+        return np.where(self.node_ids[pos] == ids, pos, -1) if self.node_ids.size > 0 else np.full(ids.shape, -1)
+
+    def resolve(self, ids=(), names=()):
+        """
+        Convert ids and names into node ids
+        :param ids: list of integer node ids
+        :param names: list of node names
+        :raises QueryError: if ids or names are malformed, or some of the nodes are unknown
+        """
+        if not isinstance(ids, (list, tuple)) or \
+                not all(isinstance(node_id, int) and not isinstance(node_id, bool) for node_id in ids):
+            raise QueryError(400, "ids should be a list of integers")
+        if not isinstance(names, (list, tuple)) or not all(isinstance(name, str) for name in names):
+            raise QueryError(400, "names should be a list of strings")
+        if not all(INT64_MIN <= node_id <= INT64_MAX for node_id in ids):
+            raise QueryError(404, "Unknown node ids: {}".format(
+                [node_id for node_id in ids if not INT64_MIN <= node_id <= INT64_MAX]))
+        unknown = [name for name in names if name not in self.name_to_id]
+        if unknown:
+            raise QueryError(404, "Unknown node names: {}".format(unknown))
+        ids = np.concatenate([np.asarray(ids, dtype=np.int64),
+                              np.array([self.name_to_id[name] for name in names], dtype=np.int64)])
+        missing = ~self.embedder.contains(ids)
+        if missing.any():
+            raise QueryError(404, "Unknown node ids: {}".format(ids[missing].tolist()))
+        return ids
+
+    def name(self, ids):
+        return self.node_names[self.positions(ids)].tolist()
+
+    def search(self, ids, k):
+        """
+        Nearest neighbors of nodes, the node itself is excluded
+        :param ids: array of node ids
+        :param k: number of neighbors
+        :return: scores and ids of neighbors, shape (len(ids), k)
+        """
+        queries = np.asarray(self.embedder[ids], dtype=np.float32)
+        if self.index is not None:
+            scores, found = self.index.search(queries, k=k + 1, nprobe=self.nprobe)
+        else:
+            scores, found = brute_force_search(self.vectors, queries, k=k + 1, metric=self.metric,
+                                               ids=self.embedder.ids, chunk_size=65536)
+        # remove the query node, or the last neighbor if the query node is not found
+        keep = found != ids[:, None]
+        keep[keep.all(axis=1), -1] = False
+        k = found.shape[1] - 1
+        return scores[keep].reshape(-1, k), found[keep].reshape(-1, k)
+
+    def neighbors_response(self, ids, scores, found):
+        return [{
+            "id": int(node_id),
+            "name": name,
+            "neighbors": [{"id": int(n), "name": n_name, "score": float(s)}
+                          for n, n_name, s in zip(node_found, self.name(node_found), node_scores) if n >= 0]
+        } for node_id, name, node_scores, node_found in zip(ids, self.name(ids), scores, found)]
+
+    def egonet(self, node_id, limit=100):
+        """
+        Node, its in and out neighbors, and edges between these nodes. Same format as the Julia graph server
+        :param node_id: original node id
+        :param limit: maximal number of neighbors, non-negative
+        :return: dictionary with nodes and links
+        """
+        if limit < 0:
+            raise QueryError(400, "limit should not be negative")
+        pos = self.positions(np.array([node_id]))[0]
+        if pos < 0:
+            raise QueryError(404, "Unknown node id: {}".format(node_id))
+
+        out_edges = self.out_order[self.out_indptr[pos]: self.out_indptr[pos + 1]]
+        in_edges = self.in_order[self.in_indptr[pos]: self.in_indptr[pos + 1]]
+        neighbors = np.unique(np.concatenate([self.edge_dst[out_edges], self.edge_src[in_edges]]))
+        neighbors = neighbors[neighbors != pos][:limit]
+        ego = np.concatenate([[pos], neighbors])
+
+        # edges between the nodes of the egonet are among the outgoing edges of these nodes
+        candidates = np.concatenate([
+            self.out_order[self.out_indptr[node]: self.out_indptr[node + 1]] for node in ego
+        ])
+        links = candidates[np.isin(self.edge_dst[candidates], ego)]
+
+        return {
+            "nodes": [{"id": int(self.node_ids[node]), "name": self.node_names[node]} for node in ego],
+            "links": [{"source": self.node_names[self.edge_src[e]], "target": self.node_names[self.edge_dst[e]],
+                       "type": int(self.edge_type[e])} for e in links],
+        }
+
+
+class QueryServer:
+    """
+    Asyncio HTTP/1.1 server for ModelStore. Searches and egonets run in a thread pool, so the event loop keeps accepting
+    requests. Nearest neighbor requests that arrive within batch_delay are searched together.
+    """
+    def __init__(self, store, cache_size=10000, batch_delay=0.002, max_batch=4096, max_k=1000):
+        """
+
+        :param store: ModelStore
+        :param cache_size: number of cached responses
+        :param batch_delay: time in seconds that a nearest neighbor request waits for other requests
+        :param max_batch: number of query nodes that triggers the search without waiting
+        :param max_k: the largest number of neighbors that can be requested
+        """
+        self.store = store
+        self.cache = ResponseCache(cache_size)
+        self.batch_delay = batch_delay
+        self.max_batch = max_batch
+        self.max_k = max_k
+
+        self.pending = []
+        self.pending_size = 0
+        self.flush_handle = None
+        # the event loop keeps only weak references to tasks, running batches are referenced here
+        self.tasks = set()
+
+    async def start(self, host="127.0.0.1", port=8081):
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def search(self, ids, k):
+        """
+        Add the query to the current batch and wait for the result
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((ids, k, future))
+        self.pending_size += ids.size
+        if self.pending_size >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_delay, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending, self.pending_size = self.pending, [], 0
+        if batch:
+            task = asyncio.ensure_future(self.run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, batch):
+        ids = np.concatenate([query_ids for query_ids, _, _ in batch])
+        k = max(query_k for _, query_k, _ in batch)
+        try:
+            scores, found = await asyncio.get_running_loop().run_in_executor(None, self.store.search, ids, k)
+        except Exception as e:
+            for _, _, future in batch:
+                # futures of handlers that were cancelled, e.g. at shutdown, are skipped
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        start = 0
+        for query_ids, query_k, future in batch:
+            end = start + query_ids.size
+            if not future.done():
+                future.set_result((scores[start: end, :query_k], found[start: end, :query_k]))
+            start = end
+
+    def parse_k(self, value):
+        try:
+            k = int(value)
+        except (TypeError, ValueError):
+            raise QueryError(400, "k should be an integer")
+        if not 0 < k <= self.max_k:
+            raise QueryError(400, "k should be between 1 and {}".format(self.max_k))
+        return k
+
+    @staticmethod
+    def parse_limit(value):
+        try:
+            limit = int(value)
+        except (TypeError, ValueError):
+            raise QueryError(400, "limit should be an integer")
+        if limit < 0:
+            raise QueryError(400, "limit should not be negative")
+        return limit
+
+    async def neighbors(self, ids, names, k):
+        ids = self.store.resolve(ids, names)
+        if ids.size == 0:
+            raise QueryError(400, "Specify id or name")
+        scores, found = await self.search(ids, k)
+        return {"results": self.store.neighbors_response(ids, scores, found)}
+
+    async def respond(self, method, target, body):
+        """
+        :return: status and response object
+        """
+        url = urlsplit(target)
+        params = {key: ",".join(values) for key, values in parse_qs(url.query).items()}
+
+        def split(value):
+            return [item for item in value.split(",") if item] if value else []
+
+        try:
+            if url.path == "/neighbors":
+                if method == "GET":
+                    ids = [int(node_id) for node_id in split(params.get("id"))]
+                    return 200, await self.neighbors(ids, split(params.get("name")), self.parse_k(params.get("k", 10)))
+                elif method == "POST":
+                    query = json.loads(body.decode("utf-8"))
+                    if not isinstance(query, dict):
+                        raise QueryError(400, "Query should be a JSON object")
+                    return 200, await self.neighbors(query.get("ids", []), query.get("names", []),
+                                                     self.parse_k(query.get("k", 10)))
+                raise QueryError(405, "Use GET or POST")
+            elif url.path == "/egonet":
+                if method != "GET":
+                    raise QueryError(405, "Use GET")
+                ids = self.store.resolve([int(node_id) for node_id in split(params.get("id"))],
+                                         split(params.get("name")))
+                if ids.size != 1:
+                    raise QueryError(400, "Specify one id or name")
+                # egonets of nodes with many neighbors take long to build, the event loop keeps serving requests
+                return 200, await asyncio.get_running_loop().run_in_executor(
+                    None, self.store.egonet, ids[0], self.parse_limit(params.get("limit", 100)))
+            elif url.path == "/stats":
+                return 200, {"nodes": len(self.store), "cache_size": len(self.cache.items),
+                             "cache_hits": self.cache.hits, "cache_misses": self.cache.misses}
+            raise QueryError(404, "Unknown path: {}".format(url.path))
+        except QueryError as e:
+            return e.status, {"error": str(e)}
+        except ValueError as e:
+            return 400, {"error": "Malformed query: {}".format(e)}
+
+    async def cached_response(self, method, target, body):
+        """
+        :return: status and encoded response. Successful responses are cached, except for statistics
+        """
+        key = (method, target, body)
+        response = self.cache.get(key)
+        if response is not None:
+            return 200, response
+        status, response = await self.respond(method, target, body)
+        response = json.dumps(response).encode("utf-8")
+        if status == 200 and not target.startswith("/stats"):
+            self.cache.put(key, response)
+        return status, response
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.write_response(writer, 400, b'{"error": "Malformed request"}', False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip().lower()
+                try:
+                    content_length = int(headers.get("content-length", 0))
+                    if content_length < 0:
+                        raise ValueError
+                except ValueError:
+                    # the body can not be skipped without its length
+                    await self.write_response(writer, 400, b'{"error": "Malformed Content-Length"}', False)
+                    break
+                body = await reader.readexactly(content_length)
+
+                connection = headers.get("connection", "")
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+                try:
+                    status, response = await self.cached_response(method, target, body)
+                except Exception as e:
+                    status, response = 500, json.dumps({"error": str(e)}).encode("utf-8")
+                await self.write_response(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def write_response(writer, status, body, keep_alive):
+        writer.write((
+            "HTTP/1.1 {} {}\r\n"
+            "Content-Type: application/json\r\n"
+            "Content-Length: {}\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            "Connection: {}\r\n\r\n"
+        ).format(status, STATUS_TEXT[status], len(body), "keep-alive" if keep_alive else "close").encode("latin-1"))
+        writer.write(body)
+        await writer.drain()
+
+
+async def serve(store, host, port, **kwargs):
+    server = await QueryServer(store, **kwargs).start(host, port)
+    print("Serving {} nodes on http://{}:{}".format(len(store), host, port))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve nearest neighbor and egonet queries for a trained model")
+    parser.add_argument("model_path", help="Directory of the trained model")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--layer", type=int, default=-1, help="Index of the embedding layer")
+    parser.add_argument("--metric", default="cosine", choices=["ip", "cosine"],
+                        help="Similarity for exact search, the index uses the metric it was built with")
+    parser.add_argument("--index", default=None, help="Directory of the index written by build_index.py")
+    parser.add_argument("--nprobe", type=int, default=8, help="Number of probed lists of the index")
+    parser.add_argument("--cache_size", type=int, default=10000, help="Number of cached responses")
+    args = parser.parse_args()
+
+    model_store = ModelStore(args.model_path, layer=args.layer, metric=args.metric, index_path=args.index,
+                             nprobe=args.nprobe)
+    asyncio.run(serve(model_store, args.host, args.port, cache_size=args.cache_size))
@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+DEFAULT_HITS = (1, 3, 10)
+
+
+def dot_scorer(src, candidates):
+    """
+    Score every source against every candidate with dot product of embeddings
+    """
+    return src @ candidates.t()
+
+
+def element_queries(ee, ids, candidate_ids=None):
+    """
+    Collect true targets of nodes stored in ElementEmbedderBase
+    :param ee: ElementEmbedderBase
+    :param ids: array of query nodes
+    :param candidate_ids: sorted array of element ids that are ranked. When None, element ids are used as positions of
+        candidates directly, e.g. rows of ElementEmbedder.embed
+    :return: targets in CSR format: targets of ids[i] are targets[indptr[i]: indptr[i + 1]]
+    """
+    rows = ee.key_rows(ids)
+    start = ee.indptr[rows]
+    lengths = ee.indptr[rows + 1] - start
+
+    indptr = np.zeros(rows.size + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    positions = np.arange(indptr[-1]) - np.repeat(indptr[:-1] - start, lengths)
+    targets = ee.indices[positions]
+
+    if candidate_ids is not None:
+        targets = np.searchsorted(candidate_ids, targets)
+    return indptr, targets
+
+
+def rank_chunk(scorer, src, candidates, indptr, targets, candidate_chunk_size):
+    """
+    Rank true targets of a chunk of sources among all candidates. Candidates are scored in blocks of
+    candidate_chunk_size, so that memory is bounded by the chunk size times candidate_chunk_size.
+    :return: rank of every target
+    """
+    lengths = indptr[1:] - indptr[:-1]
+    pair_rows = torch.from_numpy(np.repeat(np.arange(lengths.size), lengths))
+    targets = torch.from_numpy(targets)
+
+    # true scores are computed against targets only, the same score is used for all blocks
+    unique_targets, inverse = torch.unique(targets, return_inverse=True)
+    true_scores = scorer(src, candidates[unique_targets])[pair_rows, inverse].unsqueeze(1)
+
+    # ties are resolved with the average of optimistic and pessimistic ranks: rank = 1 + greater + equal / 2. Counting
+    # greater and equal separately is slow, it is computed as 1 + (num_candidates + greater - less) / 2 instead, where
+    # greater - less is the sum of signs of score differences
+    ranks = torch.full((targets.shape[0],), 1. + candidates.shape[0] / 2, dtype=torch.float64)
+    for block_start in range(0, candidates.shape[0], candidate_chunk_size):
+        block_end = min(block_start + candidate_chunk_size, candidates.shape[0])
+        scores = scorer(src, candidates[block_start: block_end])
+
+        # filtered setting: true targets of a source are not counted as its competitors, -inf scores count as less
+        in_block = (targets >= block_start) & (targets < block_end)
+        scores[pair_rows[in_block], targets[in_block] - block_start] = float("-inf")
+
+        ranks += torch.sign(scores.index_select(0, pair_rows) - true_scores).sum(1).double() / 2
+
+    return ranks.numpy()
+
+
+def rank_targets(src, candidates, indptr, targets, scorer=dot_scorer, chunk_size=256, candidate_chunk_size=8192,
+                 threads=1):
+    """
+    Rank the true targets of every source among all candidates. Sources are processed in chunks, chunks are
+    distributed over a thread pool. Matrix multiplications release GIL, so threads run in parallel.
+    :param src: tensor or array with embeddings of sources, shape (num_sources, src_dim)
+    :param candidates: tensor or array with embeddings of all candidates, shape (num_candidates, dst_dim)
+    :param indptr: targets of source i are targets[indptr[i]: indptr[i + 1]], see element_queries
+    :param targets: positions of true targets in candidates
+    :param scorer: function that returns scores of every source against every candidate, e.g.
+        PairScorer.score_candidates or LinkPredictor.score_candidates
+    :param chunk_size: number of sources that are scored together
+    :param candidate_chunk_size: number of candidates that are scored together
+    :param threads: number of threads
+    :return: array with one rank per target, in the order of targets
+    """
+    src = torch.as_tensor(src)
+    candidates = torch.as_tensor(candidates)
+
+    def rank(chunk_start):
+        chunk_end = min(chunk_start + chunk_size, src.shape[0])
+        # grad mode is thread local
+        with torch.no_grad():
+            return rank_chunk(scorer, src[chunk_start: chunk_end], candidates,
+                              indptr[chunk_start: chunk_end + 1] - indptr[chunk_start],
+                              targets[indptr[chunk_start]: indptr[chunk_end]],
+                              candidate_chunk_size)
+
+    chunks = range(0, src.shape[0], chunk_size)
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as pool:
+            ranks = list(pool.map(rank, chunks))
+    else:
+        ranks = [rank(chunk_start) for chunk_start in chunks]
+    return np.concatenate(ranks) if ranks else np.zeros(0)
+
+
+def ranking_metrics(ranks, hits=DEFAULT_HITS):
+    """
+    :param ranks: ranks of true targets, starting from 1
+    :param hits: values of k for Hits@k
+    :return: dictionary with mrr, hits@k and the number of ranked targets
+    """
+    metrics = {"mrr": float(np.mean(1. / ranks)) if ranks.size > 0 else 0.}
+    for k in hits:
+        metrics["hits@{}".format(k)] = float(np.mean(ranks <= k)) if ranks.size > 0 else 0.
+    metrics["num_queries"] = int(ranks.size)
+    return metrics
+
+
+def evaluate_ranking(src, candidates, indptr, targets, hits=DEFAULT_HITS, **kwargs):
+    """
+    Full-ranking evaluation: every true target is ranked against all candidates, other true targets of the same
+    source are excluded (filtered ranking). Arguments are the same as for rank_targets.
+    :return: dictionary with mrr, hits@k and the number of ranked targets
+    """
+    return ranking_metrics(rank_targets(src, candidates, indptr, targets, **kwargs), hits)
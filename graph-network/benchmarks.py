@@ -0,0 +1,972 @@
+"""
+Benchmarks for the performance critical parts of the pipeline. Every benchmark runs on a synthetic graph that
+mimics the structure of Sourcetrail exports, so no data files are required.
+
+Usage:
+    python benchmarks.py compaction --sizes 10000 100000 1000000
+    python benchmarks.py sampling --sizes 100000 1000000 --fanouts 5 10
+    python benchmarks.py sparse_embeddings --sizes 100000 1000000 --fanouts 10
+    python benchmarks.py inference --sizes 1000000 4000000 --batch_size 100000
+    python benchmarks.py embedder --sizes 100000 1000000 --batch_size 4096
+    python benchmarks.py negative_sampling --sizes 10000 100000 1000000 10000000 --batch_size 20480
+    python benchmarks.py element_lookup --sizes 100000 1000000 5000000 --batch_size 4096
+    python benchmarks.py holdout --sizes 100000 1000000 10000000
+    python benchmarks.py multitask_batch --sizes 100000 1000000 --batch_size 4096
+    python benchmarks.py scorers --sizes 3 30 300 --batch_size 4096
+    python benchmarks.py ranking --sizes 10000 100000 1000000 --batch_size 4096
+    python benchmarks.py ann --sizes 100000 1000000 --batch_size 1000 --nprobe 1 4 16
+    python benchmarks.py embedding_export --sizes 100000 1000000 --batch_size 4096
+    python benchmarks.py experiments_startup --sizes 100000 1000000
+    python benchmarks.py experiment_batches --sizes 10000 100000 1000000
+    python benchmarks.py prefetch --sizes 100000 1000000 --batches 4
+"""
+import argparse
+import multiprocessing
+import resource
+from time import perf_counter, sleep
+
+import numpy as np
+import pandas
+
+
+# Sourcetrail node and edge types that appear in python exports
+NODE_TYPES = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192]
+EDGE_TYPES = [1, 2, 4, 8, 512]
+
+
+def synthetic_graph(n_edges, avg_degree=4, seed=42):
+    """
+    Generate nodes and edges tables in the format returned by Dataset.load_data. Node ids are sparse
+    and unordered, as in real exports.
+    :param n_edges: number of edges
+    :param avg_degree: average number of edges per node
+    :param seed: random seed
+    :return: nodes, edges
+    """
+    rng = np.random.default_rng(seed)
+    n_nodes = max(n_edges // avg_degree, 2)
+
+    ids = rng.choice(n_nodes * 10, size=n_nodes, replace=False)
+    nodes = pandas.DataFrame({
+        "id": ids,
+        "type": rng.choice(NODE_TYPES, size=n_nodes),
+        "name": ["module.function_{}".format(i) for i in range(n_nodes)],
+    })
+    nodes['label'] = nodes['type']
+
+    edges = pandas.DataFrame({
+        "id": np.arange(n_edges),
+        "type": rng.choice(EDGE_TYPES, size=n_edges),
+        "src": ids[rng.integers(0, n_nodes, size=n_edges)],
+        "dst": ids[rng.integers(0, n_nodes, size=n_edges)],
+    })
+    return nodes, edges
+
+
+def timeit(fn, *args, repeat=1, **kwargs):
+    """
+    Return the best wall time of several runs and the result of the last run.
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = fn(*args, **kwargs)
+        best = min(best, perf_counter() - start)
+    return best, result
+
+
+def legacy_compaction(nodes, edges):
+    """
+    Reference implementation of id compaction with dictionaries and per row apply, as it was done in
+    SourceGraphDataset before compact_graph_ids.
+    """
+    from Dataset import compact_property
+
+    nodes = nodes.copy()
+    edges = edges.copy()
+
+    label_map = compact_property(nodes['label'])
+    nodes['compact_label'] = nodes['label'].apply(lambda old_id: label_map[old_id])
+
+    id_map = compact_property(nodes['id'])
+    nodes['graph_id'] = nodes['id'].apply(lambda old_id: id_map[old_id])
+
+    for type in nodes['type'].unique():
+        type_ind = nodes[nodes['type'] == type].index
+        type_map = compact_property(nodes.loc[type_ind, 'id'])
+        nodes.loc[type_ind, 'typed_id'] = nodes.loc[type_ind, 'id'].apply(lambda old_id: type_map[old_id])
+
+    node_type_map = dict(zip(nodes['id'].values, nodes['type']))
+    typed_map = dict(zip(nodes['id'].values, nodes['typed_id']))
+    edges['src_type'] = edges['src'].apply(lambda src_id: node_type_map[src_id])
+    edges['dst_type'] = edges['dst'].apply(lambda dst_id: node_type_map[dst_id])
+    edges['src_type_graph_id'] = edges['src'].apply(lambda src_id: id_map[src_id])
+    edges['dst_type_graph_id'] = edges['dst'].apply(lambda dst_id: id_map[dst_id])
+    edges['src_type_typed_id'] = edges['src'].apply(lambda src_id: typed_map[src_id])
+    edges['dst_type_typed_id'] = edges['dst'].apply(lambda dst_id: typed_map[dst_id])
+
+    return nodes, edges
+
+
+def legacy_hetero_graph(edges, typed_node_counts):
+    """
+    Reference implementation of heterograph construction with one query per edge signature, as it was done in
+    SourceGraphDataset.create_hetero_graph before build_hetero_graph.
+    """
+    import dgl
+
+    typed_subgraphs = {}
+    signatures = edges[['src_type', 'type', 'dst_type']].drop_duplicates(['src_type', 'type', 'dst_type'])
+
+    for ind, row in signatures.iterrows():
+        subgraph_signature = (str(row.src_type), str(row.type), str(row.dst_type))
+        subset = edges.query('src_type == %s and type==%s and dst_type==%s' % subgraph_signature)
+        typed_subgraphs[subgraph_signature] = list(
+            zip(subset['src_type_typed_id'].values.tolist(), subset['dst_type_typed_id'].values.tolist())
+        )
+
+    return dgl.heterograph(typed_subgraphs, typed_node_counts)
+
+
+def compacted_graph(size, node_types=True):
+    from Dataset import compact_graph_ids
+
+    nodes, edges = synthetic_graph(size)
+    if not node_types:
+        # same as SourceGraphDataset with node_types=False
+        nodes['type'] = 0
+    nodes, edges, _, _, _ = compact_graph_ids(nodes, edges)
+    typed_node_counts = {str(type): int(count) for type, count in nodes['type'].value_counts().items()}
+    return nodes, edges, typed_node_counts
+
+
+def bench_compaction(args):
+    from Dataset import compact_graph_ids
+
+    print("{:>10} {:>12} {:>12} {:>8}".format("edges", "legacy, s", "vector, s", "speedup"))
+    for size in args.sizes:
+        nodes, edges = synthetic_graph(size)
+
+        if size <= args.legacy_limit:
+            legacy_time, _ = timeit(legacy_compaction, nodes, edges)
+        else:
+            legacy_time = float("nan")
+        vector_time, _ = timeit(compact_graph_ids, nodes, edges, repeat=args.repeat)
+
+        print("{:>10} {:>12.3f} {:>12.3f} {:>8.1f}".format(size, legacy_time, vector_time, legacy_time / vector_time))
+
+
+def bench_heterograph(args):
+    from Dataset import build_hetero_graph
+
+    print("{:>10} {:>12} {:>12} {:>8}".format("edges", "legacy, s", "grouped, s", "speedup"))
+    for size in args.sizes:
+        nodes, edges, typed_node_counts = compacted_graph(size)
+
+        if size <= args.legacy_limit:
+            legacy_time, _ = timeit(legacy_hetero_graph, edges, typed_node_counts)
+        else:
+            legacy_time = float("nan")
+        grouped_time, _ = timeit(build_hetero_graph, edges, typed_node_counts, repeat=args.repeat)
+
+        print("{:>10} {:>12.3f} {:>12.3f} {:>8.1f}".format(size, legacy_time, grouped_time, legacy_time / grouped_time))
+
+
+def legacy_holdout(nodes, edges, holdout_frac):
+    """
+    Reference implementation of SourceGraphDataset.holdout with shuffling and per row membership tests in python sets.
+    """
+    edges_shuffled = edges.sample(frac=1., random_state=42)
+    train_frac = int(edges_shuffled.shape[0] * (1. - holdout_frac))
+    train = edges_shuffled.iloc[:train_frac]
+    test = edges_shuffled.iloc[train_frac:]
+
+    unique_nodes = set(train['src'].values.tolist() + train['dst'].values.tolist())
+    nodes = nodes[nodes['id'].apply(lambda nid: nid in unique_nodes)]
+
+    unique_nodes = set(nodes['id'].values.tolist())
+    test = test[test['src'].apply(lambda nid: nid in unique_nodes)]
+    test = test[test['dst'].apply(lambda nid: nid in unique_nodes)]
+    return nodes, train, test
+
+
+class LegacyEmbedder:
+    """
+    Reference implementation of Embedder with dictionary lookups, as it was before the id index was stored in arrays.
+    """
+    def __init__(self, id_map, embeddings):
+        self.e = embeddings
+        self.ind = id_map
+        aid, iid = zip(*id_map.items())
+        self.inv = dict(zip(iid, aid))
+
+    def __getitem__(self, key):
+        return self.e[np.array([self.ind[k] for k in key], dtype=np.int32), :]
+
+
+class LegacyElementLookup:
+    """
+    Reference implementation of ElementEmbedderBase element lookup with dictionary of lists, as it was before CSR.
+    """
+    def __init__(self, elements):
+        self.element_lookup = {}
+        for name, group in elements.groupby('id'):
+            self.element_lookup[name] = group['dst'].tolist()
+
+    def __getitem__(self, ids):
+        import random as rnd
+        return np.fromiter((rnd.choice(self.element_lookup[id]) for id in ids), dtype=np.int32)
+
+
+def in_subprocess(fn, *args):
+    """
+    Run function in a forked process and return its result. Used to measure peak memory of a single run.
+    """
+    with multiprocessing.get_context("fork").Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def peak_rss():
+    """
+    Peak resident set size of the current process in MB
+    """
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def train_rgcn_epoch(g, fanout, n_batches, batch_size, seed=42, sparse=False):
+    """
+    Train RGCN for one epoch on a surrogate objective and report epoch time and peak memory of the process.
+    Runs in a separate process, so that peak memory is not affected by other runs.
+    """
+    import torch
+    from rgcn_hetero import RGCN
+    from models import dense_parameters, add_sparse_optimizer
+
+    torch.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+
+    model = RGCN(g, h_dim=100, num_classes=100, num_bases=10, num_hidden_layers=1, sparse_embeddings=sparse)
+    optimizer = add_sparse_optimizer(torch.optim.Adam(dense_parameters(model), lr=1e-3), model, lr=1e-3)
+    sampler = model.neighbor_sampler(fanout) if fanout is not None else None
+
+    start = perf_counter()
+    for _ in range(n_batches):
+        batch = rng.choice(g.number_of_nodes(), size=batch_size, replace=False)
+        if sampler is None:
+            embeddings = model()
+        else:
+            embeddings = model.sample_embeddings(sampler, batch)
+        loss = embeddings[batch].pow(2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    epoch_time = perf_counter() - start
+
+    return epoch_time, peak_rss()
+
+
+def bench_sampling(args):
+    from Dataset import build_hetero_graph
+
+    print("{:>10} {:>8} {:>12} {:>14}".format("edges", "fanout", "epoch, s", "peak RSS, MB"))
+    for size in args.sizes:
+        nodes, edges, typed_node_counts = compacted_graph(size, node_types=False)
+        g = build_hetero_graph(edges, typed_node_counts)
+
+        for fanout in [None] + args.fanouts:
+            epoch_time, peak_memory = in_subprocess(train_rgcn_epoch, g, fanout, args.batches, args.batch_size)
+            print("{:>10} {:>8} {:>12.3f} {:>14.1f}".format(
+                size, "full" if fanout is None else fanout, epoch_time, peak_memory
+            ))
+
+
+def bench_sparse_embeddings(args):
+    from Dataset import build_hetero_graph
+
+    print("{:>10} {:>8} {:>8} {:>12} {:>14}".format("edges", "fanout", "sparse", "step, ms", "peak RSS, MB"))
+    for size in args.sizes:
+        nodes, edges, typed_node_counts = compacted_graph(size, node_types=False)
+        g = build_hetero_graph(edges, typed_node_counts)
+
+        for fanout in args.fanouts:
+            for sparse in [False, True]:
+                epoch_time, peak_memory = in_subprocess(
+                    train_rgcn_epoch, g, fanout, args.batches, args.batch_size, 42, sparse
+                )
+                print("{:>10} {:>8} {:>8} {:>12.1f} {:>14.1f}".format(
+                    size, fanout, str(sparse), epoch_time / args.batches * 1000, peak_memory
+                ))
+
+
+def rgcn_inference(g, mode, batch_size, seed=42):
+    """
+    Compute embeddings of all layers of RGCN either in memory with get_layers, or layer-wise with write_layers
+    """
+    import tempfile
+    import torch
+    from rgcn_hetero import RGCN
+
+    torch.manual_seed(seed)
+    model = RGCN(g, h_dim=100, num_classes=100, num_bases=10, num_hidden_layers=2)
+    baseline = peak_rss()
+
+    start = perf_counter()
+    with tempfile.TemporaryDirectory() as path:
+        if mode == "in memory":
+            model.get_layers()
+        elif mode == "layer-wise":
+            model.write_layers(path, batch_size=batch_size)
+        else:
+            model.write_layers(path, layers=[-1], batch_size=batch_size)
+    return perf_counter() - start, peak_rss() - baseline
+
+
+def bench_inference(args):
+    from Dataset import build_hetero_graph
+
+    print("{:>10} {:>12} {:>10} {:>16}".format("edges", "mode", "time, s", "peak RSS +, MB"))
+    for size in args.sizes:
+        nodes, edges, typed_node_counts = compacted_graph(size, node_types=False)
+        g = build_hetero_graph(edges, typed_node_counts)
+
+        for mode in ["in memory", "layer-wise", "last layer"]:
+            inference_time, peak_memory = in_subprocess(rgcn_inference, g, mode, args.batch_size)
+            print("{:>10} {:>12} {:>10.3f} {:>16.1f}".format(size, mode, inference_time, peak_memory))
+
+
+def bench_embedder(args):
+    from Embedder import Embedder
+
+    rng = np.random.default_rng(42)
+
+    print("{:>10} {:>8} {:>10} {:>14} {:>14} {:>8}".format(
+        "nodes", "ids", "init, s", "legacy, ids/s", "array, ids/s", "speedup"
+    ))
+    for size in args.sizes:
+        embeddings = rng.random((size, 100), dtype=np.float32)
+        for ids_kind, ids in [("compact", rng.permutation(size)), ("sparse", rng.choice(size * 100, size, replace=False))]:
+            id_map = dict(zip(ids.tolist(), range(size)))
+            init_time, embedder = timeit(Embedder, id_map, embeddings)
+            legacy = LegacyEmbedder(id_map, embeddings)
+
+            batch = rng.choice(ids, args.batch_size)
+            n_batches = 20
+            legacy_time, _ = timeit(lambda: [legacy[batch] for _ in range(n_batches)], repeat=args.repeat)
+            array_time, _ = timeit(lambda: [embedder[batch] for _ in range(n_batches)], repeat=args.repeat)
+
+            lookups = n_batches * args.batch_size
+            print("{:>10} {:>8} {:>10.3f} {:>14.0f} {:>14.0f} {:>8.1f}".format(
+                size, ids_kind, init_time, lookups / legacy_time, lookups / array_time, legacy_time / array_time
+            ))
+
+
+def bench_negative_sampling(args):
+    from AliasSampler import AliasSampler
+
+    rng = np.random.default_rng(42)
+    n_calls = 20
+    call_size = args.batch_size
+
+    print("{:>10} {:>10} {:>16} {:>16} {:>8}".format("values", "build, s", "choice, smpl/s", "alias, smpl/s", "speedup"))
+    for size in args.sizes:
+        values = np.arange(size)
+        counts = rng.zipf(1.5, size=size).astype(np.float64)
+        prob = counts ** 0.75
+        prob /= prob.sum()
+
+        build_time, sampler = timeit(AliasSampler, values, counts, power=0.75)
+        choice_time, _ = timeit(
+            lambda: [np.random.choice(values, call_size, replace=True, p=prob) for _ in range(n_calls)],
+            repeat=args.repeat
+        )
+        alias_time, _ = timeit(lambda: [sampler.sample(call_size) for _ in range(n_calls)], repeat=args.repeat)
+
+        samples = n_calls * call_size
+        print("{:>10} {:>10.3f} {:>16.0f} {:>16.0f} {:>8.1f}".format(
+            size, build_time, samples / choice_time, samples / alias_time, choice_time / alias_time
+        ))
+
+
+def bench_element_lookup(args):
+    import torch
+    from ElementEmbedderBase import ElementEmbedderBase
+    from ElementEmbedder import ElementEmbedder
+
+    rng = np.random.default_rng(42)
+    n_batches = 20
+
+    print("{:>10} {:>10} {:>10} {:>14} {:>14} {:>14}".format(
+        "pairs", "legacy, s", "csr, s", "legacy, ids/s", "numpy, ids/s", "torch, ids/s"
+    ))
+    for size in args.sizes:
+        n_nodes = max(size // 5, 1)
+        elements = pandas.DataFrame({
+            "id": rng.integers(0, n_nodes, size=size),
+            "dst": rng.integers(0, 1000, size=size),
+        })
+
+        legacy_build, legacy = timeit(LegacyElementLookup, elements)
+        csr_build, csr = timeit(ElementEmbedderBase, elements, compact_dst=False)
+        ee = ElementEmbedder(elements, 10, compact_dst=False)
+
+        batch = rng.choice(elements['id'].unique(), size=args.batch_size)
+        legacy_time, _ = timeit(lambda: [torch.LongTensor(legacy[batch]) for _ in range(n_batches)], repeat=args.repeat)
+        numpy_time, _ = timeit(lambda: [csr[batch] for _ in range(n_batches)], repeat=args.repeat)
+        torch_time, _ = timeit(lambda: [ee[batch] for _ in range(n_batches)], repeat=args.repeat)
+
+        lookups = n_batches * args.batch_size
+        print("{:>10} {:>10.3f} {:>10.3f} {:>14.0f} {:>14.0f} {:>14.0f}".format(
+            size, legacy_build, csr_build, lookups / legacy_time, lookups / numpy_time, lookups / torch_time
+        ))
+
+
+def bench_multitask_batch(args):
+    """
+    Latency of one multitask training step on precomputed node embeddings: three separate prepare_batch calls
+    versus the fused prepare_multitask_batch, including backward pass
+    """
+    import torch
+    import torch.nn as nn
+    from ElementEmbedder import ElementEmbedder
+    from LinkPredictor import LinkPredictor
+    from train_multitask import prepare_batch_with_embeder, prepare_batch_with_nodes, prepare_multitask_batch
+
+    rng = np.random.default_rng(42)
+    emb_size = 100
+    K = 3
+    n_steps = 10
+
+    def separate_step(node_embeddings, ees, lps, batches):
+        logits_fname, labels_fname = prepare_batch_with_embeder(node_embeddings, ees[0], lps[0], batches[0],
+                                                                batches[0].size, K)
+        logits_varuse, labels_varuse = prepare_batch_with_embeder(node_embeddings, ees[1], lps[1], batches[1],
+                                                                  batches[1].size, K)
+        logits_apicall, labels_apicall = prepare_batch_with_nodes(node_embeddings, ees[2], lps[2], batches[2],
+                                                                  batches[2].size, K)
+        logp = nn.functional.log_softmax(torch.cat([logits_fname, logits_varuse, logits_apicall], 0), 1)
+        loss = nn.functional.nll_loss(logp, torch.cat([labels_fname, labels_varuse, labels_apicall], 0))
+        loss.backward()
+
+    def fused_step(node_embeddings, ees, lps, batches):
+        logits, labels = prepare_multitask_batch(node_embeddings, *ees, *lps, *batches, K)
+        loss = sum(
+            nn.functional.nll_loss(nn.functional.log_softmax(l, 1), y) for l, y in zip(logits, labels)
+        ) / len(logits)
+        loss.backward()
+
+    print("{:>10} {:>14} {:>14} {:>8}".format("nodes", "separate, ms", "fused, ms", "speedup"))
+    for size in args.sizes:
+        node_embeddings = torch.randn(size, emb_size, requires_grad=True)
+        ees = [
+            ElementEmbedder(pandas.DataFrame({
+                "id": rng.integers(0, size, size=size), "dst": rng.integers(0, 10000, size=size)
+            }), emb_size),
+            ElementEmbedder(pandas.DataFrame({
+                "id": rng.integers(0, size, size=size), "dst": rng.integers(0, 10000, size=size)
+            }), emb_size),
+            ElementEmbedder(pandas.DataFrame({
+                "id": rng.integers(0, size, size=size), "dst": rng.integers(0, size, size=size)
+            }), emb_size, compact_dst=False),
+        ]
+        lps = [LinkPredictor(2 * emb_size) for _ in range(3)]
+        batches = [rng.choice(ee.elements['id'].unique(), size=args.batch_size) for ee in ees]
+
+        separate_time, _ = timeit(lambda: [separate_step(node_embeddings, ees, lps, batches) for _ in range(n_steps)],
+                                  repeat=args.repeat)
+        fused_time, _ = timeit(lambda: [fused_step(node_embeddings, ees, lps, batches) for _ in range(n_steps)],
+                               repeat=args.repeat)
+        print("{:>10} {:>14.1f} {:>14.1f} {:>8.2f}".format(
+            size, separate_time / n_steps * 1000, fused_time / n_steps * 1000, separate_time / fused_time
+        ))
+
+
+def bench_scorers(args):
+    """
+    Time of scoring a batch with forward and backward pass. Sizes are the number of negatives: for MLP every node has
+    this number of its own negatives, for dot product this number of negatives is shared by the batch, and positives
+    of other nodes in the batch are used as negatives as well
+    """
+    import torch
+    import torch.nn as nn
+    from LinkPredictor import LinkPredictor, PairScorer
+
+    emb_size = 100
+    n_steps = 10
+    src = torch.randn(args.batch_size, emb_size, requires_grad=True)
+    mlp = LinkPredictor(2 * emb_size)
+    dot = PairScorer(emb_size, emb_size, mode="dot")
+
+    def mlp_step(targets):
+        logits = mlp.forward_split(src, targets)
+        labels = torch.zeros(logits.shape[0], dtype=torch.long)
+        labels[:args.batch_size] = 1
+        nn.functional.nll_loss(nn.functional.log_softmax(logits, 1), labels).backward()
+
+    def shared_step(targets):
+        logits = dot.score_candidates(src, targets)
+        labels = torch.arange(args.batch_size)
+        nn.functional.nll_loss(nn.functional.log_softmax(logits, 1), labels).backward()
+
+    print("{:>10} {:>14} {:>14} {:>22}".format("negatives", "mlp, ms", "shared dot, ms", "dot negatives per node"))
+    for K in args.sizes:
+        mlp_targets = torch.randn(args.batch_size * (1 + K), emb_size, requires_grad=True)
+        shared_targets = torch.randn(args.batch_size + K, emb_size, requires_grad=True)
+
+        mlp_time, _ = timeit(lambda: [mlp_step(mlp_targets) for _ in range(n_steps)], repeat=args.repeat)
+        shared_time, _ = timeit(lambda: [shared_step(shared_targets) for _ in range(n_steps)], repeat=args.repeat)
+        print("{:>10} {:>14.1f} {:>14.1f} {:>22}".format(
+            K, mlp_time / n_steps * 1000, shared_time / n_steps * 1000, args.batch_size - 1 + K
+        ))
+
+
+def bench_ranking(args):
+    """
+    Time of full-ranking evaluation of batch_size sources with three true targets each. Sizes are the number of
+    candidates. Dot product scoring is compared on one thread and on all threads of the thread pool
+    """
+    import torch
+    from LinkPredictor import LinkPredictor
+    from RankingEvaluator import rank_targets
+
+    emb_size = 100
+    threads = torch.get_num_threads()
+    rng = np.random.default_rng(42)
+    src = torch.randn(args.batch_size, emb_size)
+    indptr = np.arange(0, 3 * args.batch_size + 1, 3)
+    mlp = LinkPredictor(2 * emb_size)
+
+    print("{:>10} {:>14} {:>18} {:>14}".format("candidates", "dot 1 thread, s", "dot {} threads, s".format(threads),
+                                             "mlp, s"))
+    for size in args.sizes:
+        candidates = torch.randn(size, emb_size)
+        targets = rng.integers(0, size, 3 * args.batch_size)
+
+        single_time, _ = timeit(rank_targets, src, candidates, indptr, targets, threads=1, repeat=args.repeat)
+        parallel_time, _ = timeit(rank_targets, src, candidates, indptr, targets, threads=threads,
+                                  repeat=args.repeat)
+        if size <= args.legacy_limit // 10:
+            with torch.no_grad():
+                mlp_time, _ = timeit(rank_targets, src, candidates, indptr, targets, scorer=mlp.score_candidates,
+                                     threads=threads, chunk_size=64, candidate_chunk_size=4096)
+        else:
+            mlp_time = float("nan")
+        print("{:>10} {:>14.3f} {:>18.3f} {:>14.3f}".format(size, single_time, parallel_time, mlp_time))
+
+
+def bench_ann(args):
+    """
+    Recall@10 and search time of IVFIndex compared with brute force search for batch_size queries. Sizes are the
+    number of indexed vectors. Vectors are drawn around random centers, as embeddings of similar nodes are clustered
+    """
+    from EmbeddingIndex import IVFIndex, brute_force_search, recall
+
+    emb_size = 100
+    rng = np.random.default_rng(42)
+
+    print("{:>10} {:>10} {:>10} {:>8} {:>10} {:>8} {:>8}".format(
+        "vectors", "build, s", "brute, ms", "nprobe", "ivf, ms", "recall", "speedup"))
+    for size in args.sizes:
+        centers = rng.normal(size=(max(size // 400, 1), emb_size)).astype(np.float32)
+        vectors = centers[rng.integers(0, centers.shape[0], size)] + \
+            0.5 * rng.normal(size=(size, emb_size)).astype(np.float32)
+        queries = vectors[rng.integers(0, size, args.batch_size)] + \
+            0.1 * rng.normal(size=(args.batch_size, emb_size)).astype(np.float32)
+
+        build_time, index = timeit(IVFIndex.build, vectors, metric="cosine")
+        brute_time, (_, true_ids) = timeit(brute_force_search, vectors, queries, k=10, metric="cosine",
+                                           chunk_size=65536, repeat=args.repeat)
+        for nprobe in args.nprobe:
+            search_time, (_, found) = timeit(index.search, queries, k=10, nprobe=nprobe, repeat=args.repeat)
+            print("{:>10} {:>10.2f} {:>10.1f} {:>8} {:>10.1f} {:>8.3f} {:>8.1f}".format(
+                size, build_time, brute_time * 1000, nprobe, search_time * 1000, recall(found, true_ids),
+                brute_time / search_time
+            ))
+
+
+def load_pickled_layer(path):
+    import pickle
+    return pickle.load(open(path, "rb"))[-1]
+
+
+def load_layer_file(path):
+    from Embedder import load_embedders
+    return load_embedders(path, layers=[-1])[0]
+
+
+def lookup_nodes(load, path, keys):
+    return load(path)[keys]
+
+
+class LegacyEmbedderState:
+    """
+    Pickles as Embedder with dictionaries ind and inv, as embeddings.pkl was written before the index was stored in
+    arrays
+    """
+    def __init__(self, e, ids):
+        self.state = {"e": e, "ind": dict(zip(ids.tolist(), range(ids.size))),
+                      "inv": dict(zip(range(ids.size), ids.tolist()))}
+
+    def __reduce__(self):
+        from Embedder import Embedder
+        return Embedder.__new__, (Embedder,), self.state
+
+
+def bench_embedding_export(args):
+    """
+    Size on disk and time to load the last of three layers and look up batch_size random nodes. Pickled formats have
+    to be unpickled completely, layer files are memory-mapped
+    """
+    import os
+    import pickle
+    import tempfile
+    from os.path import join
+    from Embedder import Embedder, convert_pickled_embedders
+
+    emb_size = 100
+    n_layers = 3
+    rng = np.random.default_rng(42)
+
+    def directory_size(path):
+        return sum(os.path.getsize(join(path, name)) for name in os.listdir(path))
+
+    print("{:>10} {:>24} {:>10} {:>10}".format("nodes", "format", "size, MB", "load, ms"))
+    for size in args.sizes:
+        ids = rng.permutation(size * 4)[:size]
+        keys = rng.choice(ids, args.batch_size)
+        layers = [rng.random((size, emb_size), dtype=np.float32) for _ in range(n_layers)]
+
+        with tempfile.TemporaryDirectory() as path:
+            pickle.dump([LegacyEmbedderState(layer, ids) for layer in layers], open(join(path, "legacy.pkl"), "wb"))
+            pickle.dump([Embedder.from_arrays(ids, np.arange(size), layer) for layer in layers],
+                        open(join(path, "embeddings.pkl"), "wb"))
+            convert_pickled_embedders(join(path, "embeddings.pkl"), join(path, "float32"))
+            convert_pickled_embedders(join(path, "embeddings.pkl"), join(path, "float16"), dtype="float16")
+            layers = None
+
+            results = [
+                ("pickle with dictionaries", os.path.getsize(join(path, "legacy.pkl")), load_pickled_layer,
+                 join(path, "legacy.pkl")),
+                ("pickle with arrays", os.path.getsize(join(path, "embeddings.pkl")), load_pickled_layer,
+                 join(path, "embeddings.pkl")),
+                ("layer files float32", directory_size(join(path, "float32")), load_layer_file,
+                 join(path, "float32")),
+                ("layer files float16", directory_size(join(path, "float16")), load_layer_file,
+                 join(path, "float16")),
+            ]
+            for name, file_size, load, file_path in results:
+                load_time, _ = in_subprocess(timeit, lookup_nodes, load, file_path, keys)
+                print("{:>10} {:>24} {:>10.1f} {:>10.1f}".format(size, name, file_size / 2 ** 20, load_time * 1000))
+
+
+def bench_holdout(args):
+    import contextlib
+    import io
+    import tempfile
+    from os.path import join
+    from Dataset import SourceGraphDataset, holdout_from_file
+
+    print("{:>10} {:>12} {:>12} {:>12} {:>8}".format("edges", "legacy, s", "vector, s", "chunked, s", "speedup"))
+    for size in args.sizes:
+        nodes, edges = synthetic_graph(size)
+
+        with contextlib.redirect_stdout(io.StringIO()), tempfile.TemporaryDirectory() as path:
+            if size <= args.legacy_limit:
+                legacy_time, _ = timeit(legacy_holdout, nodes, edges, 0.001)
+            else:
+                legacy_time = float("nan")
+            vector_time, _ = timeit(SourceGraphDataset.holdout, nodes, edges, 0.001, repeat=args.repeat)
+
+            edges.to_csv(join(path, "edges.csv"), index=False)
+            chunked_time, _ = timeit(
+                holdout_from_file, nodes, join(path, "edges.csv"), join(path, "train.csv"), join(path, "held.csv"),
+                0.001, chunksize=max(size // 10, 1)
+            )
+
+        print("{:>10} {:>12.3f} {:>12.3f} {:>12.3f} {:>8.1f}".format(
+            size, legacy_time, vector_time, chunked_time, legacy_time / vector_time
+        ))
+
+
+EXPERIMENT_SUITE = ['apicall', 'link', 'typeuse', 'varuse', 'fname', 'nodetype']
+
+
+def legacy_experiment_targets(experiments, type):
+    """
+    Target table of the experiment as it was computed before Experiments cached model files: nodes.csv and held.csv
+    are parsed for every experiment and node pool membership is checked row by row
+    """
+    nodes = pandas.read_csv(experiments.base_path + "/nodes.csv")
+    pandas.read_csv(experiments.base_path + "/held.csv")
+    node_pool = set(experiments.splits[2])
+
+    def keep(table):
+        table['src'] = table['src'].apply(lambda nid: nid if nid in node_pool else None)
+        table['dst'] = table['dst'].apply(lambda nid: nid if nid in node_pool else None)
+        return table.dropna(axis=0)
+
+    if type in {"link", "typeuse"}:
+        held = pandas.read_csv(experiments.base_path + "/held.csv")
+        return held.query('type == {}'.format(8 if type == "link" else 2))[['src', 'dst']]
+    elif type == "apicall":
+        return keep(pandas.read_csv(experiments.experiments['apicall']))
+    elif type == "varuse":
+        var_use = pandas.read_csv(experiments.experiments['varuse'])
+        return var_use[var_use['src'].apply(lambda nid: nid in node_pool)]
+    elif type == "fname":
+        functions = nodes.query('label == 4096').copy()
+        functions['src'] = functions['id']
+        functions['dst'] = functions['name'].apply(lambda name: name.split(".")[-1])
+        return functions[functions['src'].apply(lambda nid: nid in node_pool)][['src', 'dst']]
+    else:
+        types = nodes.copy()
+        types['src'] = types['id'].apply(lambda nid: nid if nid in node_pool else None)
+        types['dst'] = types['label']
+        return types.dropna(axis=0)[['src', 'dst']]
+
+
+def legacy_suite(experiments):
+    from Experiments import Experiment, Experiment2, Experiment3
+    created = []
+    for type in EXPERIMENT_SUITE:
+        target = legacy_experiment_targets(experiments, type)
+        if type in {"apicall", "link", "typeuse"}:
+            created.append(Experiment(experiments.embed, None, None, target, compact_dst=False))
+        elif type == "varuse":
+            created.append(Experiment2(experiments.embed, None, None, target))
+        elif type == "fname":
+            created.append(Experiment2(experiments.embed, None, None, target, split_on="edges"))
+        else:
+            created.append(Experiment3(experiments.embed, None, None, target, split_on="edges"))
+    return created
+
+
+def experiment_suite(experiments):
+    return [experiments[type] for type in EXPERIMENT_SUITE]
+
+
+def bench_experiments_startup(args):
+    """
+    Time to create all six experiments of run_experiment.py from a model directory. Sizes are numbers of nodes.
+    Cold start reads and filters source files, disk cache loads filtered targets stored by an earlier run, memory is
+    the second suite created from the same Experiments object
+    """
+    import contextlib
+    import io
+    import pickle
+    import tempfile
+    from os.path import join
+    import torch
+    from Embedder import Embedder
+    from Experiments import Experiments
+
+    rng = np.random.default_rng(42)
+    print("{:>10} {:>10} {:>10} {:>14} {:>10} {:>8}".format("nodes", "legacy, s", "cold, s", "disk cache, s",
+                                                           "memory, s", "speedup"))
+    for size in args.sizes:
+        nodes, edges = synthetic_graph(size * 4)
+        ids = nodes['id'].values
+        with tempfile.TemporaryDirectory() as path, contextlib.redirect_stdout(io.StringIO()):
+            nodes.to_csv(join(path, "nodes.csv"), index=False)
+            edges.query('type == 8 or type == 2').to_csv(join(path, "held.csv"), index=False)
+            edges.query('type == 1').to_csv(join(path, "calls.csv"), index=False)
+            pandas.DataFrame({"src": ids[rng.integers(0, size, size * 2)],
+                              "dst": rng.integers(0, 1000, size * 2)}).to_csv(join(path, "varuse.csv"), index=False)
+            torch.save({"splits": (None, None, rng.permutation(ids)[:size * 9 // 10])},
+                       join(path, "state_dict.pt"))
+            pickle.dump([Embedder.from_arrays(ids, np.arange(size), rng.random((size, 10), dtype=np.float32))],
+                        open(join(path, "embeddings.pkl"), "wb"))
+
+            def create(cache_targets):
+                return Experiments(base_path=path, api_seq_path=join(path, "calls.csv"),
+                                   variable_use_path=join(path, "varuse.csv"), cache_targets=cache_targets)
+
+            if size <= args.legacy_limit:
+                legacy_time, _ = timeit(lambda: legacy_suite(create(False)), repeat=args.repeat)
+            else:
+                legacy_time = float("nan")
+            cold_time, _ = timeit(lambda: experiment_suite(create(False)), repeat=args.repeat)
+            experiment_suite(create(True))
+            disk_time, _ = timeit(lambda: experiment_suite(create(True)), repeat=args.repeat)
+            experiments = create(False)
+            experiment_suite(experiments)
+            memory_time, _ = timeit(experiment_suite, experiments, repeat=args.repeat)
+
+        print("{:>10} {:>10.3f} {:>10.3f} {:>14.3f} {:>10.3f} {:>8.1f}".format(
+            size, legacy_time, cold_time, disk_time, memory_time, legacy_time / cold_time))
+
+
+def legacy_batch_nodes(experiment, indices, size=128, K=1):
+    """
+    Experiment.batch_nodes before batches were assembled for the whole epoch
+    """
+    for _ in range(indices.shape[0] // size + 1):
+        batch_ind = np.random.choice(indices, size, replace=False)
+        positive_in = experiment.embed[batch_ind]
+        positive_out = experiment.embed[experiment.ee[batch_ind]]
+        negative_in = np.repeat(positive_in, K, axis=0)
+        negative_out = experiment.embed[experiment.ee.sample_negative(size * K)]
+        X_b = np.concatenate([np.concatenate([positive_in, positive_out], axis=1),
+                              np.concatenate([negative_in, negative_out], axis=1)], axis=0)
+        yield {"x": X_b, "y": np.concatenate([np.ones(size, ), np.zeros(size * K, )])}
+
+
+def legacy_batch_edges(experiment, X, size=256, K=1):
+    """
+    Experiment2.batch_edges before batches were assembled for the whole epoch
+    """
+    for i in range(0, X.shape[0], size):
+        piece = X[i: i + size]
+        neg = experiment.get_negative_edges(piece[:, 0], experiment.unique_dst, piece.shape[0] * K)
+        X_ = np.vstack([piece, neg])
+        yield {"x": experiment.embed[X_[:, 0]], "elements": X_[:, 1],
+               "y": np.concatenate([np.ones(piece.shape[0], ), np.zeros(piece.shape[0] * K, )])}
+
+
+def legacy_batch(experiment, X, y, size=256):
+    """
+    Experiment3.batch before embeddings were looked up once
+    """
+    for i in range(0, X.shape[0], size):
+        yield {"x": experiment.embed[X[i: i + size, 0]], "y": y[i: i + size, :]}
+
+
+def drain(batches):
+    for _ in batches:
+        pass
+
+
+def bench_experiment_batches(args):
+    """
+    Time to generate one training epoch of batches for experiments of run_experiment.py, which is repeated for 500
+    epochs. Sizes are numbers of target edges, embeddings have 100 dimensions
+    """
+    import contextlib
+    import io
+    from Embedder import Embedder
+    from Experiments import Experiment, Experiment2, Experiment3
+
+    rng = np.random.default_rng(42)
+    print("{:>10} {:>10} {:>12} {:>12} {:>8}".format("edges", "experiment", "legacy, ms", "epoch, ms", "speedup"))
+    for size in args.sizes:
+        n_nodes = max(size // 2, 300)
+        ids = rng.permutation(n_nodes * 3)[:n_nodes]
+        embedder = Embedder.from_arrays(ids, np.arange(n_nodes), rng.random((n_nodes, 100), dtype=np.float32))
+        target = pandas.DataFrame({"src": ids[rng.integers(0, n_nodes, size)], "dst": ids[rng.integers(0, n_nodes, size)]})
+        labels = pandas.DataFrame({"src": ids, "dst": rng.integers(0, 10, n_nodes)})
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            link = Experiment(embedder, None, None, target.copy(), split_on="nodes", compact_dst=False)
+            fname = Experiment2(embedder, None, None, target.copy(), split_on="edges")
+            nodetype = Experiment3(embedder, None, None, labels, split_on="edges")
+            nodetype.get_training_data()
+        fname_edges = fname.target.iloc[fname.train_edge_ind][['src', 'dst']].values
+
+        cases = [
+            ("link", lambda: legacy_batch_nodes(link, link.train_nodes), link.train_batches),
+            ("fname", lambda: legacy_batch_edges(fname, fname_edges), fname.train_batches),
+            ("nodetype", lambda: legacy_batch(nodetype, nodetype.X_train, nodetype.y_train), nodetype.train_batches),
+        ]
+        for name, legacy, current in cases:
+            drain(current())
+            legacy_time, _ = timeit(lambda: drain(legacy()), repeat=args.repeat)
+            epoch_time, _ = timeit(lambda: drain(current()), repeat=args.repeat)
+            print("{:>10} {:>10} {:>12.1f} {:>12.1f} {:>8.1f}".format(
+                size, name, legacy_time * 1000, epoch_time * 1000, legacy_time / epoch_time))
+
+
+def simulated_step(weights, device_time):
+    """
+    Stand-in for a classifier training step. With device_time, the step waits as for an accelerator, otherwise it
+    computes one dense layer on CPU
+    """
+    def step(batch):
+        if device_time > 0:
+            sleep(device_time)
+        else:
+            np.maximum(batch["x"] @ weights, 0).sum()
+    return step
+
+
+def bench_prefetch(args):
+    """
+    Wall time of one training epoch of the link experiment with and without Prefetcher. Sizes are numbers of target
+    edges. The step is simulated, either on CPU or as an accelerator that takes as long as the CPU step. Overlap on
+    CPU requires at least two cores
+    """
+    import contextlib
+    import io
+    import os
+    from Embedder import Embedder
+    from Experiments import Experiment
+    from Prefetcher import Prefetcher
+
+    rng = np.random.default_rng(42)
+    weights = rng.random((200, 512), dtype=np.float32)
+    print("{} cores".format(os.cpu_count()))
+    print("{:>10} {:>12} {:>14} {:>14} {:>8}".format("edges", "step", "sequential, s", "prefetch, s", "speedup"))
+    for size in args.sizes:
+        n_nodes = max(size // 2, 300)
+        ids = rng.permutation(n_nodes * 3)[:n_nodes]
+        embedder = Embedder.from_arrays(ids, np.arange(n_nodes), rng.random((n_nodes, 100), dtype=np.float32))
+        target = pandas.DataFrame({"src": ids[rng.integers(0, n_nodes, size)],
+                                   "dst": ids[rng.integers(0, n_nodes, size)]})
+        with contextlib.redirect_stdout(io.StringIO()):
+            experiment = Experiment(embedder, None, None, target, split_on="nodes", compact_dst=False)
+
+        def epoch(batches, step):
+            for batch in batches:
+                step(batch)
+
+        batches = list(Prefetcher(experiment.train_batches))
+        n_batches = len(batches)
+        step_time, _ = timeit(lambda: [simulated_step(weights, 0)(batch) for batch in batches], repeat=args.repeat)
+        for name, step in [("cpu", simulated_step(weights, 0)),
+                           ("accelerator", simulated_step(weights, step_time / n_batches))]:
+            sequential, _ = timeit(lambda: epoch(experiment.train_batches(), step), repeat=args.repeat)
+            prefetch, _ = timeit(lambda: epoch(Prefetcher(experiment.train_batches, depth=args.batches), step),
+                                 repeat=args.repeat)
+            print("{:>10} {:>12} {:>14.3f} {:>14.3f} {:>8.2f}".format(size, name, sequential, prefetch,
+                                                                     sequential / prefetch))
+
+
+BENCHMARKS = {
+    "compaction": bench_compaction,
+    "heterograph": bench_heterograph,
+    "sampling": bench_sampling,
+    "sparse_embeddings": bench_sparse_embeddings,
+    "inference": bench_inference,
+    "embedder": bench_embedder,
+    "negative_sampling": bench_negative_sampling,
+    "element_lookup": bench_element_lookup,
+    "holdout": bench_holdout,
+    "multitask_batch": bench_multitask_batch,
+    "scorers": bench_scorers,
+    "ranking": bench_ranking,
+    "ann": bench_ann,
+    "embedding_export": bench_embedding_export,
+    "experiments_startup": bench_experiments_startup,
+    "experiment_batches": bench_experiment_batches,
+    "prefetch": bench_prefetch,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run performance benchmarks on synthetic data")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Problem sizes. Interpretation depends on the benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions, the best time is reported")
+    parser.add_argument("--legacy_limit", type=int, default=1000000,
+                        help="Skip reference implementations for sizes larger than this")
+    parser.add_argument("--fanouts", type=int, nargs="+", default=[5, 10],
+                        help="Fanouts compared with full graph training in sampling benchmark")
+    parser.add_argument("--batches", type=int, default=10, help="Number of batches per epoch")
+    parser.add_argument("--batch_size", type=int, default=1024,
+                        help="Number of seed nodes per batch, or number of nodes per chunk in inference benchmark")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16],
+                        help="Number of probed lists in ann benchmark")
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
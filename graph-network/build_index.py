@@ -0,0 +1,30 @@
+"""
+Build an approximate nearest neighbor index over node embeddings of a trained model. Embeddings are read from the
+embeddings directory written by layer-wise inference, or from embeddings.pkl for older models. The index is written
+into the model directory and can be loaded with EmbeddingIndex.IVFIndex.load.
+
+Usage:
+    python build_index.py models/RGCN-2020-05-11-10-14-50-783337 --layer -1 --metric cosine
+"""
+import argparse
+from os.path import join
+
+from Embedder import load_model_embedders
+from EmbeddingIndex import IVFIndex
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build IVF index over node embeddings of a trained model")
+    parser.add_argument("model_path", help="Directory of the trained model")
+    parser.add_argument("--layer", type=int, default=-1, help="Index of the embedding layer")
+    parser.add_argument("--metric", default="cosine", choices=["ip", "cosine"], help="Similarity function")
+    parser.add_argument("--n_lists", type=int, default=None,
+                        help="Number of inverted lists, 4 * sqrt(number of nodes) by default")
+    parser.add_argument("--output", default=None, help="Output directory, model_path/index_layer<layer> by default")
+    args = parser.parse_args()
+
+    embedder = load_model_embedders(args.model_path, [args.layer])[0]
+    index = IVFIndex.from_embedder(embedder, n_lists=args.n_lists, metric=args.metric)
+    output = args.output if args.output is not None else join(args.model_path, "index_layer{}".format(args.layer))
+    index.save(output)
+    print("Indexed {} nodes in {} lists, written to {}".format(len(index), index.centroids.shape[0], output))
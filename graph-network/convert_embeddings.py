@@ -0,0 +1,30 @@
+"""
+Convert embeddings.pkl of a trained model into the embeddings directory: one .npy file per layer, ids.npy with
+original node ids of rows and manifest.json. Layers of the directory are memory-mapped when loaded, and every layer
+can be loaded separately.
+
+Usage:
+    python convert_embeddings.py models/RGCN-2020-05-11-10-14-50-783337 --dtype float16
+"""
+import argparse
+from os.path import isdir, isfile, join
+
+from Embedder import MANIFEST_FILE, convert_pickled_embedders, export_embeddings, load_model_embedders, ids_by_row
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert pickled embeddings into memory-mappable layer files")
+    parser.add_argument("model_path", help="Directory of the trained model")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"], help="Precision of layers")
+    args = parser.parse_args()
+
+    path = join(args.model_path, "embeddings")
+    if isdir(path) and not isfile(join(path, MANIFEST_FILE)):
+        # layers written before the manifest was introduced, ids are taken from nodes.csv
+        embedder = load_model_embedders(args.model_path, [0])[0]
+        export_embeddings(path, ids_by_row(embedder.ids, embedder.rows, embedder.e.shape[0]), dtype=args.dtype)
+    elif isdir(path):
+        print("{} is already converted".format(path))
+    else:
+        convert_pickled_embedders(join(args.model_path, "embeddings.pkl"), path, dtype=args.dtype)
+    print("Embeddings written to {}".format(path))
@@ -1,5 +1,4 @@
-from Embedder import Embedder
-import pickle
+from Embedder import load_model_embedders
 import sys
 import pandas
 import numpy as np
@@ -13,21 +12,16 @@ else:
     max_embs = 5000
 
 nodes_path = os.path.join(model_path, "nodes.csv")
-embedders_path = os.path.join(model_path, "embeddings.pkl")
 
-embedders = pickle.load(open(embedders_path, "rb"))
 nodes = pandas.read_csv(nodes_path)
+embedders = load_model_embedders(model_path)
 
 ids = nodes['id'].values
 names = nodes['label'].values
 
-id_name_map = list(zip(ids, names))
-
-ind_mapper = embedders[0].ind
-
-id_name_map = sorted(id_name_map, key=lambda x: ind_mapper[x[0]])
-
-ids, names = zip(*id_name_map)
+# order names by embedding rows
+order = np.argsort(embedders[0].to_rows(ids), kind="stable")
+ids, names = ids[order], names[order]
 
 print(f"Limiting to {max_embs} embeddings")
 
@@ -12,7 +12,8 @@ import torch.nn as nn
 import dgl.function as fn
 from dgl.nn.pytorch import edge_softmax, GATConv
 # from graphtools import Embedder
-from Embedder import Embedder
+from Embedder import Embedder, layer_path, resolve_layers
+import numpy as np
 
 # import torch
 # torch.manual_seed(42)
@@ -83,3 +84,30 @@ class GAT(nn.Module):
     def get_embeddings(self, id_maps):
         return [Embedder(id_maps, e) for e in self.get_layers()]
 
+    def write_layers(self, path, layers=None):
+        """
+        Layer-wise inference. GATConv operates on the whole graph, so every layer is computed at once, but only the
+        current layer is kept in memory. Requested layers are written into .npy files.
+        :param path: directory where layer files are written
+        :param layers: indices of layers to keep, negative indices count from the last layer. None keeps all layers
+        :return: list of paths to written layers
+        """
+        keep = resolve_layers(layers, self.num_layers + 2)
+
+        training = self.training
+        self.eval()
+
+        with torch.no_grad():
+            h = self.embed
+            for layer_ind in range(keep[-1] + 1):
+                if layer_ind == self.num_layers + 1:
+                    # output projection
+                    h = self.gat_layers[-1](self.g, h).mean(1)
+                elif layer_ind > 0:
+                    h = self.gat_layers[layer_ind - 1](self.g, h).flatten(1)
+                if layer_ind in keep:
+                    np.save(layer_path(path, layer_ind), h.detach().numpy())
+
+        self.train(training)
+        return [layer_path(path, layer_ind) for layer_ind in keep]
+
@@ -0,0 +1,87 @@
+"""
+Load test for QueryServer. Every connection sends requests one after another over a kept-alive connection, latency of
+every request is measured on the client.
+
+Usage:
+    python QueryServer.py models/RGCN-2020-05-11-10-14-50-783337 --port 8081
+    python load_test.py models/RGCN-2020-05-11-10-14-50-783337 --port 8081 --connections 16 --requests 2000
+"""
+import argparse
+import asyncio
+from os.path import join
+from time import perf_counter
+
+import numpy as np
+import pandas
+
+
+async def request(reader, writer, host, target):
+    writer.write("GET {} HTTP/1.1\r\nHost: {}\r\nConnection: keep-alive\r\n\r\n".format(target, host).encode("latin-1"))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def run_connection(host, port, targets, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    for target in targets:
+        start = perf_counter()
+        statuses.append(await request(reader, writer, host, target))
+        latencies.append(perf_counter() - start)
+    writer.close()
+
+
+async def load_test(host, port, targets, connections):
+    latencies, statuses = [], []
+    start = perf_counter()
+    await asyncio.gather(*[
+        run_connection(host, port, targets[i::connections], latencies, statuses) for i in range(connections)
+    ])
+    return perf_counter() - start, np.array(latencies), np.array(statuses)
+
+
+def make_targets(ids, endpoint, num_requests, batch, k, distinct, seed=42):
+    """
+    Request targets for random nodes. Only distinct different requests are generated, the rest are repeated, so
+    that the cache is exercised
+    """
+    rng = np.random.default_rng(seed)
+    pool = [",".join(map(str, rng.choice(ids, batch))) for _ in range(min(distinct, num_requests))]
+    if endpoint == "neighbors":
+        pool = ["/neighbors?id={}&k={}".format(query, k) for query in pool]
+    else:
+        pool = ["/egonet?id={}".format(query.split(",")[0]) for query in pool]
+    return [pool[i] for i in rng.integers(0, len(pool), num_requests)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure latency of QueryServer")
+    parser.add_argument("model_path", help="Directory of the served model, used to sample node ids")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--endpoint", default="neighbors", choices=["neighbors", "egonet"])
+    parser.add_argument("--connections", type=int, default=16, help="Number of concurrent connections")
+    parser.add_argument("--requests", type=int, default=2000, help="Total number of requests")
+    parser.add_argument("--batch", type=int, default=1, help="Number of nodes per neighbors request")
+    parser.add_argument("--k", type=int, default=10, help="Number of neighbors")
+    parser.add_argument("--distinct", type=int, default=1000000,
+                        help="Number of distinct requests, smaller values increase cache hits")
+    args = parser.parse_args()
+
+    node_ids = pandas.read_csv(join(args.model_path, "nodes.csv"), usecols=['id'])['id'].values
+    request_targets = make_targets(node_ids, args.endpoint, args.requests, args.batch, args.k, args.distinct)
+
+    total, latencies, statuses = asyncio.run(load_test(args.host, args.port, request_targets, args.connections))
+    print("{} requests in {:.2f} s, {:.1f} requests/s, {} errors".format(
+        len(latencies), total, len(latencies) / total, int((statuses != 200).sum())))
+    print("latency p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+        *(np.percentile(latencies, [50, 90, 99, 100]) * 1000)))
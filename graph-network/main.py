@@ -4,169 +4,331 @@ from models import GAT, RGCN
 from datetime import datetime
 from params import gat_params, rgcn_params
 import pandas
-import pickle
 import json
+import os
+import copy
+import traceback
+import multiprocessing as mp
+from contextlib import contextmanager
 from os import mkdir
-from os.path import isdir, join
+from os.path import isdir, join, abspath
 import torch
 from Dataset import SourceGraphDataset
+from Instrumentation import Instrumentation
+from Embedder import export_embeddings, ids_by_row
+from EarlyStopping import EarlyStopping
 
 
 def get_name(model, timestamp):
     return "{} {}".format(model.__name__, timestamp).replace(":", "-").replace(" ", "-").replace(".", "-")
 
 
-def main(nodes_path, edges_path, models, desc, args):
+def load_dataset(model, nodes_path, edges_path, args):
     """
-
-    :param nodes_path:
-    :param edges_path:
-    :param models:
-    :param desc:
-    :param args:
-    :return:
+    Build dataset in the format required by the model
+    :param model: GAT or RGCN
+    :param nodes_path: path to the file with nodes
+    :param edges_path: path to the file with edges
+    :param args: command line arguments
+    :return: SourceGraphDataset
+    """
+    LABELS_FROM = "type"
+
+    if model.__name__ == "GAT":
+        dataset = SourceGraphDataset(nodes_path, edges_path, label_from=LABELS_FROM,
+                                     restore_state=args.restore_state,
+                                     cache_dir=args.cache_dir,
+                                     holdout_seed=args.holdout_seed)
+    elif model.__name__ == "RGCN":
+        dataset = SourceGraphDataset(nodes_path,
+                                     edges_path,
+                                     label_from=LABELS_FROM,
+                                     node_types=args.use_node_types,
+                                     edge_types=True,
+                                     restore_state=args.restore_state,
+                                     cache_dir=args.cache_dir,
+                                     holdout_seed=args.holdout_seed
+                                     )
+    else:
+        raise Exception("Unknown model: {}".format(model.__name__))
+    return dataset
+
+
+@contextmanager
+def working_directory(path):
+    """
+    Change working directory inside with block. Does nothing if path is None
+    """
+    if path is None:
+        yield
+        return
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def run_configuration(dataset, model, params, desc, args):
     """
+    Train the model with one set of parameters and save it into a new directory in MODELS_PATH
+    :param dataset: SourceGraphDataset
+    :param model: GAT or RGCN
+    :param params: model parameters
+    :param desc: description stored in metadata
+    :param args: command line arguments
+    :return: metadata of the trained model
+    """
+    dateTime = str(datetime.now())
+    print("\n\n")
+    print(dateTime)
+    print("Model: {}, Params: {}, Desc: {}".format(model.__name__, params, desc))
 
-    for model, param_grid in models.items():
-        for params in param_grid:
+    model_attempt = get_name(model, dateTime)
+
+    MODEL_BASE = join(MODELS_PATH, model_attempt)
+
+    if not isdir(MODEL_BASE):
+        mkdir(MODEL_BASE)
+
+    # None means training on the full graph
+    fanout = args.fanout if args.neighbor_sampling else None
+
+    # stops training when validation accuracy stalls or the time budget is spent
+    early_stopping = EarlyStopping(patience=args.patience, min_delta=args.min_delta, time_budget=args.time_budget,
+                                   max_epochs=EPOCHS)
+
+    # per epoch timings of training phases are appended to metrics.jsonl
+    with Instrumentation(join(MODEL_BASE, "metrics.jsonl"), profile=args.profile), \
+            working_directory(MODEL_BASE if args.workers > 1 else None):
+        if args.training_mode == 'node_classifier':
+
+            from train_node_classifier import training_procedure
+
+            m, scores = training_procedure(dataset, model, params, EPOCHS, args.restore_state,
+                                           early_stopping=early_stopping)
+
+        elif args.training_mode == "vector_sim":
 
-            LABELS_FROM = "type"
+            from train_vector_sim import training_procedure
 
-            dateTime = str(datetime.now())
-            print("\n\n")
-            print(dateTime)
-            print("Model: {}, Params: {}, Desc: {}".format(model.__name__, params, desc))
+            m, ee, scores = training_procedure(dataset, model, params, EPOCHS, args.restore_state, fanout,
+                                               early_stopping=early_stopping)
 
-            if model.__name__ == "GAT":
-                dataset = SourceGraphDataset(nodes_path, edges_path, label_from=LABELS_FROM,
-                                             restore_state=args.restore_state)
-            elif model.__name__ == "RGCN":
-                dataset = SourceGraphDataset(nodes_path,
-                                             edges_path,
-                                             label_from=LABELS_FROM,
-                                             node_types=args.use_node_types,
-                                             edge_types=True,
-                                             restore_state=args.restore_state
-                                             )
-            else:
-                raise Exception("Unknown model: {}".format(model.__name__))
-
-            model_attempt = get_name(model, dateTime)
-
-            MODEL_BASE = join(MODELS_PATH, model_attempt)
-
-            if not isdir(MODEL_BASE):
-                mkdir(MODEL_BASE)
-
-            if args.training_mode == 'node_classifier':
-
-                from train_node_classifier import training_procedure
-
-                m, scores = training_procedure(dataset, model, params, EPOCHS, args.restore_state)
-
-            elif args.training_mode == "vector_sim":
-
-                from train_vector_sim import training_procedure
-
-                m, ee, scores = training_procedure(dataset, model, params, EPOCHS, args.restore_state)
-
-                torch.save(
-                    {
-                        'elem_embeder': ee.state_dict(),
-                    },
-                    join(MODEL_BASE, "vector_sim.pt")
-                )
-
-            elif args.training_mode == "vector_sim_classifier":
-
-                from train_vector_sim_with_classifier import training_procedure
-
-                m, ee, lp, scores = training_procedure(dataset, model, params, EPOCHS, args.data_file,
-                                                       args.restore_state)
-
-                torch.save(
-                    {
-                        'elem_embeder': ee.state_dict(),
-                        'link_predictor': lp.state_dict(),
-                    },
-                    join(MODEL_BASE, "vector_sim_with_classifier.pt")
-                )
-
-            elif args.training_mode == "predict_next_function":
-
-                from train_vector_sim_next_call import training_procedure
-
-                m, ee, lp, scores = training_procedure(dataset, model, params, EPOCHS, args.call_seq_file,
-                                                       args.restore_state)
-
-                torch.save(
-                    {
-                        'elem_embeder': ee.state_dict(),
-                        'link_predictor': lp.state_dict(),
-                    },
-                    join(MODEL_BASE, "vector_sim_next_call.pt")
-                )
-            elif args.training_mode == "multitask":
-
-                from train_multitask import training_procedure
-
-                m, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apicall, scores = \
-                    training_procedure(dataset, model, params, EPOCHS, args.call_seq_file, args.fname_file,
-                                       args.varuse_file, args.restore_state)
-
-                torch.save(
-                    {
-                        'elem_embeder_fname': ee_fname.state_dict(),
-                        'elem_embeder_varuse': ee_varuse.state_dict(),
-                        'elem_embeder_apicall': ee_apicall.state_dict(),
-                        'link_predictor_fname': lp_fname.state_dict(),
-                        'link_predictor_varuse': lp_varuse.state_dict(),
-                        'link_predictor_apicall': lp_apicall.state_dict(),
-                    },
-                    join(MODEL_BASE, "multitask.pt")
-                )
-            else:
-                raise ValueError("Unknown training mode:", args.training_mode)
-
-            print("Saving...", end="")
-
-            params['activation'] = params['activation'].__name__
-
-            metadata = {
-                "base": MODEL_BASE,
-                "name": model_attempt,
-                "parameters": params,
-                "layers": "embeddings.pkl",
-                "mappings": "nodes.csv",
-                "state": "state_dict.pt",
-                "scores": scores,
-                "time": dateTime,
-                "description": desc,
-                "training_mode": args.training_mode,
-                "datafile": args.data_file,
-                "call_seq": args.call_seq_file,
-                "fname_file": args.fname_file,
-                "varuse_file": args.varuse_file
-            }
+            torch.save(
+                {
+                    'elem_embeder': ee.state_dict(),
+                },
+                join(MODEL_BASE, "vector_sim.pt")
+            )
+
+        elif args.training_mode == "vector_sim_classifier":
+
+            from train_vector_sim_with_classifier import training_procedure
+
+            m, ee, lp, scores = training_procedure(dataset, model, params, EPOCHS, args.data_file,
+                                                   args.restore_state, fanout, early_stopping=early_stopping)
+
+            torch.save(
+                {
+                    'elem_embeder': ee.state_dict(),
+                    'link_predictor': lp.state_dict(),
+                },
+                join(MODEL_BASE, "vector_sim_with_classifier.pt")
+            )
+
+        elif args.training_mode == "predict_next_function":
+
+            from train_vector_sim_next_call import training_procedure
+
+            m, ee, lp, scores = training_procedure(dataset, model, params, EPOCHS, args.call_seq_file,
+                                                   args.restore_state, fanout, early_stopping=early_stopping)
+
+            torch.save(
+                {
+                    'elem_embeder': ee.state_dict(),
+                    'link_predictor': lp.state_dict(),
+                },
+                join(MODEL_BASE, "vector_sim_next_call.pt")
+            )
+        elif args.training_mode == "multitask":
 
-            pickle.dump(m.get_embeddings(dataset.global_id_map), open(join(metadata['base'], metadata['layers']), "wb"))
+            from train_multitask import training_procedure
 
-            with open(join(metadata['base'], "metadata.json"), "w") as mdata:
-                mdata.write(json.dumps(metadata, indent=4))
+            m, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apicall, scores = \
+                training_procedure(dataset, model, params, EPOCHS, args.call_seq_file, args.fname_file,
+                                   args.varuse_file, args.restore_state, fanout, args.scorer, args.shared_negatives,
+                                   early_stopping=early_stopping)
 
             torch.save(
                 {
-                    'model_state_dict': m.state_dict(),
-                    'splits': dataset.splits
+                    'elem_embeder_fname': ee_fname.state_dict(),
+                    'elem_embeder_varuse': ee_varuse.state_dict(),
+                    'elem_embeder_apicall': ee_apicall.state_dict(),
+                    'link_predictor_fname': lp_fname.state_dict(),
+                    'link_predictor_varuse': lp_varuse.state_dict(),
+                    'link_predictor_apicall': lp_apicall.state_dict(),
                 },
-                join(metadata['base'], metadata['state'])
+                join(MODEL_BASE, "multitask.pt")
             )
+        else:
+            raise ValueError("Unknown training mode:", args.training_mode)
+
+    print("Saving...", end="")
+
+    params['activation'] = params['activation'].__name__
+
+    metadata = {
+        "base": MODEL_BASE,
+        "name": model_attempt,
+        "parameters": params,
+        "layers": "embeddings",
+        "mappings": "nodes.csv",
+        "state": "state_dict.pt",
+        "scores": scores,
+        "time": dateTime,
+        "description": desc,
+        "training_mode": args.training_mode,
+        "datafile": args.data_file,
+        "call_seq": args.call_seq_file,
+        "fname_file": args.fname_file,
+        "varuse_file": args.varuse_file,
+        "fanout": fanout,
+        "scorer": args.scorer,
+        "shared_negatives": args.shared_negatives,
+        "metrics": "metrics.jsonl",
+        "embedding_dtype": args.embedding_dtype,
+        "early_stopping": early_stopping.report()
+    }
+
+    mkdir(join(metadata['base'], metadata['layers']))
+    m.write_layers(join(metadata['base'], metadata['layers']))
+    # rows of layers are global graph ids
+    export_embeddings(join(metadata['base'], metadata['layers']),
+                      ids_by_row(dataset.nodes['id'].values, dataset.nodes['global_graph_id'].values),
+                      dtype=args.embedding_dtype)
+
+    with open(join(metadata['base'], "metadata.json"), "w") as mdata:
+        mdata.write(json.dumps(metadata, indent=4))
+
+    torch.save(
+        {
+            'model_state_dict': m.state_dict(),
+            'splits': dataset.splits
+        },
+        join(metadata['base'], metadata['state'])
+    )
+
+    dataset.nodes.to_csv(join(metadata['base'], "nodes.csv"), index=False)
+    dataset.edges.to_csv(join(metadata['base'], "edges.csv"), index=False)
+    dataset.held.to_csv(join(metadata['base'], "held.csv"), index=False)
+
+    print("done")
+
+    return metadata
+
+
+# datasets for the grid, worker processes inherit them from the parent when they are forked
+_grid_datasets = None
+
+
+def init_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def run_in_worker(task):
+    model, params, desc, args = task
+    try:
+        return run_configuration(_grid_datasets[model.__name__], model, params, desc, args)
+    except Exception:
+        # a failed configuration should not stop the rest of the grid
+        traceback.print_exc()
+        return {"name": model.__name__, "parameters": params, "error": traceback.format_exc().strip().splitlines()[-1]}
+
+
+def run_parallel(datasets, configurations, desc, args):
+    """
+    Run configurations in a pool of forked processes. Datasets are not serialized, workers share the memory of the
+    parent process copy-on-write. Every worker trains one configuration using threads_per_worker threads, and
+    trains in the directory of its model, so that checkpoints of different runs do not overwrite each other.
+    :param datasets: dictionary with datasets for every model name
+    :param configurations: list of (model, params)
+    :param desc: description stored in metadata
+    :param args: command line arguments
+    :return: list of metadata, in the order of completion
+    """
+    global _grid_datasets, MODELS_PATH
+    _grid_datasets = datasets
+
+    # workers change the working directory, relative paths are resolved beforehand
+    MODELS_PATH = abspath(MODELS_PATH)
+    args = copy.copy(args)
+    for attr in ["data_file", "call_seq_file", "fname_file", "varuse_file"]:
+        if getattr(args, attr) is not None:
+            setattr(args, attr, abspath(getattr(args, attr)))
+
+    threads = args.threads_per_worker or max(1, os.cpu_count() // args.workers)
+    tasks = [(model, params, desc, args) for model, params in configurations]
+
+    # a new process for every configuration releases memory of the previous run
+    with mp.get_context("fork").Pool(args.workers, initializer=init_worker, initargs=(threads,),
+                                      maxtasksperchild=1) as pool:
+        results = list(pool.imap_unordered(run_in_worker, tasks))
+
+    _grid_datasets = None
+    return results
+
+
+def write_summary(results, path):
+    """
+    Write one row with parameters and scores for every trained model
+    :param results: list of metadata returned by run_configuration
+    :param path: path to csv file
+    :return: summary table
+    """
+    rows = []
+    for metadata in results:
+        row = {"name": metadata["name"], "error": metadata.get("error", "")}
+        row.update({"param_" + key: value for key, value in metadata["parameters"].items()})
+        row.update(metadata.get("scores", {}))
+        row.update(metadata.get("early_stopping", {}))
+        rows.append(row)
+    summary = pandas.DataFrame(rows)
+    summary.to_csv(path, index=False)
+    return summary
+
+
+def main(nodes_path, edges_path, models, desc, args):
+    """
+
+    :param nodes_path:
+    :param edges_path:
+    :param models:
+    :param desc:
+    :param args:
+    :return:
+    """
+
+    if args.workers > 1 and args.restore_state:
+        raise ValueError("Restoring state is not supported when configurations are trained in parallel")
+
+    # dataset is built once for every model and reused for all parameters
+    datasets = {}
+    configurations = []
+    for model, param_grid in models.items():
+        datasets[model.__name__] = load_dataset(model, nodes_path, edges_path, args)
+        configurations.extend((model, params) for params in param_grid)
 
-            dataset.nodes.to_csv(join(metadata['base'], "nodes.csv"), index=False)
-            dataset.edges.to_csv(join(metadata['base'], "edges.csv"), index=False)
-            dataset.held.to_csv(join(metadata['base'], "held.csv"), index=False)
+    if args.workers > 1:
+        results = run_parallel(datasets, configurations, desc, args)
+    else:
+        results = [run_configuration(datasets[model.__name__], model, params, desc, args)
+                   for model, params in configurations]
 
-            print("done")
+    summary_name = "grid {}".format(datetime.now()).replace(":", "-").replace(" ", "-").replace(".", "-")
+    summary = write_summary(results, join(MODELS_PATH, summary_name + ".csv"))
+    print(summary.to_string())
 
 
 if __name__ == "__main__":
@@ -190,6 +352,35 @@ if __name__ == "__main__":
                         help='Path to the file with edges that are used for training')
     parser.add_argument('--use_node_types', action='store_true')
     parser.add_argument('--restore_state', action='store_true')
+    parser.add_argument('--neighbor_sampling', action='store_true',
+                        help='Compute node embeddings only for the sampled neighborhood of nodes in the current batch instead of the full graph. Supported for RGCN')
+    parser.add_argument('--fanout', dest='fanout', default=10, type=int,
+                        help='Number of sampled incoming edges per relation and layer when --neighbor_sampling is used, -1 for all edges')
+    parser.add_argument('--cache_dir', dest='cache_dir', default=None,
+                        help='Directory for binary cache of preprocessed datasets. Repeated runs with the same data and parameters load the dataset from cache')
+
+    parser.add_argument('--holdout_seed', dest='holdout_seed', default=42, type=int,
+                        help='Random seed for the split of edges into train and holdout sets')
+
+    parser.add_argument('--profile', action='store_true',
+                        help='Record torch profiler trace for the first epoch. The trace is stored in the model directory next to metrics.jsonl')
+
+    parser.add_argument('--scorer', dest='scorer', default='mlp', choices=['mlp', 'dot', 'distmult', 'bilinear'],
+                        help='Function that scores node pairs in multitask training')
+    parser.add_argument('--shared_negatives', dest='shared_negatives', default=None, type=int,
+                        help='Score every node against in-batch negatives and this number of shared negatives in multitask training. Requires scorer other than mlp')
+    parser.add_argument('--embedding_dtype', dest='embedding_dtype', default='float32', choices=['float32', 'float16'],
+                        help='Precision of exported node embeddings. float16 halves the size of embedding files')
+    parser.add_argument('--workers', dest='workers', default=1, type=int,
+                        help='Number of processes that train configurations from the parameter grid in parallel')
+    parser.add_argument('--threads_per_worker', dest='threads_per_worker', default=None, type=int,
+                        help='Number of torch threads in every worker process. By default CPU cores are divided equally between workers')
+    parser.add_argument('--patience', dest='patience', default=None, type=int,
+                        help='Stop training when validation accuracy did not improve for this number of epochs. By default all epochs are trained')
+    parser.add_argument('--min_delta', dest='min_delta', default=0., type=float,
+                        help='Smallest change of validation accuracy that counts as improvement for --patience')
+    parser.add_argument('--time_budget', dest='time_budget', default=None, type=float,
+                        help='Stop training of every configuration after this number of seconds')
 
     args = parser.parse_args()
 
@@ -8,3 +8,75 @@ import numpy as np
 
 from gat import GAT
 from rgcn_hetero import RGCN
+
+
+def create_sampler(model, fanout):
+    """
+    Create neighbor sampler for mini-batch training
+    :param model: GNN model
+    :param fanout: number of sampled neighbors per relation, None for training on the full graph
+    :return: NeighborSampler or None
+    """
+    if fanout is None:
+        return None
+    if not hasattr(model, "neighbor_sampler"):
+        raise ValueError("Neighbor sampling is not supported for model:", model.__class__.__name__)
+    return model.neighbor_sampler(fanout)
+
+
+def sparse_parameters(model):
+    """
+    :param model: torch module
+    :return: list of parameters of embedding tables that produce sparse gradients
+    """
+    return [module.weight for module in model.modules() if isinstance(module, nn.Embedding) and module.sparse]
+
+
+def dense_parameters(model):
+    """
+    :param model: torch module
+    :return: list of parameters that produce dense gradients, regular optimizers should be created for these
+    """
+    sparse = set(id(p) for p in sparse_parameters(model))
+    return [p for p in model.parameters() if id(p) not in sparse]
+
+
+class CombinedOptimizer:
+    """
+    Steps a dense optimizer and an optimizer for sparse parameters together. Exposes the part of the optimizer
+    interface that is used by training procedures.
+    """
+    def __init__(self, dense, sparse):
+        self.dense = dense
+        self.sparse = sparse
+
+    def zero_grad(self):
+        self.dense.zero_grad()
+        self.sparse.zero_grad()
+
+    def step(self):
+        self.dense.step()
+        self.sparse.step()
+
+    def state_dict(self):
+        return {"dense": self.dense.state_dict(), "sparse": self.sparse.state_dict()}
+
+    def load_state_dict(self, state_dict):
+        self.dense.load_state_dict(state_dict["dense"])
+        self.sparse.load_state_dict(state_dict["sparse"])
+
+
+def add_sparse_optimizer(optimizer, model, lr=0.01):
+    """
+    Add SparseAdam for embedding tables of the model that have sparse gradients. Dense optimizers do not support
+    sparse gradients, or update all rows of the table on every step. SparseAdam updates only rows that received
+    gradients, so the cost of the step depends on the batch and not on the size of the graph.
+    :param optimizer: optimizer for parameters returned by dense_parameters
+    :param model: GNN model
+    :param lr: learning rate for sparse parameters
+    :return: optimizer, unchanged if the model does not have sparse parameters
+    """
+    sparse = sparse_parameters(model)
+    if len(sparse) == 0:
+        return optimizer
+    return CombinedOptimizer(optimizer, torch.optim.SparseAdam(sparse, lr=lr))
@@ -89,7 +89,9 @@ rgcn_grids = [
         'num_hidden_layers': [1],
         'dropout': [0.3],
         'use_self_loop': [False],
-        'activation': [torch.nn.functional.hardtanh] #torch.nn.functional.leaky_relu
+        'activation': [torch.nn.functional.hardtanh], #torch.nn.functional.leaky_relu
+        'sparse_embeddings': [False],
+        'embed_mode': ['relation'] # 'shared' uses one embedding table per node type
     }
 ]
 
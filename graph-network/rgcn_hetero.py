@@ -11,13 +11,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 from functools import partial
 # from graphtools import Embedder
-from Embedder import Embedder
+from Embedder import Embedder, layer_path, resolve_layers, remove_layer
 
 # import torch
 # torch.manual_seed(42)
 
+import dgl
 import dgl.function as fn
-from dgl.data.rdf import AIFB, MUTAG, BGS, AM
 
 
 class RelGraphConvHetero(nn.Module):
@@ -112,9 +112,9 @@ class RelGraphConvHetero(nn.Module):
         Parameters
         ----------
         g : DGLHeteroGraph
-            Input graph.
+            Input graph or block produced by NeighborSampler.
         xs : list of torch.Tensor
-            Node feature for each node type.
+            Node feature for each (source) node type.
 
         Returns
         -------
@@ -122,23 +122,24 @@ class RelGraphConvHetero(nn.Module):
             New node features for each node type.
         """
         g = g.local_var()
-        for i, ntype in enumerate(g.ntypes):
-            g.nodes[ntype].data['x'] = xs[i]
+        for i, ntype in enumerate(g.srctypes):
+            g.srcnodes[ntype].data['x'] = xs[i]
         ws = self.basis_weight()
         funcs = {}
         for i, (srctype, etype, dsttype) in enumerate(g.canonical_etypes):
-            g.nodes[srctype].data['h%d' % i] = th.matmul(
-                g.nodes[srctype].data['x'], ws[etype])
+            g.srcnodes[srctype].data['h%d' % i] = th.matmul(
+                g.srcnodes[srctype].data['x'], ws[etype])
             funcs[(srctype, etype, dsttype)] = (fn.copy_u('h%d' % i, 'm'), fn.mean('m', 'h'))
         # message passing
         g.multi_update_all(funcs, 'sum')
 
-        hs = [g.nodes[ntype].data['h'] for ntype in g.ntypes]
+        hs = [g.dstnodes[ntype].data['h'] for ntype in g.dsttypes]
         for i in range(len(hs)):
             h = hs[i]
             # apply bias and activation
             if self.self_loop:
-                h = h + th.matmul(xs[i], self.loop_weight)
+                # for blocks, destination nodes are the first source nodes
+                h = h + th.matmul(xs[i][:h.shape[0]], self.loop_weight)
             if self.bias:
                 h = h + self.h_bias
             if self.activation:
@@ -148,6 +149,36 @@ class RelGraphConvHetero(nn.Module):
         return hs
 
 
+def create_embedding_table(num_nodes, embed_size, sparse):
+    """
+    Create trainable embeddings for nodes
+    :param num_nodes: number of rows
+    :param embed_size: number of columns
+    :param sparse: if True, the table is nn.Embedding with sparse gradients, otherwise dense nn.Parameter
+    """
+    if sparse:
+        table = nn.Embedding(num_nodes, embed_size, sparse=True)
+        nn.init.xavier_uniform_(table.weight, gain=nn.init.calculate_gain('relu'))
+    else:
+        table = nn.Parameter(th.Tensor(num_nodes, embed_size))
+        nn.init.xavier_uniform_(table, gain=nn.init.calculate_gain('relu'))
+    return table
+
+
+def lookup_embeddings(table, ids=None):
+    """
+    Read rows of embedding table created by create_embedding_table
+    :param table: nn.Parameter or nn.Embedding
+    :param ids: tensor with row indices, None for all rows
+    """
+    if isinstance(table, nn.Embedding):
+        # rows are always read through the lookup, so that the gradient stays sparse
+        if ids is None:
+            ids = th.arange(table.num_embeddings)
+        return table(ids)
+    return table if ids is None else table[ids]
+
+
 class RelGraphConvHeteroEmbed(nn.Module):
     r"""Embedding layer for featureless heterograph."""
 
@@ -157,20 +188,48 @@ class RelGraphConvHeteroEmbed(nn.Module):
                  bias=True,
                  activation=None,
                  self_loop=False,
-                 dropout=0.0):
+                 dropout=0.0,
+                 sparse=False,
+                 mode="relation",
+                 num_bases=None):
+        """
+
+        :param sparse: store node embeddings in nn.Embedding with sparse gradients. Only rows of nodes that
+            participate in the forward pass receive gradients, which allows to update them with a sparse optimizer
+            (see models.add_sparse_optimizer)
+        :param mode: "relation" - every canonical edge type has its own table of source node embeddings,
+            "shared" - every node type has one table, and relations transform the shared embeddings with weights
+            that are combined from num_bases basis matrices. Memory for node embeddings does not depend on the
+            number of relations in the shared mode
+        :param num_bases: number of basis matrices in the shared mode, None for one matrix per relation
+        """
         super(RelGraphConvHeteroEmbed, self).__init__()
         self.embed_size = embed_size
         self.g = g
         self.bias = bias
         self.activation = activation
         self.self_loop = self_loop
-
-        # create weight embeddings for each node for each relation
-        self.embeds = nn.ParameterDict()
-        for srctype, etype, dsttype in g.canonical_etypes:
-            embed = nn.Parameter(th.Tensor(g.number_of_nodes(srctype), self.embed_size))
-            nn.init.xavier_uniform_(embed, gain=nn.init.calculate_gain('relu'))
-            self.embeds["{}-{}-{}".format(srctype, etype, dsttype)] = embed
+        self.sparse = sparse
+        self.mode = mode
+
+        if mode == "relation":
+            # create weight embeddings for each node for each relation
+            self.embeds = nn.ModuleDict() if sparse else nn.ParameterDict()
+            for srctype, etype, dsttype in g.canonical_etypes:
+                self.embeds["{}-{}-{}".format(srctype, etype, dsttype)] = create_embedding_table(
+                    g.number_of_nodes(srctype), self.embed_size, sparse
+                )
+        elif mode == "shared":
+            self.node_embeds = nn.ModuleDict() if sparse else nn.ParameterDict()
+            for ntype in g.ntypes:
+                self.node_embeds[ntype] = create_embedding_table(g.number_of_nodes(ntype), self.embed_size, sparse)
+            # relation specific transformation of shared embeddings, including self loop
+            rel_names = sorted(set(g.etypes))
+            self.projection = RelGraphConvHetero(
+                embed_size, embed_size, rel_names, "basis", num_bases, bias=False, self_loop=self_loop
+            )
+        else:
+            raise ValueError("Unknown embedding mode:", mode)
 
         # bias
         if self.bias:
@@ -178,37 +237,53 @@ class RelGraphConvHeteroEmbed(nn.Module):
             nn.init.zeros_(self.h_bias)
 
         # weight for self loop
-        if self.self_loop:
-            self.self_embeds = nn.ParameterList()
+        if self.self_loop and mode == "relation":
+            self.self_embeds = nn.ModuleList() if sparse else nn.ParameterList()
             for ntype in g.ntypes:
-                embed = nn.Parameter(th.Tensor(g.number_of_nodes(ntype), embed_size))
-                nn.init.xavier_uniform_(embed,
-                                        gain=nn.init.calculate_gain('relu'))
-                self.self_embeds.append(embed)
+                self.self_embeds.append(create_embedding_table(g.number_of_nodes(ntype), embed_size, sparse))
 
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self):
+    def forward(self, block=None):
         """ Forward computation
 
+        Parameters
+        ----------
+        block : DGLHeteroGraph, optional
+            Block produced by NeighborSampler. If None, features are computed for all nodes of the graph.
+
         Returns
         -------
         torch.Tensor
             New node features.
         """
-        g = self.g.local_var()
-        funcs = {}
-        for i, (srctype, etype, dsttype) in enumerate(g.canonical_etypes):
-            g.nodes[srctype].data['embed-%d' % i] = self.embeds["{}-{}-{}".format(srctype, etype, dsttype)]
-            funcs[(srctype, etype, dsttype)] = (fn.copy_u('embed-%d' % i, 'm'), fn.mean('m', 'h'))
-        g.multi_update_all(funcs, 'sum')
+        g = self.g.local_var() if block is None else block.local_var()
+
+        if self.mode == "shared":
+            hs = self.projection(g, [
+                lookup_embeddings(self.node_embeds[ntype], None if block is None else g.srcnodes[ntype].data[dgl.NID])
+                for ntype in g.srctypes
+            ])
+        else:
+            funcs = {}
+            for i, (srctype, etype, dsttype) in enumerate(g.canonical_etypes):
+                embed = lookup_embeddings(
+                    self.embeds["{}-{}-{}".format(srctype, etype, dsttype)],
+                    None if block is None else g.srcnodes[srctype].data[dgl.NID]
+                )
+                g.srcnodes[srctype].data['embed-%d' % i] = embed
+                funcs[(srctype, etype, dsttype)] = (fn.copy_u('embed-%d' % i, 'm'), fn.mean('m', 'h'))
+            g.multi_update_all(funcs, 'sum')
+
+            hs = [g.dstnodes[ntype].data['h'] for ntype in g.dsttypes]
 
-        hs = [g.nodes[ntype].data['h'] for ntype in g.ntypes]
         for i in range(len(hs)):
             h = hs[i]
             # apply bias and activation
-            if self.self_loop:
-                h = h + self.self_embeds[i]
+            if self.self_loop and self.mode == "relation":
+                h = h + lookup_embeddings(
+                    self.self_embeds[i], None if block is None else g.dstnodes[g.dsttypes[i]].data[dgl.NID]
+                )
             if self.bias:
                 h = h + self.h_bias
             if self.activation:
@@ -218,6 +293,79 @@ class RelGraphConvHeteroEmbed(nn.Module):
         return hs
 
 
+class NeighborSampler:
+    """
+    Samples blocks (message flow graphs) for mini-batch training. Starting from seed nodes, incoming edges of every
+    relation are sampled with the given fanout, and the sampled frontier is converted into a block. The source nodes
+    of the block become seeds for the previous layer.
+
+    Node ids are global graph ids, i.e. typed ids shifted by the number of nodes of preceding types in g.ntypes,
+    the same as SourceGraphDataset.global_id_map.
+    """
+    def __init__(self, g, fanouts):
+        """
+
+        :param g: DGLHeteroGraph
+        :param fanouts: number of sampled incoming edges per relation for every block, -1 to take all edges
+        """
+        self.g = g
+        self.fanouts = fanouts
+
+        self.offsets = []
+        offset = 0
+        for ntype in g.ntypes:
+            self.offsets.append(offset)
+            offset += g.number_of_nodes(ntype)
+        self.offsets.append(offset)
+
+    def to_typed(self, global_ids):
+        """
+        Convert sorted global ids into dictionary of typed ids
+        """
+        bounds = np.searchsorted(global_ids, self.offsets)
+        return {
+            ntype: th.from_numpy(global_ids[bounds[i]: bounds[i + 1]] - self.offsets[i])
+            for i, ntype in enumerate(self.g.ntypes) if bounds[i] < bounds[i + 1]
+        }
+
+    def sample_blocks(self, seeds):
+        """
+        :param seeds: sorted array of unique global ids
+        :return: list of blocks, the first block corresponds to the embedding layer
+        """
+        seeds = self.to_typed(seeds)
+        blocks = []
+        for fanout in reversed(self.fanouts):
+            if fanout < 0:
+                frontier = dgl.in_subgraph(self.g, seeds)
+            else:
+                frontier = dgl.sampling.sample_neighbors(self.g, seeds, fanout)
+            block = dgl.to_block(frontier, seeds)
+            seeds = {ntype: block.srcnodes[ntype].data[dgl.NID] for ntype in block.srctypes}
+            blocks.insert(0, block)
+        return blocks
+
+
+class SampledEmbeddings:
+    """
+    Embeddings computed for a subset of nodes. Can be indexed with global graph ids, the same way as the tensor with
+    embeddings of all nodes.
+    """
+    def __init__(self, ids, embeddings):
+        """
+
+        :param ids: sorted array of unique global graph ids
+        :param embeddings: tensor where row i stores embedding of the node ids[i]
+        """
+        self.ids = ids
+        self.embeddings = embeddings
+
+    def __getitem__(self, ids):
+        if isinstance(ids, th.Tensor):
+            ids = ids.numpy()
+        return self.embeddings[th.from_numpy(np.searchsorted(self.ids, ids))]
+
+
 class RGCN(nn.Module):
     def __init__(self,
                  g,
@@ -226,7 +374,16 @@ class RGCN(nn.Module):
                  num_hidden_layers=1,
                  dropout=0,
                  use_self_loop=False,
-                 activation=F.relu):
+                 activation=F.relu,
+                 sparse_embeddings=False,
+                 embed_mode="relation"):
+        """
+
+        :param sparse_embeddings: use sparse gradients for node embeddings of the input layer. Optimizers should be
+            created with models.add_sparse_optimizer
+        :param embed_mode: "relation" for separate node embeddings for every relation in the input layer, "shared"
+            for one embedding table per node type with relation weights decomposed into num_bases bases
+        """
         # TODO
         # 1. Parameter activation is not used
         super(RGCN, self).__init__()
@@ -241,10 +398,12 @@ class RGCN(nn.Module):
         self.dropout = dropout
         self.use_self_loop = use_self_loop
         self.activation = activation
+        self.sparse_embeddings = sparse_embeddings
+        self.embed_mode = embed_mode
 
         self.embed_layer = RelGraphConvHeteroEmbed(
             self.h_dim, g, activation=self.activation, self_loop=self.use_self_loop,
-            dropout=self.dropout)
+            dropout=self.dropout, sparse=self.sparse_embeddings, mode=self.embed_mode, num_bases=self.num_bases)
         self.layers = nn.ModuleList()
         # h2h
         for i in range(self.num_hidden_layers):
@@ -260,14 +419,45 @@ class RGCN(nn.Module):
 
         self.emb_size = out_dim
 
-    def forward(self):
-        h = self.embed_layer()
-        for layer in self.layers:
-            h = layer(self.g, h)
+    def forward(self, blocks=None):
+        """
+        Compute node embeddings
+        :param blocks: list of blocks produced by NeighborSampler, one for the embedding layer and one for every
+            following layer. If None, embeddings are computed for all nodes in the graph.
+        :return: tensor with embeddings of all nodes, or of destination nodes of the last block, ordered by global id
+        """
+        if blocks is None:
+            h = self.embed_layer()
+            for layer in self.layers:
+                h = layer(self.g, h)
+        else:
+            h = self.embed_layer(blocks[0])
+            for layer, block in zip(self.layers, blocks[1:]):
+                h = layer(block, h)
 
         h = torch.cat(h, dim=0)
         return h
 
+    @property
+    def num_blocks(self):
+        """
+        Number of message passing steps, including the embedding layer
+        """
+        return len(self.layers) + 1
+
+    def neighbor_sampler(self, fanout):
+        return NeighborSampler(self.g, [fanout] * self.num_blocks)
+
+    def sample_embeddings(self, sampler, seeds):
+        """
+        Compute embeddings only for the receptive field of seed nodes
+        :param sampler: NeighborSampler
+        :param seeds: global graph ids of nodes for which embeddings are needed
+        :return: SampledEmbeddings that can be indexed with global graph ids of seed nodes
+        """
+        seeds = np.unique(np.asarray(seeds, dtype=np.int64))
+        return SampledEmbeddings(seeds, self(sampler.sample_blocks(seeds)))
+
     def get_layers(self):
         """
         Retrieve tensor values on the layers for further use as node embeddings.
@@ -284,3 +474,54 @@ class RGCN(nn.Module):
     def get_embeddings(self, id_maps):
         return [Embedder(id_maps, e) for e in self.get_layers()]
 
+    def write_layers(self, path, layers=None, batch_size=10000):
+        """
+        Layer-wise inference. Layers are computed one after another for chunks of batch_size nodes, using full
+        neighborhoods. Every layer is written into a memory-mapped .npy file and the next layer reads its inputs from
+        this file, so only one chunk of embeddings is kept in memory.
+        :param path: directory where layer files are written
+        :param layers: indices of layers to keep, negative indices count from the last layer. Layers that are not
+            requested, but needed to compute the requested ones, are removed after use. None keeps all layers
+        :param batch_size: number of nodes in one chunk
+        :return: list of paths to written layers
+        """
+        keep = resolve_layers(layers, self.num_blocks)
+        sampler = self.neighbor_sampler(-1)
+        num_nodes = sampler.offsets[-1]
+
+        training = self.training
+        self.eval()
+
+        previous = None
+        with torch.no_grad():
+            for layer_ind in range(keep[-1] + 1):
+                layer = self.embed_layer if layer_ind == 0 else self.layers[layer_ind - 1]
+                out_dim = self.h_dim if layer_ind == 0 else layer.out_feat
+                out = np.lib.format.open_memmap(
+                    layer_path(path, layer_ind), mode="w+", dtype=np.float32, shape=(num_nodes, out_dim)
+                )
+
+                for start in range(0, num_nodes, batch_size):
+                    end = min(start + batch_size, num_nodes)
+                    seeds = sampler.to_typed(np.arange(start, end))
+                    block = dgl.to_block(dgl.in_subgraph(self.g, seeds), seeds)
+                    if layer_ind == 0:
+                        h = layer(block)
+                    else:
+                        # source nodes of every type are read from the previous layer by their global ids
+                        h = layer(block, [
+                            th.from_numpy(previous[block.srcnodes[ntype].data[dgl.NID].numpy() + sampler.offsets[i]])
+                            for i, ntype in enumerate(block.srctypes)
+                        ])
+                    out[start: end] = torch.cat(h, dim=0).numpy()
+
+                out.flush()
+                del out
+                previous = None
+                if layer_ind > 0 and layer_ind - 1 not in keep:
+                    remove_layer(path, layer_ind - 1)
+                previous = np.load(layer_path(path, layer_ind), mmap_mode="r")
+
+        self.train(training)
+        return [layer_path(path, layer_ind) for layer_ind in keep]
+
@@ -4,12 +4,18 @@ os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
 # os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 from Experiments import Experiments, Experiment
+from Embedder import attach_embedder, share_embedder
+from Prefetcher import Prefetcher
+from EarlyStopping import EarlyStopping
 import argparse
+import multiprocessing
+from time import perf_counter
 
 from classifiers import LRClassifier, NNClassifier, ElementPredictor, NodeClassifier
 import tensorflow as tf; tf.get_logger().setLevel('ERROR')
 import numpy as np
-from copy import deepcopy
+import pandas
+from copy import copy
 
 parser = argparse.ArgumentParser(description="""
 apicall creates an experiment where we try to predict the exstense of "next call" link between nodes. 
@@ -22,7 +28,35 @@ apicall creates an experiment where we try to predict the exstense of "next call
 #                     help='Select experiment [apicall|link|typeuse|varuse|fname|nodetype]')
 parser.add_argument("--base_path", default=None, help="path to the trained GNN model")
 parser.add_argument('--random', action='store_true')
-args = parser.parse_args()
+parser.add_argument('--ranking', action='store_true',
+                    help='Also report MRR and Hits@k of dot product ranking against all targets for experiments where '
+                         'targets are nodes')
+parser.add_argument('--cache_targets', action='store_true',
+                    help='Store filtered target tables of experiments in the model directory and reuse them in later runs')
+parser.add_argument('--prefetch', type=int, default=4,
+                    help='Number of batches that are prepared in a background thread while the classifier is trained, '
+                         '0 disables prefetching')
+parser.add_argument('--prefetch_workers', type=int, default=1,
+                    help='Number of threads that convert prefetched batches into tensors')
+parser.add_argument('--experiments', nargs='+', default=['apicall', 'link', 'typeuse', 'varuse', 'fname', 'nodetype'],
+                    help='Experiments of the suite')
+parser.add_argument('--baseline', action='store_true',
+                    help='Also run every experiment with random embeddings')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of processes that run experiments concurrently, 1 runs them one after another')
+parser.add_argument('--threads', type=int, default=None,
+                    help='Number of intra-op threads of every worker, number of cores divided by workers by default')
+parser.add_argument('--results', default=None, help='Path of the csv file with the results table')
+parser.add_argument('--patience', type=int, default=None,
+                    help='Stop training of a classifier when the monitored metric did not improve for this number of '
+                         'epochs. Experiments have no validation split, the metric is computed on the test split. By '
+                         'default all epochs are trained')
+parser.add_argument('--min_delta', type=float, default=0.,
+                    help='Smallest change of the monitored metric that counts as improvement')
+parser.add_argument('--time_budget', type=float, default=None,
+                    help='Stop training of a classifier after this number of seconds')
+parser.add_argument('--monitor', default='accuracy', choices=['accuracy', 'loss'],
+                    help='Metric that is monitored for early stopping: moving average of test accuracy or test loss')
 
 # GAT
 # BASE_PATH = "models/GAT-2020-05-05-17-23-39-269036-fname" # trained on function names
@@ -41,20 +75,44 @@ BASE_PATH = "models/RGCN-2020-05-11-20-34-49-002750-multitask-5layers"
 API_SEQ = "data_files/python_flat_calls.csv.bz2"
 VAR_USE = "data_files/python_node_to_var.csv.bz2"
 
-e = Experiments(base_path=BASE_PATH,
-                api_seq_path=API_SEQ,
-                type_use_path=None, #not needed
-                node_type_path=None, #not needed
-                variable_use_path=VAR_USE, #not needed
-                function_name_path=None,
-                gnn_layer=-1
-                )
+# set in the main process, or in worker processes by init_worker
+args = None
+e = None
+threads = os.cpu_count()
+shared_memory = None
+
+
+def load_experiments(embedder=None):
+    return Experiments(base_path=BASE_PATH,
+                       api_seq_path=API_SEQ,
+                       type_use_path=None, #not needed
+                       node_type_path=None, #not needed
+                       variable_use_path=VAR_USE, #not needed
+                       function_name_path=None,
+                       gnn_layer=-1,
+                       cache_targets=args.cache_targets,
+                       embedder=embedder
+                       )
 
 # if args.random:
 #     e.embed.e = np.random.randn(e.embed.e.shape[0], e.embed.e.shape[1])
 
 # EXPERIMENT_NAME = args.experiment
 
+def to_tensors(batch):
+    return {key: tf.convert_to_tensor(value) for key, value in batch.items()}
+
+
+def prefetched(batches):
+    """
+    Prepare batches in background threads, so that batch construction overlaps with training steps
+    :param batches: function that returns a batch generator, e.g. experiment.train_batches
+    """
+    if args.prefetch == 0:
+        return batches()
+    return Prefetcher(batches, depth=args.prefetch, workers=args.prefetch_workers, transform=to_tensors)
+
+
 def run_experiment(EXPERIMENT_NAME, random=False):
     experiment = e[EXPERIMENT_NAME]
 
@@ -63,9 +121,16 @@ def run_experiment(EXPERIMENT_NAME, random=False):
     ma_alpha = 2 / (10 + 1)
 
     if random:
-        experiment.embed.e = deepcopy(experiment.embed.e)
+        # the embedder is shared by all experiments, only this experiment gets random embeddings
+        experiment.embed = copy(experiment.embed)
         experiment.embed.e = np.random.randn(experiment.embed.e.shape[0], experiment.embed.e.shape[1])
 
+    metrics = None
+    if args.ranking and EXPERIMENT_NAME in {'link', 'apicall', 'typeuse'}:
+        metrics = experiment.rank_test_nodes(threads=threads)
+        print("Ranking: MRR {:.4f}, Hits@1 {:.4f}, Hits@10 {:.4f}, {} targets".format(
+            metrics["mrr"], metrics["hits@1"], metrics["hits@10"], metrics["num_queries"]))
+
     if EXPERIMENT_NAME in {'link', 'apicall', 'typeuse'}:
         clf = NNClassifier(experiment.embed_size)
     elif EXPERIMENT_NAME in {'varuse', 'fname'}:
@@ -112,9 +177,14 @@ def run_experiment(EXPERIMENT_NAME, random=False):
 
     EPOCHS = 500
 
+    early_stopping = EarlyStopping(patience=args.patience, min_delta=args.min_delta,
+                                   mode="max" if args.monitor == "accuracy" else "min",
+                                   time_budget=args.time_budget, max_epochs=EPOCHS)
+
     # print(f"\n\n\nExperiment name: {EXPERIMENT_NAME}")
     tests = []
 
+    early_stopping.start()
     for epoch in range(EPOCHS):
         # Reset the metrics at the start of the next epoch
         train_loss.reset_states()
@@ -123,18 +193,22 @@ def run_experiment(EXPERIMENT_NAME, random=False):
         test_accuracy.reset_states()
 
 
-        for batch_ind, batch in enumerate(experiment.train_batches()):
+        for batch_ind, batch in enumerate(prefetched(experiment.train_batches)):
             train_step(batch)
 
         if epoch % 1 == 0:
 
-            for batch in experiment.test_batches():
+            for batch in prefetched(experiment.test_batches):
                 test_step(batch)
 
             ma_train = train_accuracy.result() * 100 * ma_alpha + ma_train * (1 - ma_alpha)
             ma_test = test_accuracy.result() * 100 * ma_alpha + ma_test * (1 - ma_alpha)
             tests.append(ma_test)
 
+            monitored = ma_test if args.monitor == "accuracy" else test_loss.result()
+            if early_stopping.step(epoch, monitored):
+                break
+
             # template = 'Epoch {}, Loss: {:.4f}, Accuracy: {:.4f}, Test Loss: {:.4f}, Test Accuracy: {:.4f}, Average Test {:.4f}'
             # print(template.format(epoch+1,
             #                       train_loss.result(),
@@ -143,15 +217,85 @@ def run_experiment(EXPERIMENT_NAME, random=False):
             #                       test_accuracy.result()*100,
             #                       ma_test))
 
+    early_stopping.finish()
+
     # ma_train = train_accuracy.result() * 100 * ma_alpha + ma_train * (1 - ma_alpha)
     # ma_test = test_accuracy.result() * 100 * ma_alpha + ma_test * (1 - ma_alpha)
 
-    return ma_train, max(tests)
+    return ma_train, max(tests), metrics, early_stopping
+
+
+def run_task(task):
+    """
+    Run one experiment of the suite
+    :param task: name of the experiment and whether random embeddings are used
+    :return: row of the results table
+    """
+    experiment_name, random = task
+    start = perf_counter()
+    train_acc, test_acc, metrics, early_stopping = run_experiment(experiment_name, random=random)
+    result = {"experiment": experiment_name, "random": random, "train_acc": float(train_acc),
+              "test_acc": float(test_acc), "wall_time": perf_counter() - start,
+              "stop_epoch": early_stopping.last_epoch, "time_saved": early_stopping.time_saved}
+    if metrics is not None:
+        result.update(mrr=metrics["mrr"], hits_at_10=metrics["hits@10"])
+    print(f"\n{experiment_name}{' (random)' if random else ''}:")
+    print("Train Accuracy: {:.4f}, Test Accuracy: {:.4f}, {:.1f} s".format(
+        result["train_acc"], result["test_acc"], result["wall_time"]))
+    print(early_stopping.summary())
+    return result
+
+
+def init_worker(worker_args, shared_embedder, worker_threads):
+    """
+    Prepare a worker process: limit threads, attach embeddings shared by the main process and load experiments
+    """
+    global args, e, threads, shared_memory
+    args = worker_args
+    threads = worker_threads
+    tf.config.threading.set_intra_op_parallelism_threads(worker_threads)
+    embedder, shared_memory = attach_embedder(shared_embedder)
+    e = load_experiments(embedder)
+
+
+def run_suite(tasks, workers, worker_threads):
+    """
+    Run experiments in a pool of processes. Every worker loads experiments once, the embedding matrix is shared.
+    """
+    shared_embedder, memory = share_embedder(e.embed)
+    # numerical libraries read thread limits when they are imported by a new process
+    for variable in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ[variable] = str(worker_threads)
+    try:
+        # fork is not safe after tensorflow is initialized
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(workers, initializer=init_worker, initargs=(args, shared_embedder, worker_threads)) as pool:
+            return pool.map(run_task, tasks, chunksize=1)
+    finally:
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    e = load_experiments()
+
+    tasks = [(name, random) for name in args.experiments
+             for random in ([False, True] if args.baseline else [args.random])]
+    workers = max(1, min(args.workers, len(tasks)))
+    threads = args.threads or max(1, os.cpu_count() // workers)
+
+    start = perf_counter()
+    if workers == 1:
+        if args.threads is not None:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+        results = [run_task(task) for task in tasks]
+    else:
+        results = run_suite(tasks, workers, threads)
 
-for experiment_name in ['apicall','link','typeuse','varuse','fname','nodetype']:
-    print(f"\n{experiment_name}:")
-    train_acc, test_acc = run_experiment(experiment_name, random=args.random)
-    print("Train Accuracy: {:.4f}, Test Accuracy: {:.4f}".format(train_acc, test_acc))
-    # train_acc, test_acc = run_experiment(experiment_name, random=True)
-    # print("Random Train Accuracy: {:.4f}, Test Accuracy: {:.4f}".format(train_acc, test_acc))
-    print("\n")
\ No newline at end of file
+    results = pandas.DataFrame(results)
+    print(results.to_string(index=False, float_format="{:.4f}".format))
+    print("Suite wall time {:.1f} s, {} workers with {} threads".format(perf_counter() - start, workers, threads))
+    if args.results is not None:
+        results.to_csv(args.results, index=False)
\ No newline at end of file
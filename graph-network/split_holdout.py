@@ -0,0 +1,34 @@
+"""
+Split edges into train and holdout sets without loading the edge file into memory. The split is the same as the one
+made by SourceGraphDataset with the same holdout fraction and seed.
+
+Usage:
+    python split_holdout.py nodes.csv edges.csv output_dir --holdout_frac 0.001 --seed 42
+"""
+import argparse
+from os import mkdir
+from os.path import isdir, join
+
+import pandas
+
+from Dataset import holdout_from_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split edges into train and holdout sets chunk by chunk")
+    parser.add_argument("nodes_path", help="Path to the file with nodes")
+    parser.add_argument("edges_path", help="Path to the file with edges")
+    parser.add_argument("output_dir", help="Directory for nodes.csv, edges_train.csv and edges_held.csv")
+    parser.add_argument("--holdout_frac", type=float, default=0.001, help="Expected fraction of held out edges")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for the split")
+    parser.add_argument("--chunksize", type=int, default=1000000, help="Number of edges processed at once")
+    args = parser.parse_args()
+
+    if not isdir(args.output_dir):
+        mkdir(args.output_dir)
+
+    nodes = pandas.read_csv(args.nodes_path)
+    nodes = holdout_from_file(nodes, args.edges_path, join(args.output_dir, "edges_train.csv"),
+                              join(args.output_dir, "edges_held.csv"), args.holdout_frac, seed=args.seed,
+                              chunksize=args.chunksize)
+    nodes.to_csv(join(args.output_dir, "nodes.csv"), index=False)
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from AliasSampler import AliasSampler, build_alias_table
+
+
+@pytest.mark.parametrize("weights", [
+    np.array([1., 2., 7.]),
+    np.array([0., 0., 1., 0.]),
+    np.r_[1e6, np.ones(1000)],
+    np.random.default_rng(0).zipf(1.5, 10000).astype(np.float64),
+])
+def test_alias_table(weights):
+    prob = weights / weights.sum()
+    accept, alias = build_alias_table(prob)
+
+    # probability of every value implied by the tables
+    implied = accept / prob.size + np.bincount(alias, weights=(1. - accept) / prob.size, minlength=prob.size)
+    assert np.allclose(implied, prob)
+
+
+def test_alias_sampler():
+    sampler = AliasSampler.from_occurrences(np.array([10, 20, 20, 30, 30, 30]), power=1., buffer_size=1000, seed=42)
+
+    sample = np.concatenate([sampler.sample(300) for _ in range(100)] + [sampler.sample(5000)])
+    values, counts = np.unique(sample, return_counts=True)
+    assert values.tolist() == [10, 20, 30]
+    assert np.allclose(counts / counts.sum(), [1 / 6, 2 / 6, 3 / 6], atol=0.01)
+
+    same_seed = AliasSampler.from_occurrences(np.array([10, 20, 20, 30, 30, 30]), power=1., buffer_size=1000, seed=42)
+    assert np.array_equal(same_seed.sample(300), sample[:300])
@@ -0,0 +1,33 @@
+import os
+
+import torch
+
+from Checkpointer import AsyncCheckpointer, load_checkpoint
+
+
+def test_async_checkpointer(tmp_path):
+    path = str(tmp_path / "saved_state.pt")
+    model = torch.nn.Linear(4, 2)
+    optimizer = torch.optim.Adam(model.parameters())
+
+    checkpointer = AsyncCheckpointer(path, keep_last=2)
+    for epoch in range(3):
+        model(torch.ones(1, 4)).sum().backward()
+        optimizer.step()
+        checkpointer.save({'m': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': epoch})
+        weight = model.weight.detach().clone()
+        # parameters are modified while the checkpoint is written
+        with torch.no_grad():
+            model.weight.zero_()
+    checkpointer.close()
+
+    assert sorted(os.listdir(tmp_path)) == ["saved_state.pt", "saved_state.pt.1"]
+
+    checkpoint = load_checkpoint(path)
+    assert checkpoint['epoch'] == 2
+    assert torch.equal(checkpoint['m']['weight'], weight)
+    assert load_checkpoint(path + ".1")['epoch'] == 1
+
+    restored = torch.optim.Adam(model.parameters())
+    restored.load_state_dict(checkpoint['optimizer'])
+    assert restored.state_dict()['state'][0]['step'] == 3
@@ -1,5 +1,91 @@
 from Dataset import *
+import pytest
 
 def test_compact_property():
     assert compact_property(numpy.array([3,2,1])) == {1:0, 2:1, 3:2}
-    assert compact_property(numpy.array([6,4,3,7,8,4])) == {3: 0, 4: 1, 6: 2, 7:3, 8:4}
\ No newline at end of file
+    assert compact_property(numpy.array([6,4,3,7,8,4])) == {3: 0, 4: 1, 6: 2, 7:3, 8:4}
+
+def test_compact_codes():
+    uniq, codes = compact_codes(numpy.array([6,4,3,7,8,4]))
+    assert uniq.tolist() == [3, 4, 6, 7, 8]
+    assert codes.tolist() == [2, 1, 0, 3, 4, 1]
+    assert lookup_codes(uniq, numpy.array([8, 3])).tolist() == [4, 0]
+    with pytest.raises(KeyError):
+        lookup_codes(uniq, numpy.array([5]))
+
+
+def test_compact_graph_ids():
+    nodes = pandas.DataFrame({"id": [30, 10, 20, 40], "type": [2, 1, 2, 1], "label": [2, 1, 2, 1]})
+    edges = pandas.DataFrame({"src": [30, 10], "dst": [40, 20]})
+    nodes, edges, label_map, id_map, typed_id_map = compact_graph_ids(nodes, edges)
+    assert nodes['graph_id'].tolist() == [2, 0, 1, 3]
+    assert nodes['typed_id'].tolist() == [1, 0, 0, 1]
+    assert nodes['compact_label'].tolist() == [1, 0, 1, 0]
+    assert typed_id_map == {"1": {10: 0, 40: 1}, "2": {20: 0, 30: 1}}
+    assert edges['src_type'].tolist() == [2, 1]
+    assert edges['src_type_graph_id'].tolist() == [2, 0]
+    assert edges['dst_type_typed_id'].tolist() == [1, 0]
+
+
+def test_dataset_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pandas.DataFrame({
+        "id": [10, 20, 30, 40], "type": [1, 2, 1, 2], "serialized_name": ["a.f", "a.b", "a.g", "a.c"]
+    }).to_csv("nodes.csv", index=False)
+    pandas.DataFrame({
+        "id": [0, 1, 2, 3], "type": [8, 8, 1, 1], "source_node_id": [10, 30, 20, 40], "target_node_id": [30, 10, 10, 30]
+    }).to_csv("edges.csv", index=False)
+
+    created = SourceGraphDataset("nodes.csv", "edges.csv", label_from="type", node_types=True, edge_types=True,
+                                 cache_dir="cache")
+    restored = SourceGraphDataset("nodes.csv", "edges.csv", label_from="type", node_types=True, edge_types=True,
+                                  cache_dir="cache")
+
+    assert restored.global_id_map == created.global_id_map
+    assert restored.typed_id_map == created.typed_id_map
+    assert restored.g.canonical_etypes == created.g.canonical_etypes
+    assert all((a == b).all() for a, b in zip(restored.splits, created.splits))
+
+    # numeric columns stay backed by the files of the cache
+    column = restored.nodes['typed_id'].to_numpy()
+    while column is not None and not isinstance(column, numpy.memmap):
+        column = column.base
+    assert column is not None and column.filename.startswith(str(tmp_path / "cache"))
+
+
+def test_holdout_from_file(tmp_path, monkeypatch):
+    rng = numpy.random.default_rng(0)
+    nodes = pandas.DataFrame({"id": numpy.arange(0, 2000, 2), "type": 1})
+    edges = pandas.DataFrame({
+        "id": numpy.arange(1500), "type": 8,
+        "src": rng.choice(nodes['id'], 1500), "dst": rng.choice(nodes['id'], 1500)
+    })
+    edges.to_csv(tmp_path / "edges.csv", index=False)
+
+    nodes_mem, train_mem, held_mem = SourceGraphDataset.holdout(nodes, edges, 0.1, seed=1)
+    nodes_file = holdout_from_file(nodes, tmp_path / "edges.csv", tmp_path / "train.csv", tmp_path / "held.csv", 0.1,
+                                   seed=1, chunksize=100)
+
+    assert 0 < held_mem.shape[0] < 300
+    assert nodes_file['id'].tolist() == nodes_mem['id'].tolist()
+    assert pandas.read_csv(tmp_path / "train.csv")['id'].tolist() == train_mem['id'].tolist()
+    assert pandas.read_csv(tmp_path / "held.csv")['id'].tolist() == held_mem['id'].tolist()
+
+    _, _, held_other_seed = SourceGraphDataset.holdout(nodes, edges, 0.1, seed=2)
+    assert held_other_seed['id'].tolist() != held_mem['id'].tolist()
+
+    _, train, held = SourceGraphDataset.holdout(nodes, edges, 0.)
+    assert train.shape[0] == 1500 and held.shape[0] == 0
+
+    # files without edges
+    edges.iloc[:0].to_csv(tmp_path / "empty.csv", index=False)
+    assert holdout_from_file(nodes, tmp_path / "empty.csv", tmp_path / "train.csv", tmp_path / "held.csv", 0.1).empty
+    assert pandas.read_csv(tmp_path / "held.csv").columns.tolist() == edges.columns.tolist()
+
+    # some pandas versions do not produce chunks for such files
+    (tmp_path / "train.csv").unlink()
+    read_csv = pandas.read_csv
+    monkeypatch.setattr(pandas, "read_csv", lambda *args, chunksize=None, **kwargs:
+                        iter([]) if chunksize is not None else read_csv(*args, **kwargs))
+    assert holdout_from_file(nodes, tmp_path / "empty.csv", tmp_path / "train.csv", tmp_path / "held.csv", 0.1).empty
+    assert pandas.read_csv(tmp_path / "train.csv").columns.tolist() == edges.columns.tolist()
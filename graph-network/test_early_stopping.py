@@ -0,0 +1,75 @@
+from time import sleep
+
+import pytest
+
+from EarlyStopping import EarlyStopping
+
+
+def run(stopping, values):
+    for epoch, value in enumerate(values):
+        if stopping.step(epoch, value):
+            return epoch
+    return None
+
+
+def test_patience():
+    stopping = EarlyStopping(patience=2, max_epochs=10)
+    assert run(stopping, [0.1, 0.5, 0.4, 0.5, 0.3, 0.9]) == 3
+    report = stopping.report()
+    assert report["stop_epoch"] == 3
+    assert report["best_epoch"] == 1 and report["best_value"] == 0.5
+    assert report["epochs_saved"] == 6
+
+    # loss is minimized, improvements smaller than min_delta do not count
+    stopping = EarlyStopping(patience=2, min_delta=0.05, mode="min")
+    assert run(stopping, [1., 0.8, 0.78, 0.77, 0.5]) == 3
+    assert stopping.best_epoch == 1
+
+
+def test_no_stopping():
+    stopping = EarlyStopping(max_epochs=3)
+    assert run(stopping, [0.3, 0.2, 0.1]) is None
+    report = stopping.report()
+    assert report["stop_reason"] == "epoch budget"
+    assert report["epochs_saved"] == 0 and report["time_saved"] == 0.
+    assert report["best_epoch"] == 0
+
+    stopping.reset()
+    assert stopping.best_value is None and not stopping.stopped
+
+    with pytest.raises(ValueError):
+        EarlyStopping(mode="mean")
+
+
+def test_time_budget():
+    stopping = EarlyStopping(time_budget=0.05, max_epochs=100)
+    stopping.start()
+    assert not stopping.step(0, 0.1)
+    sleep(0.06)
+    assert stopping.step(1, 0.2)
+    assert stopping.stopped and stopping.epochs_saved == 98
+    assert stopping.time_saved > 0.05 * 98 / 2
+
+
+def test_time_is_fixed_when_training_ends():
+    stopping = EarlyStopping(patience=2, max_epochs=10)
+    stopping.start()
+    for epoch, value in enumerate([0.5, 0.4, 0.3]):
+        sleep(0.02)
+        if stopping.step(epoch, value):
+            break
+    # the first epoch is measured, 7 epochs of about 0.02 s are saved
+    assert stopping.stopped and stopping.epochs_saved == 7
+    time_saved = stopping.report()["time_saved"]
+    assert time_saved >= 7 * 0.02
+    sleep(0.05)
+    assert stopping.report()["time_saved"] == time_saved
+
+    # training that ends with the epoch budget is finished by the caller
+    stopping = EarlyStopping(max_epochs=2)
+    stopping.start()
+    run(stopping, [0.1, 0.2])
+    stopping.finish()
+    elapsed = stopping.elapsed
+    sleep(0.02)
+    assert stopping.elapsed == elapsed
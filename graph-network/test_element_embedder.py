@@ -0,0 +1,28 @@
+import numpy as np
+import pandas
+import pytest
+import torch
+
+from ElementEmbedderBase import ElementEmbedderBase
+from ElementEmbedder import ElementEmbedder
+
+
+@pytest.mark.parametrize("ids", [[0, 1, 2, 3, 4, 4, 5], [0., 10., 200., 3000., 40000., 40000., 500000.]])
+def test_element_lookup(ids):
+    elements = pandas.DataFrame({
+        "id": ids,
+        "dst": [6, 11, 12, 11, 14, 15, 16]
+    })
+
+    ee = ElementEmbedderBase(elements)
+    assert len(ee) == 6
+    # dst are compacted in sorted order
+    assert ee[np.array([ids[0], ids[1], ids[6]])].tolist() == [0, 1, 5]
+    assert set(ee[np.array([ids[4]] * 100)].tolist()) == {3, 4}
+
+    with pytest.raises(KeyError):
+        ee[np.array([ids[0], 7])]
+
+    ee = ElementEmbedder(elements, 5, compact_dst=False)
+    sample = ee[np.array([ids[2], ids[3]])]
+    assert sample.dtype == torch.int64 and sample.tolist() == [12, 11]
@@ -0,0 +1,84 @@
+import os
+import pickle
+
+import numpy as np
+import pandas
+import pytest
+
+from Embedder import Embedder, export_embeddings, ids_by_row, load_embedders, load_model_embedders, layer_path, \
+    convert_pickled_embedders, share_embedder, attach_embedder
+
+
+@pytest.mark.parametrize("ids", [np.array([5, 1, 3, 0]), np.array([5000, 10, 300000, 7])])
+def test_embedder_lookup(ids):
+    embeddings = np.arange(8, dtype=np.float32).reshape(4, 2)
+    rows = np.array([2, 0, 3, 1])
+    embedder = Embedder(dict(zip(ids, rows)), embeddings)
+
+    assert np.array_equal(embedder[ids[::-1].copy()], embeddings[rows[::-1]])
+    assert np.array_equal(embedder[int(ids[1])], embeddings[0])
+    assert embedder.ind == dict(zip(ids.tolist(), rows.tolist()))
+    assert embedder.inv == dict(zip(rows.tolist(), ids.tolist()))
+    assert embedder.contains(np.array([ids[0], 2, -1])).tolist() == [True, False, False]
+
+    with pytest.raises(KeyError):
+        embedder[np.array([ids[0], 2])]
+
+    restored = pickle.loads(pickle.dumps(embedder))
+    assert np.array_equal(restored[ids], embedder[ids])
+
+
+def test_embedder_legacy_pickle():
+    # state of Embedder pickled before the index was stored in arrays
+    embedder = Embedder.__new__(Embedder)
+    embedder.__setstate__({"e": np.eye(3), "ind": {10: 2, 20: 0, 30: 1}, "inv": {2: 10, 0: 20, 1: 30}})
+
+    assert np.array_equal(embedder[np.array([20, 30])], np.eye(3)[[0, 1]])
+
+
+def test_export_embeddings(tmp_path):
+    ids = np.array([30, 10, 20])
+    rows = np.array([1, 2, 0])
+    layers = [np.random.rand(3, 4).astype(np.float32), np.random.rand(3, 2).astype(np.float32)]
+    embedders = [Embedder(dict(zip(ids, rows)), layer) for layer in layers]
+
+    # model trained before layer-wise inference
+    pickle.dump(embedders, open(tmp_path / "embeddings.pkl", "wb"))
+    assert np.array_equal(load_model_embedders(str(tmp_path), [-1])[0][ids], layers[1][rows])
+
+    # layer files with ids in nodes.csv
+    os.mkdir(tmp_path / "embeddings")
+    for ind, layer in enumerate(layers):
+        np.save(layer_path(str(tmp_path / "embeddings"), ind), layer)
+    pandas.DataFrame({"id": ids, "global_graph_id": rows}).to_csv(tmp_path / "nodes.csv", index=False)
+    assert np.array_equal(load_model_embedders(str(tmp_path), [0])[0][ids], layers[0][rows])
+
+    export_embeddings(str(tmp_path / "embeddings"), ids_by_row(ids, rows), dtype="float16")
+    os.remove(tmp_path / "nodes.csv")
+    loaded = load_model_embedders(str(tmp_path))
+    assert len(loaded) == 2 and isinstance(loaded[0].e, np.memmap) and loaded[0].e.dtype == np.float16
+    assert loaded[1][ids].dtype == np.float32
+    assert np.allclose(loaded[1][ids], layers[1][rows], atol=1e-3)
+    assert np.array_equal(load_embedders(str(tmp_path / "embeddings"), layers=[0])[0].ids, np.sort(ids))
+
+    convert_pickled_embedders(str(tmp_path / "embeddings.pkl"), str(tmp_path / "converted"))
+    converted = load_embedders(str(tmp_path / "converted"))
+    assert np.array_equal(converted[1][ids], layers[1][rows])
+
+
+def test_share_embedder(tmp_path):
+    ids = np.array([7, 3, 5])
+    embeddings = np.arange(6, dtype=np.float32).reshape(3, 2)
+    np.save(str(tmp_path / "layer0.npy"), embeddings)
+
+    # arrays in memory are copied into shared memory, memory-mapped layers are shared through the file
+    for e in [embeddings, np.load(str(tmp_path / "layer0.npy"), mmap_mode="r")]:
+        description, memory = share_embedder(Embedder.from_arrays(ids, np.arange(3), e))
+        assert (memory is None) == isinstance(e, np.memmap)
+        attached, attached_memory = attach_embedder(pickle.loads(pickle.dumps(description)))
+        assert np.array_equal(attached[np.array([5, 7])], embeddings[[2, 0]])
+        if memory is not None:
+            del attached
+            attached_memory.close()
+            memory.close()
+            memory.unlink()
@@ -0,0 +1,30 @@
+import numpy as np
+
+from Embedder import Embedder
+from EmbeddingIndex import IVFIndex, brute_force_search, recall
+
+
+def test_ivf_index(tmp_path):
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(20, 16))
+    vectors = centers[rng.integers(0, 20, 2000)] + 0.1 * rng.normal(size=(2000, 16))
+    ids = np.arange(2000) * 3 + 7
+    embedder = Embedder(dict(zip(ids, rng.permutation(2000))), vectors)
+    queries = vectors[:50]
+
+    for metric in ["ip", "cosine"]:
+        true_scores, true_ids = brute_force_search(embedder.e[embedder.rows], queries, k=5, metric=metric,
+                                                   ids=embedder.ids, chunk_size=300)
+        index = IVFIndex.from_embedder(embedder, n_lists=20, metric=metric)
+
+        # probing all lists is exact search
+        scores, found = index.search(queries, k=5, nprobe=20)
+        assert np.allclose(scores, true_scores, atol=1e-4)
+        assert recall(found, true_ids) == 1.
+
+        index.save(str(tmp_path / metric))
+        loaded = IVFIndex.load(str(tmp_path / metric))
+        assert isinstance(loaded.vectors, np.memmap)
+        scores, found = loaded.search(queries, k=5, nprobe=4)
+        assert recall(found, true_ids) > 0.9
+        assert (np.diff(scores, axis=1) <= 0).all()
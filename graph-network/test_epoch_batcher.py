@@ -0,0 +1,42 @@
+import numpy as np
+
+from EpochBatcher import EpochBatcher, epoch_layout, epoch_order, interleave, negative_sources, sample_counts
+
+
+def test_epoch_layout():
+    counts = np.array([2, 1])
+    bounds, is_positive = epoch_layout(counts, 2)
+    assert bounds.tolist() == [0, 6, 9]
+    assert is_positive.tolist() == [True, True, False, False, False, False, True, False, False]
+
+    merged = interleave(np.array([1, 2, 3]), np.array([10, 10, 20, 20, 30, 30]), is_positive)
+    assert merged.tolist() == [1, 2, 10, 10, 20, 20, 3, 30, 30]
+
+    # negatives are paired with sources of their own batch
+    sources = negative_sources(counts, 2)
+    assert np.all(sources[:4] < 2) and np.all(sources[4:] == 2)
+
+    assert sample_counts(5, 2).tolist() == [2, 2, 1]
+    assert sample_counts(4, 2).tolist() == [2, 2]
+    assert sample_counts(5, 2, whole=True).tolist() == [5]
+
+    order, counts = epoch_order(5, 2)
+    assert counts.tolist() == [2, 2, 2]
+    assert set(order[:5].tolist()) == set(range(5)) and order[4] != order[5]
+
+
+def test_batches():
+    src = np.arange(10, dtype=np.float32).reshape(5, 2)
+    dst = -np.arange(5, dtype=np.float32).reshape(5, 1)
+    src_positions = np.array([0, 1, 2, 3, 4, 0, 1])
+    dst_positions = np.array([4, 3, 2, 1, 0, 0, 0])
+    bounds = np.array([0, 3, 5, 7])
+    labels = np.arange(7)
+
+    # blocks of 4 rows hold one or two batches, the buffer grows for larger batches
+    for block_rows in [4, 2, 65536]:
+        batches = [{name: value.copy() for name, value in batch.items()} for batch in
+                   EpochBatcher(block_rows).batches([src, dst], [src_positions, dst_positions], bounds, y=labels)]
+        assert [batch["y"].tolist() for batch in batches] == [[0, 1, 2], [3, 4], [5, 6]]
+        x = np.concatenate([batch["x"] for batch in batches])
+        assert np.array_equal(x, np.hstack([src[src_positions], dst[dst_positions]]))
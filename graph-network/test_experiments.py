@@ -1,2 +1,93 @@
+import os
+import pickle
+
 import pytest
 
+import numpy as np
+import pandas
+import torch
+
+from Embedder import Embedder
+from Experiments import Experiment, Experiment2, Experiment3, Experiments
+
+
+def test_rank_test_nodes():
+    ids = np.arange(100, 140)
+    embeddings = np.random.RandomState(0).randn(ids.size, 8)
+    # every source points to the node with the same embedding, ranking by dot product puts it close to the top
+    target = pandas.DataFrame({"src": ids[:20], "dst": ids[20:]})
+    embeddings[20:] = embeddings[:20] * 10
+    embedder = Embedder(dict(zip(ids, range(ids.size))), embeddings)
+
+    experiment = Experiment(embedder, None, None, target, split_on="nodes", compact_dst=False, test_frac=0.5)
+    metrics = experiment.rank_test_nodes(threads=2)
+    assert metrics["num_queries"] == 10
+    assert metrics["hits@10"] == 1. and metrics["mrr"] > 0.5
+
+    experiment = Experiment(embedder, None, None, target, split_on="edges", compact_dst=False)
+    with pytest.raises(ValueError):
+        experiment.rank_test_nodes()
+
+
+def make_model_dir(path):
+    ids = np.arange(10)
+    pandas.DataFrame({
+        "id": ids, "label": [4096] * 5 + [1] * 5, "name": ["mod.f{}".format(i) for i in range(5)] + ["v"] * 5
+    }).to_csv(path / "nodes.csv", index=False)
+    pandas.DataFrame({"type": [8, 8, 8, 2], "src": [0, 0, 1, 2], "dst": [1, 1, 2, 7]}).to_csv(path / "held.csv",
+                                                                                                 index=False)
+    pandas.DataFrame({"src": [0, 1, 2, 8], "dst": [1, 2, 9, 0]}).to_csv(path / "api.csv", index=False)
+    torch.save({"splits": (ids[:6], ids[6:8], ids[:8])}, path / "state_dict.pt")
+    with open(path / "embeddings.pkl", "wb") as embeddings:
+        pickle.dump([Embedder(dict(zip(ids, ids)), np.random.RandomState(0).randn(ids.size, 4))], embeddings)
+
+
+def test_target_tables(tmp_path):
+    make_model_dir(tmp_path)
+    experiments = Experiments(base_path=str(tmp_path), api_seq_path=str(tmp_path / "api.csv"), cache_targets=True)
+
+    assert experiments.target_table("link").values.tolist() == [[0, 1], [1, 2]]
+    assert experiments.target_table("typeuse").values.tolist() == [[2, 7]]
+    assert experiments.target_table("apicall").values.tolist() == [[0, 1], [1, 2]]
+    assert experiments.target_table("fname")['dst'].tolist() == ["f0", "f1", "f2", "f3", "f4"]
+    assert experiments.target_table("nodetype")['dst'].tolist() == [4096] * 5 + [1] * 3
+
+    # experiments modify their targets, the cached table stays the same
+    experiments["apicall"]
+    assert experiments.target_table("apicall").columns.tolist() == ['src', 'dst']
+
+    # the second instance reads tables from the model directory
+    cached = Experiments(base_path=str(tmp_path), api_seq_path=str(tmp_path / "api.csv"), cache_targets=True)
+    assert cached.target_table("fname").values.tolist() == experiments.target_table("fname").values.tolist()
+    assert cached._nodes is None
+
+    # a worker that computed the same table later uses the entry of the first writer
+    cache_path = experiments.target_cache_path("fname")
+    stored = Experiments.save_cached_target(pandas.DataFrame({"src": [0], "dst": ["other"]}), cache_path)
+    assert stored['dst'].tolist() == ["f0", "f1", "f2", "f3", "f4"]
+    assert not [name for name in os.listdir(os.path.dirname(cache_path)) if name.endswith(".tmp")]
+
+
+def test_batches():
+    ids = np.arange(100, 400)
+    embeddings = np.random.RandomState(0).randn(ids.size, 4)
+    embedder = Embedder(dict(zip(ids, range(ids.size))), embeddings)
+    target = pandas.DataFrame({"src": ids[:200], "dst": ids[100:]})
+
+    experiment = Experiment(embedder, None, None, target.copy(), split_on="nodes", compact_dst=False)
+    batches = [batch["x"].copy() for batch in experiment.batch_nodes(experiment.train_nodes, size=32, K=3)]
+    assert len(batches) == experiment.train_nodes.size // 32 + 1
+    assert all(batch.shape == (32 * 4, 8) for batch in batches)
+    # every positive is a node with embedding of its target
+    positives = np.concatenate([batch[:32] for batch in batches])
+    expected = {tuple(embeddings[i - 100]) + tuple(embeddings[i]) for i in ids[:200]}
+    assert all(tuple(row) in expected for row in positives)
+
+    experiment = Experiment2(embedder, None, None, target.copy(), split_on="edges")
+    batches = list(experiment.train_batches())
+    assert sum(batch["y"].sum() for batch in batches) == experiment.train_edge_ind.size
+    assert all(batch["x"].shape[0] == batch["elements"].shape[0] == batch["y"].shape[0] for batch in batches)
+
+    experiment = Experiment3(embedder, None, None, target.copy(), split_on="edges")
+    x = np.concatenate([batch["x"].copy() for batch in experiment.train_batches()])
+    assert np.array_equal(x, embedder[experiment.X_train[:, 0].astype(np.int64)])
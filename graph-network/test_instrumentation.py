@@ -0,0 +1,28 @@
+import json
+
+from Instrumentation import Instrumentation, phase, add_samples, start_epoch, end_epoch
+
+
+def test_instrumentation(tmp_path):
+    # without active instrumentation measurements are ignored
+    with phase("gnn_forward"):
+        add_samples(10)
+    end_epoch(0)
+
+    with Instrumentation(tmp_path / "metrics.jsonl"):
+        for epoch in range(2):
+            start_epoch(epoch)
+            with phase("gnn_forward"):
+                with phase("negative_sampling"):
+                    pass
+            with phase("gnn_forward"):
+                pass
+            add_samples(100)
+            end_epoch(epoch, loss=0.5)
+
+    records = [json.loads(line) for line in open(tmp_path / "metrics.jsonl")]
+    assert [r['epoch'] for r in records] == [0, 1]
+    assert all(r['samples'] == 100 and r['loss'] == 0.5 for r in records)
+    assert set(records[1]['phases']) == {"gnn_forward", "negative_sampling"}
+    assert records[1]['phases']["gnn_forward"] >= records[1]['phases']["negative_sampling"]
+    assert records[1]['peak_rss_mb'] > 0
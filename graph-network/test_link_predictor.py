@@ -0,0 +1,37 @@
+import torch
+
+from LinkPredictor import LinkPredictor, PairScorer
+
+
+def test_forward_split():
+    lp = LinkPredictor(150)
+    src = torch.randn(7, 100)
+    dst = torch.randn(28, 50)
+
+    expected = lp(torch.cat([src.repeat(4, 1), dst], 1))
+    assert torch.allclose(lp.forward_split(src, dst), expected, atol=1e-6)
+
+
+def test_pair_scorer():
+    src = torch.randn(7, 100)
+    dst = torch.randn(28, 100)
+
+    for mode in ["dot", "distmult", "bilinear"]:
+        scorer = PairScorer(100, 100, mode=mode)
+        logits = scorer.forward_split(src, dst)
+        assert torch.allclose(logits, scorer(torch.cat([src.repeat(4, 1), dst], 1)), atol=1e-5)
+
+        # the score of the pair is the logit of the positive class
+        candidates = scorer.score_candidates(src, dst)
+        assert candidates.shape == (7, 28)
+        assert torch.allclose(candidates[torch.arange(7), torch.arange(7)], logits[:7, 1], atol=1e-5)
+
+
+def test_score_candidates():
+    lp = LinkPredictor(20)
+    src = torch.randn(5, 10)
+    candidates = torch.randn(8, 10)
+    scores = lp.score_candidates(src, candidates)
+    pairs = lp(torch.cat([src[2].repeat(8, 1), candidates], 1))
+    assert scores.shape == (5, 8)
+    assert torch.allclose(scores[2], pairs[:, 1] - pairs[:, 0], atol=1e-5)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from Prefetcher import Prefetcher
+
+
+def reused_buffer_batches(n):
+    buffer = np.zeros(3)
+    for i in range(n):
+        buffer[:] = i
+        yield {"x": buffer, "y": i}
+
+
+def test_prefetcher():
+    # batches are copied out of the reused buffer and returned in order
+    batches = list(Prefetcher(lambda: reused_buffer_batches(20), depth=3))
+    assert [batch["x"].tolist() for batch in batches] == [[i] * 3 for i in range(20)]
+
+    batches = list(Prefetcher(reused_buffer_batches(20), depth=1, workers=3,
+                              transform=lambda batch: batch["x"].sum() + batch["y"]))
+    assert batches == [4 * i for i in range(20)]
+
+
+def test_prefetcher_errors():
+    def failing():
+        yield {"y": 1}
+        raise RuntimeError("failed")
+
+    prefetcher = Prefetcher(failing)
+    assert next(prefetcher)["y"] == 1
+    with pytest.raises(RuntimeError):
+        next(prefetcher)
+
+    # interrupted iteration stops the background thread
+    with Prefetcher(reused_buffer_batches(1000), depth=2) as prefetcher:
+        next(prefetcher)
+    assert not prefetcher.worker.is_alive()
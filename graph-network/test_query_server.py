@@ -0,0 +1,109 @@
+import asyncio
+import json
+import os
+
+import numpy as np
+import pandas
+
+from QueryServer import ModelStore, QueryServer
+
+
+def write_model(path):
+    pandas.DataFrame({
+        "id": [10, 20, 30, 40], "name": ["a.f", "a.g", "a.h", "b.f"], "global_graph_id": [2, 0, 1, 3]
+    }).to_csv(path / "nodes.csv", index=False)
+    pandas.DataFrame({"src": [10, 20, 30], "dst": [20, 30, 10], "type": [8, 8, 512]}).to_csv(path / "edges.csv",
+                                                                                           index=False)
+    os.mkdir(path / "embeddings")
+    # rows are global graph ids: 20, 30, 10, 40
+    np.save(path / "embeddings" / "layer0.npy", np.array([[1., 0.1], [0., 1.], [1., 0.], [-1., 0.]], dtype=np.float32))
+
+
+async def get(port, targets):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    responses = []
+    # all requests use the same connection
+    for target in targets:
+        writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(target).encode("latin-1"))
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.lower()] = value.strip()
+        responses.append((status, json.loads(await reader.readexactly(int(headers["content-length"])))))
+    writer.close()
+    return responses
+
+
+def test_query_server(tmp_path):
+    write_model(tmp_path)
+    store = ModelStore(str(tmp_path), layer=-1, metric="cosine")
+
+    async def run():
+        server = await QueryServer(store).start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await asyncio.gather(
+                get(port, ["/neighbors?id=10&k=2", "/neighbors?id=10&k=2", "/egonet?name=a.f", "/stats"]),
+                get(port, ["/neighbors?name=a.g,b.f&k=1", "/neighbors?id=50", "/neighbors?id=x", "/unknown"]),
+                get(port, ["/egonet?id=10&limit=1", "/egonet?id=10&limit=-1", "/egonet?id=10&limit=x"]),
+            )
+
+    first, second, limits = asyncio.run(run())
+
+    (status, neighbors), (_, cached), (_, egonet), (_, stats) = first
+    assert status == 200 and neighbors == cached
+    assert [n["id"] for n in neighbors["results"][0]["neighbors"]] == [20, 30]
+    assert {n["name"] for n in egonet["nodes"]} == {"a.f", "a.g", "a.h"}
+    assert {(l["source"], l["target"]) for l in egonet["links"]} == {("a.f", "a.g"), ("a.g", "a.h"), ("a.h", "a.f")}
+    assert stats["cache_hits"] >= 1
+
+    (status, batched), (missing, _), (malformed, _), (unknown, _) = second
+    assert [r["neighbors"][0]["id"] for r in batched["results"]] == [10, 30]
+    assert (missing, malformed, unknown) == (404, 400, 404)
+
+    (status, limited), (negative, _), (not_integer, _) = limits
+    assert status == 200 and len(limited["nodes"]) == 2
+    assert (negative, not_integer) == (400, 400)
+
+
+async def status_of(port, request):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(request)
+    status = int((await reader.readline()).split()[1])
+    writer.close()
+    return status
+
+
+def test_query_server_errors(tmp_path):
+    write_model(tmp_path)
+    server = QueryServer(ModelStore(str(tmp_path), layer=-1, metric="cosine"))
+
+    def post(body, length=None):
+        return "POST /neighbors HTTP/1.1\r\nContent-Length: {}\r\n\r\n{}".format(
+            len(body) if length is None else length, body).encode("latin-1")
+
+    async def run():
+        running = await server.start("127.0.0.1", 0)
+        port = running.sockets[0].getsockname()[1]
+        async with running:
+            statuses = [await status_of(port, request) for request in
+                        [post('{"ids": [10]}'), post("[1, 2]"), post('"x"'), post("{}", length="x"),
+                         post('{"names": [[1]]}'), post('{"ids": "10"}'), post('{"ids": [1.5]}'),
+                         post('{"ids": [100000000000000000000]}')]]
+
+            # a cancelled query does not prevent results of other queries in the batch
+            loop = asyncio.get_running_loop()
+            cancelled, waiting = loop.create_future(), loop.create_future()
+            cancelled.cancel()
+            await server.run_batch([(np.array([10]), 1, cancelled), (np.array([20]), 1, waiting)])
+            return statuses, waiting.result()
+
+    statuses, (scores, found) = asyncio.run(run())
+    assert statuses == [200, 400, 400, 400, 400, 400, 400, 404]
+    # finished batches are not referenced
+    assert not server.tasks
+    assert found.shape == (1, 1)
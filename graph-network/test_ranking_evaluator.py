@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import torch
+
+from ElementEmbedderBase import ElementEmbedderBase
+from RankingEvaluator import element_queries, rank_targets, ranking_metrics
+
+
+def test_rank_targets():
+    src = torch.tensor([[1., 0.], [0., 1.]])
+    candidates = torch.tensor([[3., 0.], [2., 0.], [0., 1.], [1., 1.]])
+    # the first source has two true targets, each of them is ranked without the other one
+    indptr = np.array([0, 2, 3])
+    targets = np.array([1, 3, 2])
+
+    expected = np.array([2., 2., 1.5])
+    for chunk_size, candidate_chunk_size, threads in [(256, 8192, 1), (1, 1, 2), (1, 3, 1)]:
+        ranks = rank_targets(src, candidates, indptr, targets, chunk_size=chunk_size,
+                             candidate_chunk_size=candidate_chunk_size, threads=threads)
+        assert ranks.tolist() == expected.tolist()
+
+    metrics = ranking_metrics(expected, hits=(1, 2))
+    assert np.isclose(metrics["mrr"], (1 / 2 + 1 / 2 + 1 / 1.5) / 3)
+    assert metrics["hits@1"] == 0. and metrics["hits@2"] == 1. and metrics["num_queries"] == 3
+
+
+def test_element_queries():
+    ee = ElementEmbedderBase(pd.DataFrame({"id": [5, 3, 5, 7], "dst": [40, 10, 20, 40]}), compact_dst=False)
+    indptr, targets = element_queries(ee, np.array([5, 7, 3]))
+    assert indptr.tolist() == [0, 2, 3, 4]
+    assert targets.tolist() == [40, 20, 40, 10]
+
+    indptr, targets = element_queries(ee, np.array([7, 5]), candidate_ids=np.array([10, 20, 40]))
+    assert targets.tolist() == [2, 2, 1]
+
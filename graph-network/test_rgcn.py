@@ -0,0 +1,141 @@
+import dgl
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from gat import GAT
+from models import CombinedOptimizer, add_sparse_optimizer, create_sampler, dense_parameters, sparse_parameters
+from rgcn_hetero import RGCN
+
+
+def make_graph(node_types):
+    """
+    Small graph with two relations. With node types, nodes 0-2 and 3-5 of the homogeneous version have types "1" and
+    "2", the global ids are the same
+    """
+    src = torch.tensor([0, 1, 2, 3, 4, 5, 0, 3, 5])
+    dst = torch.tensor([1, 2, 0, 4, 5, 3, 3, 1, 2])
+    rel = torch.tensor([0, 0, 0, 0, 0, 0, 1, 1, 1])
+    if not node_types:
+        return dgl.heterograph({
+            ("1", str(r), "1"): (src[rel == r], dst[rel == r]) for r in range(2)
+        }, {"1": 6})
+    relations = {}
+    for s, d, r in zip(src.tolist(), dst.tolist(), rel.tolist()):
+        signature = ("1" if s < 3 else "2", str(r), "1" if d < 3 else "2")
+        relations.setdefault(signature, ([], []))
+        relations[signature][0].append(s % 3)
+        relations[signature][1].append(d % 3)
+    return dgl.heterograph({key: (torch.tensor(s), torch.tensor(d)) for key, (s, d) in relations.items()},
+                           {"1": 3, "2": 3})
+
+
+def make_model(g, **kwargs):
+    torch.manual_seed(0)
+    return RGCN(g, 8, 4, num_bases=-1, num_hidden_layers=1, use_self_loop=True, **kwargs)
+
+
+@pytest.mark.parametrize("node_types", [False, True])
+def test_sampled_forward(node_types):
+    model = make_model(make_graph(node_types))
+    full = model()
+
+    # with all neighbors sampled, embeddings of seeds are the same as on the full graph
+    seeds = np.array([1, 3, 5])
+    sampled = model.sample_embeddings(create_sampler(model, -1), seeds)
+    assert torch.allclose(sampled[seeds], full[seeds], atol=1e-6)
+
+    blocks = create_sampler(model, -1).sample_blocks(seeds)
+    assert len(blocks) == model.num_blocks
+    assert torch.allclose(model(blocks), full[seeds], atol=1e-6)
+
+    assert create_sampler(model, None) is None
+
+
+@pytest.mark.parametrize("node_types", [False, True])
+def test_write_layers(tmp_path, node_types):
+    model = make_model(make_graph(node_types))
+    expected = model.get_layers()
+
+    # chunks smaller than the graph, so that layers read their inputs from the previous layer file
+    (tmp_path / "all").mkdir()
+    paths = model.write_layers(str(tmp_path / "all"), batch_size=4)
+    assert len(paths) == len(expected)
+    for path, layer in zip(paths, expected):
+        assert np.allclose(np.load(path), layer, atol=1e-5)
+
+    (tmp_path / "last").mkdir()
+    paths = model.write_layers(str(tmp_path / "last"), layers=[-1], batch_size=4)
+    assert sorted(p.name for p in (tmp_path / "last").iterdir()) == ["layer2.npy"]
+    assert np.allclose(np.load(paths[0]), expected[-1], atol=1e-5)
+
+
+def test_gat_write_layers(tmp_path):
+    g = dgl.add_self_loop(dgl.graph((torch.tensor([0, 1, 2, 3]), torch.tensor([1, 2, 3, 0]))))
+    torch.manual_seed(0)
+    model = GAT(g, 1, 8, 8, 4, [2, 1], F.elu, 0., 0., 0.2, False)
+    torch.nn.init.normal_(model.embed)
+    expected = model.get_layers()
+
+    paths = model.write_layers(str(tmp_path))
+    assert len(paths) == len(expected)
+    for path, layer in zip(paths, expected):
+        assert np.allclose(np.load(path), layer, atol=1e-5)
+
+    paths = model.write_layers(str(tmp_path), layers=[-1])
+    assert np.allclose(np.load(paths[0]), expected[-1], atol=1e-5)
+
+
+def test_sparse_embeddings():
+    model = make_model(make_graph(True), sparse_embeddings=True)
+    sparse = sparse_parameters(model)
+    assert len(sparse) > 0
+    optimizer = add_sparse_optimizer(torch.optim.Adam(dense_parameters(model), lr=0.01), model)
+    assert isinstance(optimizer, CombinedOptimizer)
+    dense_ids = {id(p) for group in optimizer.dense.param_groups for p in group["params"]}
+    assert dense_ids == {id(p) for p in dense_parameters(model)} and not dense_ids & {id(p) for p in sparse}
+
+    sparse_before = [p.detach().clone() for p in sparse]
+    dense_before = [p.detach().clone() for p in dense_parameters(model)]
+
+    blocks = create_sampler(model, 1).sample_blocks(np.array([1]))
+    optimizer.zero_grad()
+    (model(blocks) ** 2).sum().backward()
+    assert all(p.grad is None or p.grad.is_sparse for p in sparse)
+    optimizer.step()
+
+    # SparseAdam changes only rows that were looked up in the forward pass
+    looked_up, updated = 0, 0
+    for p, before in zip(sparse, sparse_before):
+        rows = set(p.grad.coalesce().indices()[0].tolist()) if p.grad is not None else set()
+        changed = set(torch.nonzero((p.detach() != before).any(dim=1)).flatten().tolist())
+        assert changed <= rows
+        looked_up += len(rows)
+        updated += len(changed)
+    assert 0 < updated and looked_up < sum(p.shape[0] for p in sparse)
+
+    assert any(not torch.equal(p.detach(), before) for p, before in zip(dense_parameters(model), dense_before))
+
+
+@pytest.mark.parametrize("node_types", [False, True])
+def test_shared_embeddings(node_types):
+    g = make_graph(node_types)
+    model = make_model(g, embed_mode="shared")
+    assert not hasattr(model.embed_layer, "embeds")
+    assert [model.embed_layer.node_embeds[ntype].shape[0] for ntype in g.ntypes] == \
+           [g.number_of_nodes(ntype) for ntype in g.ntypes]
+
+    full = model()
+    assert full.shape == (6, 4)
+    full.sum().backward()
+    assert all(table.grad is not None for table in model.embed_layer.node_embeds.values())
+    assert model.embed_layer.projection.weight.grad is not None
+
+    seeds = np.array([0, 4])
+    blocks = create_sampler(model, -1).sample_blocks(seeds)
+    model.zero_grad()
+    sampled = model(blocks)
+    assert torch.allclose(sampled, full[seeds], atol=1e-6)
+    sampled.sum().backward()
+    assert model.embed_layer.projection.weight.grad is not None
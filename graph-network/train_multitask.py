@@ -8,6 +8,10 @@ from RAdam import RAdam
 
 from ElementEmbedder import ElementEmbedder
 from LinkPredictor import LinkPredictor
+from models import create_sampler, dense_parameters, add_sparse_optimizer
+from Instrumentation import phase, add_samples, start_epoch, end_epoch
+from Checkpointer import AsyncCheckpointer, load_checkpoint
+from RankingEvaluator import element_queries, evaluate_ranking
 
 def evaluate_no_classes(logits, labels):
     pred = logits.argmax(1)
@@ -60,7 +64,9 @@ def prepare_batch_with_nodes(node_embeddings: torch.Tensor,
                              link_predictor: LinkPredictor,
                              indices: np.array,
                              batch_size: int,
-                             negative_factor: int):
+                             negative_factor: int,
+                             next_call_indices=None,
+                             negative_indices=None):
     """
     Creates a batch using graph embeddings. ElementEmbedder return indices of the nodes that are adjacent to the nodes
     given by indices.
@@ -70,6 +76,9 @@ def prepare_batch_with_nodes(node_embeddings: torch.Tensor,
     :param indices: indices in the current batch
     :param batch_size:
     :param negative_factor: by what what factor there should be more negative samples than positive
+    :param next_call_indices: positive targets for indices, sampled from elem_embeder if None
+    :param negative_indices: negative targets, sampled from elem_embeder if None. Targets are passed explicitly when
+        node embeddings are computed only for the sampled subgraph that must include them
     :return:
     """
     K = negative_factor
@@ -79,13 +88,16 @@ def prepare_batch_with_nodes(node_embeddings: torch.Tensor,
 
     # get embeddings for nodes in the current batch
     node_embeddings_batch = node_embeddings[indices]
-    next_call_indices = elem_embeder[indices]
+    if next_call_indices is None:
+        next_call_indices = elem_embeder[indices]
     next_call_embeddings = node_embeddings[next_call_indices]
     positive_batch = torch.cat([node_embeddings_batch, next_call_embeddings], 1)
     labels_pos = torch.ones(batch_size, dtype=torch.long)
 
     node_embeddings_neg_batch = node_embeddings_batch.repeat(K, 1)
-    negative_indices = elem_embeder.sample_negative(batch_size * K) # embeddings are sampled from 3/4 unigram distribution
+    if negative_indices is None:
+        with phase("negative_sampling"):
+            negative_indices = elem_embeder.sample_negative(batch_size * K) # embeddings are sampled from 3/4 unigram distribution
     negative_random = node_embeddings[negative_indices]
     negative_batch = torch.cat([node_embeddings_neg_batch, negative_random], 1)
     labels_neg = torch.zeros(batch_size * K, dtype=torch.long)
@@ -111,7 +123,8 @@ def prepare_batch_with_embeder(node_embeddings,
     labels_pos = torch.ones(batch_size, dtype=torch.long)
 
     node_embeddings_neg_batch = node_embeddings_batch.repeat(K, 1)
-    negative_indices = torch.LongTensor(elem_embeder.sample_negative(batch_size * K))
+    with phase("negative_sampling"):
+        negative_indices = torch.LongTensor(elem_embeder.sample_negative(batch_size * K))
     negative_random = elem_embeder(negative_indices)
     negative_batch = torch.cat([node_embeddings_neg_batch, negative_random], 1)
     labels_neg = torch.zeros(batch_size * K, dtype=torch.long)
@@ -124,6 +137,84 @@ def prepare_batch_with_embeder(node_embeddings,
     return logits, labels
 
 
+def pair_labels(batch_size, negative_factor):
+    """
+    Labels for batch_size positive pairs followed by batch_size * negative_factor negative pairs
+    """
+    labels = torch.zeros(batch_size * (1 + negative_factor), dtype=torch.long)
+    labels[:batch_size] = 1
+    return labels
+
+
+def prepare_multitask_batch(node_embeddings,
+                            ee_fname, ee_varuse, ee_apicall,
+                            lp_fname, lp_varuse, lp_apicall,
+                            indices_fname, indices_varuse, indices_apicall,
+                            negative_factor,
+                            next_call_indices=None,
+                            negative_call_indices=None,
+                            shared_negatives=None):
+    """
+    Fused version of prepare_batch_with_embeder for fname and varuse and prepare_batch_with_nodes for apicall.
+    Embeddings of all nodes that are needed by the three tasks are gathered with one lookup, positive and negative
+    targets of every task are embedded with one lookup, and link predictors score pairs with
+    LinkPredictor.forward_split, so that node embeddings are neither repeated for negatives nor concatenated with
+    target embeddings.
+
+    With shared_negatives, link predictors should be PairScorer. Every node is scored against the positive targets of
+    all nodes in the batch (in-batch negatives) and against shared_negatives targets sampled once for the whole batch.
+    Logits then have one column per candidate, and the label is the column of the positive target, so that the same
+    loss and accuracy functions apply.
+    :param node_embeddings: tensor with embeddings of all nodes or SampledEmbeddings
+    :param indices_fname: nodes in the batch for fname task, the batch sizes of tasks can differ
+    :param indices_varuse: nodes in the batch for varuse task
+    :param indices_apicall: nodes in the batch for apicall task
+    :param negative_factor: number of negative pairs for every positive pair
+    :param next_call_indices: positive targets for apicall, sampled from ee_apicall if None
+    :param negative_call_indices: negative targets for apicall, sampled from ee_apicall if None
+    :param shared_negatives: number of negatives shared by all nodes in the batch, None for negative_factor
+        negatives per node
+    :return: list of logits and list of labels, in the order fname, varuse, apicall
+    """
+    K = negative_factor
+    sizes = [indices_fname.size, indices_varuse.size, indices_apicall.size]
+
+    def num_negatives(size):
+        return size * K if shared_negatives is None else shared_negatives
+
+    with phase("negative_sampling"):
+        targets_fname = np.concatenate([ee_fname.sample_elements(indices_fname),
+                                        ee_fname.sample_negative(num_negatives(indices_fname.size))])
+        targets_varuse = np.concatenate([ee_varuse.sample_elements(indices_varuse),
+                                         ee_varuse.sample_negative(num_negatives(indices_varuse.size))])
+        if next_call_indices is None:
+            next_call_indices = ee_apicall.sample_elements(indices_apicall)
+        if negative_call_indices is None:
+            negative_call_indices = ee_apicall.sample_negative(num_negatives(indices_apicall.size))
+
+    nodes = node_embeddings[np.concatenate([
+        indices_fname, indices_varuse, indices_apicall, np.asarray(next_call_indices), negative_call_indices
+    ])]
+    nodes_fname, nodes_varuse, nodes_apicall, targets_apicall = torch.split(
+        nodes, sizes + [indices_apicall.size + num_negatives(indices_apicall.size)]
+    )
+
+    tasks = [
+        (lp_fname, nodes_fname, ee_fname(torch.from_numpy(targets_fname))),
+        (lp_varuse, nodes_varuse, ee_varuse(torch.from_numpy(targets_varuse))),
+        (lp_apicall, nodes_apicall, targets_apicall),
+    ]
+
+    if shared_negatives is None:
+        logits = [lp.forward_split(src, targets) for lp, src, targets in tasks]
+        labels = [pair_labels(size, K) for size in sizes]
+    else:
+        # the positive target of node i is candidate i
+        logits = [lp.score_candidates(src, targets) for lp, src, targets in tasks]
+        labels = [torch.arange(size) for size in sizes]
+    return logits, labels
+
+
 def final_evaluation_no_classes(model, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apicall, splits):
     pool_fname = set(ee_fname.elements['id'].to_list())
     pool_varuse = set(ee_varuse.elements['id'].to_list())
@@ -240,6 +331,46 @@ def final_evaluation_no_classes(model, ee_fname, ee_varuse, ee_apicall, lp_fname
             scores["test_acc_apicall"],
         ))
 
+    with torch.no_grad():
+        scores.update(ranking_evaluation(node_embeddings, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse,
+                                         lp_apicall, [("test", test_idx_fname, test_idx_varuse, test_idx_apicall),
+                                                      ("val", val_idx_fname, val_idx_varuse, val_idx_apicall)]))
+
+    return scores
+
+
+def ranking_evaluation(node_embeddings, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apicall, partitions,
+                       threads=None):
+    """
+    Rank the true targets of every node against all candidates of the task: all names for fname and varuse, all
+    called functions for apicall. Accuracy on 1:1 negatives saturates quickly, MRR and Hits@k over all candidates
+    allow to compare models.
+    :param node_embeddings: embeddings of all nodes
+    :param partitions: list of tuples (name, fname nodes, varuse nodes, apicall nodes)
+    :param threads: number of threads for scoring, all available by default
+    :return: dictionary with scores named as test_mrr_fname, test_hits@10_apicall
+    """
+    if threads is None:
+        threads = torch.get_num_threads()
+
+    call_candidates = np.unique(ee_apicall.indices)
+    tasks = [
+        ("fname", ee_fname, lp_fname, ee_fname.embed.weight, None),
+        ("varuse", ee_varuse, lp_varuse, ee_varuse.embed.weight, None),
+        ("apicall", ee_apicall, lp_apicall, node_embeddings[call_candidates], call_candidates),
+    ]
+
+    scores = {}
+    for partition, *indices in partitions:
+        for (task, ee, lp, candidates, candidate_ids), idx in zip(tasks, indices):
+            indptr, targets = element_queries(ee, idx, candidate_ids)
+            metrics = evaluate_ranking(node_embeddings[idx], candidates, indptr, targets,
+                                       scorer=lp.score_candidates, threads=threads)
+            print("Ranking Eval : %s %s MRR %.4f, Hits@1 %.4f, Hits@10 %.4f, %d targets" % (
+                partition, task, metrics["mrr"], metrics["hits@1"], metrics["hits@10"], metrics["num_queries"]))
+            for metric, value in metrics.items():
+                if metric != "num_queries":
+                    scores["{}_{}_{}".format(partition, metric, task)] = value
     return scores
 
 
@@ -251,7 +382,8 @@ def create_idx_pools(splits, pool):
     return train_idx, test_idx, val_idx
 
 
-def train(model, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apicall, splits, epochs):
+def train(model, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apicall, splits, epochs, sampler=None,
+          resume=None, shared_negatives=None, early_stopping=None):
     pool_fname = set(ee_fname.elements['id'].to_list())
     pool_varuse = set(ee_varuse.elements['id'].to_list())
     pool_apicall = set(ee_apicall.elements['id'].to_list())
@@ -275,7 +407,7 @@ def train(model, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apical
     #     ], lr=0.01)
     optimizer = RAdam(
         [
-            {'params': model.parameters(),},
+            {'params': dense_parameters(model),},
             {'params': ee_fname.parameters(),},
             {'params': ee_varuse.parameters(),},
             {'params': ee_apicall.parameters(),},
@@ -283,6 +415,7 @@ def train(model, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apical
             {'params': lp_varuse.parameters(),},
             {'params': lp_apicall.parameters(),},
         ], lr=0.01)
+    optimizer = add_sparse_optimizer(optimizer, model, lr=0.01)
 
     best_val_acc_fname = torch.tensor(0)
     best_test_acc_fname = torch.tensor(0)
@@ -294,7 +427,20 @@ def train(model, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apical
     batch_size = 4096
     K = 3  # negative oversampling factor
 
-    for epoch in range(epochs):
+    first_epoch = 0
+    if resume is not None:
+        # checkpoints of older versions do not have optimizer state
+        if 'optimizer' in resume:
+            optimizer.load_state_dict(resume['optimizer'])
+        first_epoch = resume['epoch'] + 1
+
+    checkpointer = AsyncCheckpointer("saved_state.pt")
+
+    if early_stopping is not None:
+        early_stopping.start()
+
+    for epoch in range(first_epoch, epochs):
+        start_epoch(epoch)
 
         # since we train in batches, we need to iterate over the nodes
         # since indexes are sampled randomly, it is a little bit hard to make sure we cover all data
@@ -303,97 +449,83 @@ def train(model, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apical
         num_batches = len(ee_fname) // batch_size
 
         for batch_ind in range(num_batches):
-            node_embeddings = model()
-
-            random_batch_fname = np.random.choice(train_idx_fname, size=batch_size)
-            random_batch_varuse = np.random.choice(train_idx_varuse, size=batch_size)
-            random_batch_apicall = np.random.choice(train_idx_apicall, size=batch_size)
-
-            train_logits_fname, train_labels_fname = prepare_batch_with_embeder(node_embeddings,
-                                                                              ee_fname,
-                                                                              lp_fname,
-                                                                              random_batch_fname,
-                                                                              batch_size,
-                                                                              K)
-
-            train_logits_varuse, train_labels_varuse = prepare_batch_with_embeder(node_embeddings,
-                                                                                ee_varuse,
-                                                                                lp_varuse,
-                                                                                random_batch_varuse,
-                                                                                batch_size,
-                                                                                K)
-
-            train_logits_apicall, train_labels_apicall = prepare_batch_with_nodes(node_embeddings,
-                                                                                  ee_apicall,
-                                                                                  lp_apicall,
-                                                                                  random_batch_apicall,
-                                                                                  batch_size,
-                                                                                  K)
-
-            train_acc_fname = evaluate_no_classes(train_logits_fname, train_labels_fname)
-            train_acc_varuse = evaluate_no_classes(train_logits_varuse, train_labels_varuse)
-            train_acc_apicall = evaluate_no_classes(train_logits_apicall, train_labels_apicall)
-
-            train_logits = torch.cat([train_logits_fname, train_logits_varuse, train_logits_apicall], 0)
-            train_labels = torch.cat([train_labels_fname, train_labels_varuse, train_labels_apicall], 0)
-
-            logp = nn.functional.log_softmax(train_logits, 1)
-            loss = nn.functional.nll_loss(logp, train_labels)
-
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with phase("batch_sampling"):
+                random_batch_fname = np.random.choice(train_idx_fname, size=batch_size)
+                random_batch_varuse = np.random.choice(train_idx_varuse, size=batch_size)
+                random_batch_apicall = np.random.choice(train_idx_apicall, size=batch_size)
+
+            if sampler is None:
+                with phase("gnn_forward"):
+                    node_embeddings = model()
+                next_call_indices = None
+                negative_call_indices = None
+            else:
+                # targets of apicall are nodes as well, compute embeddings for the receptive field of all of them
+                with phase("negative_sampling"):
+                    next_call_indices = ee_apicall[random_batch_apicall]
+                    negative_call_indices = ee_apicall.sample_negative(
+                        batch_size * K if shared_negatives is None else shared_negatives
+                    )
+                with phase("gnn_forward"):
+                    node_embeddings = model.sample_embeddings(sampler, np.concatenate([
+                        random_batch_fname, random_batch_varuse, random_batch_apicall,
+                        next_call_indices.numpy(), negative_call_indices
+                    ]))
+
+            with phase("batch_preparation"):
+                train_logits, train_labels = prepare_multitask_batch(node_embeddings,
+                                                                     ee_fname, ee_varuse, ee_apicall,
+                                                                     lp_fname, lp_varuse, lp_apicall,
+                                                                     random_batch_fname,
+                                                                     random_batch_varuse,
+                                                                     random_batch_apicall,
+                                                                     K,
+                                                                     next_call_indices,
+                                                                     negative_call_indices,
+                                                                     shared_negatives)
+
+            train_acc_fname, train_acc_varuse, train_acc_apicall = \
+                [evaluate_no_classes(logits, labels) for logits, labels in zip(train_logits, train_labels)]
+
+            # tasks have the same number of pairs, the average of task losses equals the loss over all pairs
+            loss = sum(
+                nn.functional.nll_loss(nn.functional.log_softmax(logits, 1), labels)
+                for logits, labels in zip(train_logits, train_labels)
+            ) / len(train_logits)
+
+            with phase("backward"):
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+            add_samples(3 * batch_size)
 
             if batch_ind % 1 == 0:
                 print("\r%d/%d batches complete, fname acc: %.4f, varuse acc: %.4f, apicall acc: %.4f" % (
                 batch_ind, num_batches, train_acc_fname.item(), train_acc_varuse.item(), train_acc_apicall.item()),
                       end="\n")
 
-        test_logits_fname, test_labels_fname = prepare_batch_with_embeder(node_embeddings,
-                                                                        ee_fname,
-                                                                        lp_fname,
-                                                                        test_idx_fname,
-                                                                        test_idx_fname.size,
-                                                                        1)
-        test_logits_varuse, test_labels_varuse = prepare_batch_with_embeder(node_embeddings,
-                                                                          ee_varuse,
-                                                                          lp_varuse,
-                                                                          test_idx_varuse,
-                                                                          test_idx_varuse.size,
-                                                                          1)
-        test_logits_apicall, test_labels_apicall = prepare_batch_with_nodes(node_embeddings,
-                                                                            ee_apicall,
-                                                                            lp_apicall,
-                                                                            test_idx_apicall,
-                                                                            test_idx_apicall.size,
-                                                                            1)
-
-        val_logits_fname, val_labels_fname = prepare_batch_with_embeder(node_embeddings,
-                                                                      ee_fname,
-                                                                      lp_fname,
-                                                                      val_idx_fname,
-                                                                      val_idx_fname.size,
-                                                                      1)
-        val_logits_varuse, val_labels_varuse = prepare_batch_with_embeder(node_embeddings,
-                                                                        ee_varuse,
-                                                                        lp_varuse,
-                                                                        val_idx_varuse,
-                                                                        val_idx_varuse.size,
-                                                                        1)
-        val_logits_apicall, val_labels_apicall = prepare_batch_with_nodes(node_embeddings,
-                                                                          ee_apicall,
-                                                                          lp_apicall,
-                                                                          val_idx_apicall,
-                                                                          val_idx_apicall.size,
-                                                                          1)
-
-        test_acc_fname, test_acc_varuse, test_acc_apicall, val_acc_fname, val_acc_varuse, val_acc_apicall = \
-            evaluate_no_classes(test_logits_fname, test_labels_fname), \
-            evaluate_no_classes(test_logits_varuse, test_labels_varuse), \
-            evaluate_no_classes(test_logits_apicall, test_labels_apicall), \
-            evaluate_no_classes(val_logits_fname, val_labels_fname), \
-            evaluate_no_classes(val_logits_varuse, val_labels_varuse), \
-            evaluate_no_classes(val_logits_apicall, val_labels_apicall)
+        with phase("evaluation"):
+            if sampler is not None:
+                # evaluation requires embeddings for all test and validation nodes
+                with torch.no_grad():
+                    node_embeddings = model()
+
+            test_logits, test_labels = prepare_multitask_batch(node_embeddings,
+                                                               ee_fname, ee_varuse, ee_apicall,
+                                                               lp_fname, lp_varuse, lp_apicall,
+                                                               test_idx_fname, test_idx_varuse, test_idx_apicall,
+                                                               1)
+            val_logits, val_labels = prepare_multitask_batch(node_embeddings,
+                                                             ee_fname, ee_varuse, ee_apicall,
+                                                             lp_fname, lp_varuse, lp_apicall,
+                                                             val_idx_fname, val_idx_varuse, val_idx_apicall,
+                                                             1)
+
+            test_acc_fname, test_acc_varuse, test_acc_apicall = \
+                [evaluate_no_classes(logits, labels) for logits, labels in zip(test_logits, test_labels)]
+            val_acc_fname, val_acc_varuse, val_acc_apicall = \
+                [evaluate_no_classes(logits, labels) for logits, labels in zip(val_logits, val_labels)]
 
         track_best(epoch, loss, train_acc_fname, val_acc_fname, test_acc_fname,
                    train_acc_varuse, val_acc_varuse, test_acc_varuse,
@@ -402,19 +534,46 @@ def train(model, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apical
                    best_val_acc_varuse, best_test_acc_varuse,
                    best_val_acc_apicall, best_test_acc_apicall)
 
-        torch.save({
-            'm': model.state_dict(),
-            'ee_fname': ee_fname.state_dict(),
-            'ee_varuse': ee_varuse.state_dict(),
-            'ee_apicall': ee_apicall.state_dict(),
-            "lp_fname": lp_fname.state_dict(),
-            "lp_varuse": lp_varuse.state_dict(),
-            "lp_apicall": lp_apicall.state_dict(),
-            "epoch": epoch
-        }, "saved_state.pt")
+        with phase("checkpoint"):
+            checkpointer.save({
+                'm': model.state_dict(),
+                'ee_fname': ee_fname.state_dict(),
+                'ee_varuse': ee_varuse.state_dict(),
+                'ee_apicall': ee_apicall.state_dict(),
+                "lp_fname": lp_fname.state_dict(),
+                "lp_varuse": lp_varuse.state_dict(),
+                "lp_apicall": lp_apicall.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "epoch": epoch
+            })
 
+        end_epoch(epoch, loss=loss.item(), val_acc_fname=val_acc_fname.item(), val_acc_varuse=val_acc_varuse.item(),
+                  val_acc_apicall=val_acc_apicall.item())
+
+        val_acc_mean = (val_acc_fname.item() + val_acc_varuse.item() + val_acc_apicall.item()) / 3
+        if early_stopping is not None and early_stopping.step(epoch, val_acc_mean):
+            print(early_stopping.summary())
+            break
+
+    if early_stopping is not None:
+        early_stopping.finish()
+
+    # wait for the last checkpoint
+    checkpointer.close()
+
+
+def training_procedure(dataset, model, params, EPOCHS, api_seq_file, fname_file, var_use_file, restore_state,
+                       fanout=None, scorer="mlp", shared_negatives=None, early_stopping=None):
+    """
+
+    :param scorer: "mlp" for LinkPredictor, or "dot", "distmult", "bilinear" for PairScorer
+    :param shared_negatives: train with in-batch negatives and the given number of negatives shared by the batch.
+        Requires scorer other than "mlp"
+    :param early_stopping: EarlyStopping that monitors the mean validation accuracy of the three tasks
+    """
+    if shared_negatives is not None and scorer == "mlp":
+        raise ValueError("Shared negatives require dot, distmult or bilinear scorer")
 
-def training_procedure(dataset, model, params, EPOCHS, api_seq_file, fname_file, var_use_file, restore_state):
     NODE_EMB_SIZE = 100
     ELEM_EMB_SIZE = 100
 
@@ -422,6 +581,8 @@ def training_procedure(dataset, model, params, EPOCHS, api_seq_file, fname_file,
               num_classes=NODE_EMB_SIZE,
               **params)
 
+    sampler = create_sampler(m, fanout)
+
     def create_elem_embedder(file_path, nodes, emb_size, compact_dst):
         element_data = pd.read_csv(file_path)
         function2nodeid = dict(zip(nodes['id'].values, nodes['global_graph_id'].values))
@@ -438,27 +599,31 @@ def training_procedure(dataset, model, params, EPOCHS, api_seq_file, fname_file,
     ee_varuse = create_elem_embedder(var_use_file, dataset.nodes, ELEM_EMB_SIZE, True)
     ee_apicall = create_elem_embedder(api_seq_file, dataset.nodes, ELEM_EMB_SIZE, False)
 
-    from LinkPredictor import LinkPredictor
-    lp_fname = LinkPredictor(ee_fname.emb_size + m.emb_size)
-    lp_varuse = LinkPredictor(ee_varuse.emb_size + m.emb_size)
-    lp_apicall = LinkPredictor(m.emb_size + m.emb_size)
+    from LinkPredictor import create_link_predictor
+    lp_fname = create_link_predictor(scorer, m.emb_size, ee_fname.emb_size)
+    lp_varuse = create_link_predictor(scorer, m.emb_size, ee_varuse.emb_size)
+    lp_apicall = create_link_predictor(scorer, m.emb_size, m.emb_size)
 
+    resume = None
     if restore_state:
-        checkpoint = torch.load("saved_state.pt")
+        checkpoint = load_checkpoint("saved_state.pt")
         m.load_state_dict(checkpoint['m'])
         ee_fname.load_state_dict(checkpoint['ee_fname'])
         ee_varuse.load_state_dict(checkpoint['ee_varuse'])
         ee_apicall.load_state_dict(checkpoint['ee_apicall'])
         lp_fname.load_state_dict(checkpoint['lp_fname'])
-        lp_varuse.load_state_dict(checkpoint['lp_fname'])
+        lp_varuse.load_state_dict(checkpoint['lp_varuse'])
         lp_apicall.load_state_dict(checkpoint['lp_apicall'])
         print(f"Restored from epoch {checkpoint['epoch']}")
+        # optimizer is created during training, keep only its state
+        resume = {key: checkpoint[key] for key in ("optimizer", "epoch") if key in checkpoint}
         checkpoint = None
 
     # from train_vector_sim_with_classifier import train_no_classes, final_evaluation_no_classes
 
     try:
-        train(m, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apicall, dataset.splits, EPOCHS)
+        train(m, ee_fname, ee_varuse, ee_apicall, lp_fname, lp_varuse, lp_apicall, dataset.splits, EPOCHS,
+              sampler=sampler, resume=resume, shared_negatives=shared_negatives, early_stopping=early_stopping)
     except KeyboardInterrupt:
         print("Training interrupted")
     finally:
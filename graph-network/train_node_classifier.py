@@ -4,6 +4,10 @@ import dgl.function as fn
 from dgl.nn.pytorch import edge_softmax, GATConv
 import numpy as np
 
+from models import dense_parameters, add_sparse_optimizer
+from Instrumentation import phase, add_samples, start_epoch, end_epoch
+from Checkpointer import AsyncCheckpointer, load_checkpoint
+
 def evaluate(logits, labels, train_idx, test_idx, val_idx):
 
     pred = logits.argmax(1)
@@ -41,13 +45,14 @@ def final_evaluation(model, g_labels, splits):
     return scores
 
 
-def train(model, g_labels, splits, epochs):
+def train(model, g_labels, splits, epochs, resume=None, early_stopping=None):
     """
     Training procedure for the model with node classifier.
     :param model:
     :param g_labels:
     :param splits:
     :param epochs:
+    :param early_stopping: EarlyStopping that monitors validation accuracy, None to train for all epochs
     :return:
     """
 
@@ -56,13 +61,29 @@ def train(model, g_labels, splits, epochs):
 
     heldout_idx = test_idx.tolist() + val_idx.tolist()
 
-    optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    optimizer = torch.optim.Adam(dense_parameters(model), lr=0.01)
+    optimizer = add_sparse_optimizer(optimizer, model, lr=0.01)
 
     best_val_acc = torch.tensor(0)
     best_test_acc = torch.tensor(0)
 
-    for epoch in range(epochs):
-        logits = model()
+    first_epoch = 0
+    if resume is not None:
+        # checkpoints of older versions do not have optimizer state
+        if 'optimizer' in resume:
+            optimizer.load_state_dict(resume['optimizer'])
+        first_epoch = resume['epoch'] + 1
+
+    checkpointer = AsyncCheckpointer("saved_state.pt")
+
+    if early_stopping is not None:
+        early_stopping.start()
+
+    for epoch in range(first_epoch, epochs):
+        start_epoch(epoch)
+
+        with phase("gnn_forward"):
+            logits = model()
 
         train_acc, val_acc, test_acc = evaluate(logits, labels, train_idx, test_idx, val_idx)
 
@@ -73,9 +94,12 @@ def train(model, g_labels, splits, epochs):
 
         logp = nn.functional.log_softmax(logits, 1)
         loss = nn.functional.nll_loss(logp[train_idx], labels[train_idx])
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        with phase("backward"):
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        add_samples(len(train_idx))
 
         if best_val_acc < val_acc:
             best_val_acc = val_acc
@@ -91,27 +115,44 @@ def train(model, g_labels, splits, epochs):
             best_test_acc.item(),
         ))
 
-        torch.save({
-            'm': model.state_dict(),
-            "epoch": epoch
-        }, "saved_state.pt")
+        with phase("checkpoint"):
+            checkpointer.save({
+                'm': model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "epoch": epoch
+            })
+
+        end_epoch(epoch, loss=loss.item(), val_acc=val_acc.item())
+
+        if early_stopping is not None and early_stopping.step(epoch, val_acc.item()):
+            print(early_stopping.summary())
+            break
+
+    if early_stopping is not None:
+        early_stopping.finish()
+
+    # wait for the last checkpoint
+    checkpointer.close()
 
     return heldout_idx
 
-def training_procedure(dataset, model, params, EPOCHS, restore_state):
+def training_procedure(dataset, model, params, EPOCHS, restore_state, early_stopping=None):
     m = model(dataset.g,
               num_classes=dataset.num_classes,
               produce_logits=True,
               **params)
 
+    resume = None
     if restore_state:
-        checkpoint = torch.load("saved_state.pt")
+        checkpoint = load_checkpoint("saved_state.pt")
         m.load_state_dict(checkpoint['m'])
         print(f"Restored from epoch {checkpoint['epoch']}")
+        # optimizer is created during training, keep only its state
+        resume = {key: checkpoint[key] for key in ("optimizer", "epoch") if key in checkpoint}
         checkpoint = None
 
     try:
-        train(m, dataset.labels, dataset.splits, EPOCHS)
+        train(m, dataset.labels, dataset.splits, EPOCHS, resume=resume, early_stopping=early_stopping)
     except KeyboardInterrupt:
         print("Training interrupted")
     finally:
@@ -4,6 +4,10 @@ import dgl.function as fn
 from dgl.nn.pytorch import edge_softmax, GATConv
 import numpy as np
 
+from models import create_sampler, dense_parameters, add_sparse_optimizer
+from Instrumentation import phase, add_samples, start_epoch, end_epoch
+from Checkpointer import AsyncCheckpointer, load_checkpoint
+
 
 def evaluate_no_classes(logits, labels):
     # pred = logits.argmax(1)
@@ -42,7 +46,8 @@ def prepare_batch_no_classes(node_embeddings,
 
     node_embeddings_neg_batch = node_embeddings_batch.repeat(K, 1)
     # negative_indices = torch.LongTensor(np.random.randint(low=0, high=elem_embeder.n_elements, size=batch_size * K))
-    negative_indices = torch.LongTensor(elem_embeder.sample_negative(batch_size * K))
+    with phase("negative_sampling"):
+        negative_indices = torch.LongTensor(elem_embeder.sample_negative(batch_size * K))
     negative_random = elem_embeder(negative_indices)
     # negative_batch = torch.cat([node_embeddings_neg_batch, negative_random], 1)
     labels_neg = torch.zeros(batch_size * K)
@@ -112,7 +117,7 @@ def final_evaluation_no_classes(model, elem_embeder, splits):
     return scores
 
 
-def train_no_classes(model, elem_embeder, splits, epochs):
+def train_no_classes(model, elem_embeder, splits, epochs, sampler=None, resume=None, early_stopping=None):
     train_idx, test_idx, val_idx = splits
 
     pool = set(elem_embeder.elements['id'].to_list())
@@ -129,9 +134,10 @@ def train_no_classes(model, elem_embeder, splits, epochs):
     heldout_idx = test_idx.tolist() + val_idx.tolist()
 
     optimizer = torch.optim.Adagrad([
-            {'params': model.parameters(), 'lr': 1e-2},
+            {'params': dense_parameters(model), 'lr': 1e-2},
             {'params': elem_embeder.parameters(), 'lr': 1e-1}
         ], lr=0.01)
+    optimizer = add_sparse_optimizer(optimizer, model, lr=1e-2)
 
     best_val_acc = torch.tensor(0)
     best_test_acc = torch.tensor(0)
@@ -139,7 +145,20 @@ def train_no_classes(model, elem_embeder, splits, epochs):
     batch_size = 4096
     K = 3  # negative oversampling factor
 
-    for epoch in range(epochs):
+    first_epoch = 0
+    if resume is not None:
+        # checkpoints of older versions do not have optimizer state
+        if 'optimizer' in resume:
+            optimizer.load_state_dict(resume['optimizer'])
+        first_epoch = resume['epoch'] + 1
+
+    checkpointer = AsyncCheckpointer("saved_state.pt")
+
+    if early_stopping is not None:
+        early_stopping.start()
+
+    for epoch in range(first_epoch, epochs):
+        start_epoch(epoch)
 
         # since we train in batches, we need to iterate over the nodes
         # since indexes are sampled randomly, it is a little bit hard to make sure we cover all data
@@ -148,52 +167,81 @@ def train_no_classes(model, elem_embeder, splits, epochs):
         num_batches = len(elem_embeder) // batch_size
         for batch_ind in range(num_batches):
 
-            node_embeddings = model()
+            with phase("batch_sampling"):
+                random_batch = np.random.choice(train_idx, size=batch_size)
 
-            random_batch = np.random.choice(train_idx, size=batch_size)
+            with phase("gnn_forward"):
+                if sampler is None:
+                    node_embeddings = model()
+                else:
+                    node_embeddings = model.sample_embeddings(sampler, random_batch)
 
-            train_logits, train_labels = prepare_batch_no_classes(node_embeddings,
-                                                                  elem_embeder,
-                                                                  random_batch,
-                                                                  batch_size,
-                                                                  K)
+            with phase("batch_preparation"):
+                train_logits, train_labels = prepare_batch_no_classes(node_embeddings,
+                                                                      elem_embeder,
+                                                                      random_batch,
+                                                                      batch_size,
+                                                                      K)
 
             train_acc = evaluate_no_classes(train_logits, train_labels)
 
             # logp = nn.functional.log_softmax(train_logits, 1)
             # loss = nn.functional.nll_loss(logp, train_labels)
             loss = nn.functional.binary_cross_entropy_with_logits(train_logits, train_labels)
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with phase("backward"):
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+            add_samples(batch_size)
 
             if batch_ind % 1 == 0:
                 print("\r%d/%d batches complete, acc: %.4f" % (batch_ind, num_batches, train_acc.item()), end="\n")
 
-        test_logits, test_labels = prepare_batch_no_classes(node_embeddings,
-                                                            elem_embeder,
-                                                            test_idx,
-                                                            test_idx.size,
-                                                            1)
+        with phase("evaluation"):
+            if sampler is not None:
+                # evaluation requires embeddings for all test and validation nodes
+                with torch.no_grad():
+                    node_embeddings = model()
 
-        val_logits, val_labels = prepare_batch_no_classes(node_embeddings,
-                                                          elem_embeder,
-                                                          val_idx,
-                                                          val_idx.size,
-                                                          1)
+            test_logits, test_labels = prepare_batch_no_classes(node_embeddings,
+                                                                elem_embeder,
+                                                                test_idx,
+                                                                test_idx.size,
+                                                                1)
+
+            val_logits, val_labels = prepare_batch_no_classes(node_embeddings,
+                                                              elem_embeder,
+                                                              val_idx,
+                                                              val_idx.size,
+                                                              1)
 
-        test_acc, val_acc = evaluate_no_classes(test_logits, test_labels), \
-                            evaluate_no_classes(val_logits, val_labels)
+            test_acc, val_acc = evaluate_no_classes(test_logits, test_labels), \
+                                evaluate_no_classes(val_logits, val_labels)
 
         track_best(epoch, loss, train_acc, val_acc, test_acc, best_val_acc, best_test_acc)
 
-        torch.save({
-            'm': model.state_dict(),
-            'ee': elem_embeder.state_dict(),
-            "epoch": epoch
-        }, "saved_state.pt")
+        with phase("checkpoint"):
+            checkpointer.save({
+                'm': model.state_dict(),
+                'ee': elem_embeder.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "epoch": epoch
+            })
+
+        end_epoch(epoch, loss=loss.item(), val_acc=val_acc.item())
+
+        if early_stopping is not None and early_stopping.step(epoch, val_acc.item()):
+            print(early_stopping.summary())
+            break
+
+    if early_stopping is not None:
+        early_stopping.finish()
+
+    # wait for the last checkpoint
+    checkpointer.close()
 
-def training_procedure(dataset, model, params, EPOCHS, restore_state):
+def training_procedure(dataset, model, params, EPOCHS, restore_state, fanout=None, early_stopping=None):
 
     NODE_EMB_SIZE = 100
     ELEM_EMB_SIZE = 100
@@ -215,18 +263,22 @@ def training_procedure(dataset, model, params, EPOCHS, restore_state):
 
     assert ee.emb_size == m.emb_size, "Embedding sizes for GNN and ElementEmbedder should match"
 
+    resume = None
     if restore_state:
-        checkpoint = torch.load("saved_state.pt")
+        checkpoint = load_checkpoint("saved_state.pt")
         m.load_state_dict(checkpoint['m'])
         ee.load_state_dict(checkpoint['ee'])
         print(f"Restored from epoch {checkpoint['epoch']}")
+        # optimizer is created during training, keep only its state
+        resume = {key: checkpoint[key] for key in ("optimizer", "epoch") if key in checkpoint}
         checkpoint = None
 
     # from LinkPredictor import LinkPredictor
     # lp = LinkPredictor(ee.emb_size + m.emb_size)
 
     try:
-        train_no_classes(m, ee, dataset.splits, EPOCHS)
+        train_no_classes(m, ee, dataset.splits, EPOCHS, sampler=create_sampler(m, fanout), resume=resume,
+                         early_stopping=early_stopping)
     except KeyboardInterrupt:
         print("Training interrupted")
     finally:
@@ -8,6 +8,9 @@ import pickle
 
 from ElementEmbedder import ElementEmbedder
 from LinkPredictor import LinkPredictor
+from models import create_sampler, dense_parameters, add_sparse_optimizer
+from Instrumentation import phase, add_samples, start_epoch, end_epoch
+from Checkpointer import AsyncCheckpointer, load_checkpoint
 
 def evaluate_no_classes(logits, labels):
     pred = logits.argmax(1)
@@ -36,7 +39,9 @@ def prepare_batch_no_classes(node_embeddings: torch.Tensor,
                              link_predictor: LinkPredictor,
                              indices: np.array,
                              batch_size: int,
-                             negative_factor: int):
+                             negative_factor: int,
+                             next_call_indices=None,
+                             negative_indices=None):
     """
     Creates a batch using graph embeddings. ElementEmbedder return indices of the nodes that are adjacent to the nodes
     given by indices.
@@ -46,6 +51,9 @@ def prepare_batch_no_classes(node_embeddings: torch.Tensor,
     :param indices: indices in the current batch
     :param batch_size:
     :param negative_factor: by what what factor there should be more negative samples than positive
+    :param next_call_indices: positive targets for indices, sampled from elem_embeder if None
+    :param negative_indices: negative targets, sampled from elem_embeder if None. Targets are passed explicitly when
+        node embeddings are computed only for the sampled subgraph that must include them
     :return:
     """
     K = negative_factor
@@ -55,13 +63,16 @@ def prepare_batch_no_classes(node_embeddings: torch.Tensor,
 
     # get embeddings for nodes in the current batch
     node_embeddings_batch = node_embeddings[indices]
-    next_call_indices = elem_embeder[indices]
+    if next_call_indices is None:
+        next_call_indices = elem_embeder[indices]
     next_call_embeddings = node_embeddings[next_call_indices]
     positive_batch = torch.cat([node_embeddings_batch, next_call_embeddings], 1)
     labels_pos = torch.ones(batch_size, dtype=torch.long)
 
     node_embeddings_neg_batch = node_embeddings_batch.repeat(K, 1)
-    negative_indices = elem_embeder.sample_negative(batch_size * K) # embeddings are sampled from 3/4 unigram distribution
+    if negative_indices is None:
+        with phase("negative_sampling"):
+            negative_indices = elem_embeder.sample_negative(batch_size * K) # embeddings are sampled from 3/4 unigram distribution
     negative_random = node_embeddings[negative_indices]
     negative_batch = torch.cat([node_embeddings_neg_batch, negative_random], 1)
     labels_neg = torch.zeros(batch_size * K, dtype=torch.long)
@@ -129,7 +140,8 @@ def final_evaluation_no_classes(model, elem_embeder, link_predictor, splits):
     return scores
 
 
-def train_no_classes(model, elem_embeder, link_predictor, splits, epochs):
+def train_no_classes(model, elem_embeder, link_predictor, splits, epochs, sampler=None, resume=None,
+                     early_stopping=None):
     # there should be no (significant) leak of training signal from the train to test set. the src nodes appear
     # either in train or in test set. If an node A is from train set, node B is from test set, and C is a common target,
     # then edge A->C is used for training, B->C used for testing. But in future experiments embedding for C is trained
@@ -155,9 +167,10 @@ def train_no_classes(model, elem_embeder, link_predictor, splits, epochs):
 
     optimizer = torch.optim.Adagrad(
         [
-            {'params': model.parameters(), 'lr': 1e-2},
+            {'params': dense_parameters(model), 'lr': 1e-2},
             {'params': link_predictor.parameters(), 'lr': 1e-2}
         ], lr=0.01)
+    optimizer = add_sparse_optimizer(optimizer, model, lr=1e-2)
 
     best_val_acc = torch.tensor(0)
     best_test_acc = torch.tensor(0)
@@ -165,7 +178,20 @@ def train_no_classes(model, elem_embeder, link_predictor, splits, epochs):
     batch_size = 4096
     K = 3  # negative oversampling factor
 
-    for epoch in range(epochs):
+    first_epoch = 0
+    if resume is not None:
+        # checkpoints of older versions do not have optimizer state
+        if 'optimizer' in resume:
+            optimizer.load_state_dict(resume['optimizer'])
+        first_epoch = resume['epoch'] + 1
+
+    checkpointer = AsyncCheckpointer("saved_state.pt")
+
+    if early_stopping is not None:
+        early_stopping.start()
+
+    for epoch in range(first_epoch, epochs):
+        start_epoch(epoch)
 
         # since we train in batches, we need to iterate over the nodes
         # since indexes are sampled randomly, it is a little bit hard to make sure we cover all data
@@ -174,60 +200,99 @@ def train_no_classes(model, elem_embeder, link_predictor, splits, epochs):
         num_batches = len(elem_embeder) // batch_size
 
         for batch_ind in range(num_batches):
-            node_embeddings = model()
-
-            random_batch = np.random.choice(train_idx, size=batch_size)
-
-
-            train_logits, train_labels = prepare_batch_no_classes(node_embeddings,
-                                                                  elem_embeder,
-                                                                  link_predictor,
-                                                                  random_batch,
-                                                                  batch_size,
-                                                                  K)
+            with phase("batch_sampling"):
+                random_batch = np.random.choice(train_idx, size=batch_size)
+
+            if sampler is None:
+                with phase("gnn_forward"):
+                    node_embeddings = model()
+                next_call_indices = None
+                negative_indices = None
+            else:
+                # targets are nodes as well, compute embeddings for the receptive field of all of them
+                with phase("negative_sampling"):
+                    next_call_indices = elem_embeder[random_batch]
+                    negative_indices = elem_embeder.sample_negative(batch_size * K)
+                with phase("gnn_forward"):
+                    node_embeddings = model.sample_embeddings(sampler, np.concatenate([
+                        random_batch, next_call_indices.numpy(), negative_indices
+                    ]))
+
+            with phase("batch_preparation"):
+                train_logits, train_labels = prepare_batch_no_classes(node_embeddings,
+                                                                      elem_embeder,
+                                                                      link_predictor,
+                                                                      random_batch,
+                                                                      batch_size,
+                                                                      K,
+                                                                      next_call_indices,
+                                                                      negative_indices)
 
             train_acc = evaluate_no_classes(train_logits, train_labels)
 
             logp = nn.functional.log_softmax(train_logits, 1)
             loss = nn.functional.nll_loss(logp, train_labels)
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with phase("backward"):
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+            add_samples(batch_size)
 
             if batch_ind % 1 == 0:
                 print("\r%d/%d batches complete, acc: %.4f / %.4f" % (batch_ind, num_batches, train_acc.item(), np.average(train_labels.numpy())), end="\n")
 
-
-        test_logits, test_labels = prepare_batch_no_classes(node_embeddings,
-                                                            elem_embeder,
-                                                            link_predictor,
-                                                            test_idx,
-                                                            test_idx.size,
-                                                            1)
-
-        val_logits, val_labels = prepare_batch_no_classes(node_embeddings,
-                                                          elem_embeder,
-                                                          link_predictor,
-                                                          val_idx,
-                                                          val_idx.size,
-                                                          1)
-
-        test_acc, val_acc = evaluate_no_classes(test_logits, test_labels), \
-                            evaluate_no_classes(val_logits, val_labels)
+        with phase("evaluation"):
+            if sampler is not None:
+                # evaluation requires embeddings for all test and validation nodes
+                with torch.no_grad():
+                    node_embeddings = model()
+
+            test_logits, test_labels = prepare_batch_no_classes(node_embeddings,
+                                                                elem_embeder,
+                                                                link_predictor,
+                                                                test_idx,
+                                                                test_idx.size,
+                                                                1)
+
+            val_logits, val_labels = prepare_batch_no_classes(node_embeddings,
+                                                              elem_embeder,
+                                                              link_predictor,
+                                                              val_idx,
+                                                              val_idx.size,
+                                                              1)
+
+            test_acc, val_acc = evaluate_no_classes(test_logits, test_labels), \
+                                evaluate_no_classes(val_logits, val_labels)
 
         # print(np.average(test_labels.numpy()), np.average(val_labels.numpy()))
         track_best(epoch, loss, train_acc, val_acc, test_acc, best_val_acc, best_test_acc)
         # pickle.dump(node_embeddings.detach().numpy(), open("nodes.pkl", "wb"))
         # elem_embeder.elements.to_csv("edges.csv", index=False)
-        torch.save({
-            'm': model.state_dict(),
-            'ee': elem_embeder.state_dict(),
-            "lp": link_predictor.state_dict(),
-            "epoch": epoch
-        }, "saved_state.pt")
-
-def training_procedure(dataset, model, params, EPOCHS, call_seq_file, restore_state):
+        with phase("checkpoint"):
+            checkpointer.save({
+                'm': model.state_dict(),
+                'ee': elem_embeder.state_dict(),
+                "lp": link_predictor.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "epoch": epoch
+            })
+
+        end_epoch(epoch, loss=loss.item(), val_acc=val_acc.item())
+
+        if early_stopping is not None and early_stopping.step(epoch, val_acc.item()):
+            print(early_stopping.summary())
+            break
+
+    if early_stopping is not None:
+        early_stopping.finish()
+
+    # wait for the last checkpoint
+    checkpointer.close()
+
+def training_procedure(dataset, model, params, EPOCHS, call_seq_file, restore_state, fanout=None,
+                       early_stopping=None):
     NODE_EMB_SIZE = 100
     ELEM_EMB_SIZE = 100
 
@@ -253,16 +318,20 @@ def training_procedure(dataset, model, params, EPOCHS, call_seq_file, restore_st
     from LinkPredictor import LinkPredictor
     lp = LinkPredictor(ee.emb_size + m.emb_size)
 
+    resume = None
     if restore_state:
-        checkpoint = torch.load("saved_state.pt")
+        checkpoint = load_checkpoint("saved_state.pt")
         m.load_state_dict(checkpoint['m'])
         ee.load_state_dict(checkpoint['ee'])
         lp.load_state_dict(checkpoint['lp'])
         print(f"Restored from epoch {checkpoint['epoch']}")
+        # optimizer is created during training, keep only its state
+        resume = {key: checkpoint[key] for key in ("optimizer", "epoch") if key in checkpoint}
         checkpoint = None
 
     try:
-        train_no_classes(m, ee, lp, dataset.splits, EPOCHS)
+        train_no_classes(m, ee, lp, dataset.splits, EPOCHS, sampler=create_sampler(m, fanout), resume=resume,
+                         early_stopping=early_stopping)
     except KeyboardInterrupt:
         print("Training interrupted")
     finally:
@@ -5,6 +5,10 @@ from dgl.nn.pytorch import edge_softmax, GATConv
 import numpy as np
 import pandas as pd
 
+from models import create_sampler, dense_parameters, add_sparse_optimizer
+from Instrumentation import phase, add_samples, start_epoch, end_epoch
+from Checkpointer import AsyncCheckpointer, load_checkpoint
+
 
 def evaluate_no_classes(logits, labels):
     pred = logits.argmax(1)
@@ -42,7 +46,8 @@ def prepare_batch_no_classes(node_embeddings,
     labels_pos = torch.ones(batch_size, dtype=torch.long)
 
     node_embeddings_neg_batch = node_embeddings_batch.repeat(K, 1)
-    negative_indices = torch.LongTensor(elem_embeder.sample_negative(batch_size * K))
+    with phase("negative_sampling"):
+        negative_indices = torch.LongTensor(elem_embeder.sample_negative(batch_size * K))
     negative_random = elem_embeder(negative_indices)
     negative_batch = torch.cat([node_embeddings_neg_batch, negative_random], 1)
     labels_neg = torch.zeros(batch_size * K, dtype=torch.long)
@@ -111,7 +116,8 @@ def final_evaluation_no_classes(model, elem_embeder, link_predictor, splits):
     return scores
 
 
-def train_no_classes(model, elem_embeder, link_predictor, splits, epochs):
+def train_no_classes(model, elem_embeder, link_predictor, splits, epochs, sampler=None, resume=None,
+                     early_stopping=None):
     train_idx, test_idx, val_idx = splits
 
     pool = set(elem_embeder.elements['id'].to_list())
@@ -129,10 +135,11 @@ def train_no_classes(model, elem_embeder, link_predictor, splits, epochs):
 
     optimizer = torch.optim.Adagrad(
         [
-            {'params': model.parameters(), 'lr': 1e-1},
+            {'params': dense_parameters(model), 'lr': 1e-1},
             {'params': elem_embeder.parameters(), 'lr': 1e-1},
             {'params': link_predictor.parameters(), 'lr': 1e-2}
         ], lr=0.01)
+    optimizer = add_sparse_optimizer(optimizer, model, lr=1e-1)
 
     best_val_acc = torch.tensor(0)
     best_test_acc = torch.tensor(0)
@@ -140,7 +147,20 @@ def train_no_classes(model, elem_embeder, link_predictor, splits, epochs):
     batch_size = 4096
     K = 3  # negative oversampling factor
 
-    for epoch in range(epochs):
+    first_epoch = 0
+    if resume is not None:
+        # checkpoints of older versions do not have optimizer state
+        if 'optimizer' in resume:
+            optimizer.load_state_dict(resume['optimizer'])
+        first_epoch = resume['epoch'] + 1
+
+    checkpointer = AsyncCheckpointer("saved_state.pt")
+
+    if early_stopping is not None:
+        early_stopping.start()
+
+    for epoch in range(first_epoch, epochs):
+        start_epoch(epoch)
 
         # since we train in batches, we need to iterate over the nodes
         # since indexes are sampled randomly, it is a little bit hard to make sure we cover all data
@@ -149,57 +169,86 @@ def train_no_classes(model, elem_embeder, link_predictor, splits, epochs):
         num_batches = len(elem_embeder) // batch_size
 
         for batch_ind in range(num_batches):
-            node_embeddings = model()
-
-            random_batch = np.random.choice(train_idx, size=batch_size)
-
-            train_logits, train_labels = prepare_batch_no_classes(node_embeddings,
-                                                                  elem_embeder,
-                                                                  link_predictor,
-                                                                  random_batch,
-                                                                  batch_size,
-                                                                  K)
+            with phase("batch_sampling"):
+                random_batch = np.random.choice(train_idx, size=batch_size)
+
+            with phase("gnn_forward"):
+                if sampler is None:
+                    node_embeddings = model()
+                else:
+                    node_embeddings = model.sample_embeddings(sampler, random_batch)
+
+            with phase("batch_preparation"):
+                train_logits, train_labels = prepare_batch_no_classes(node_embeddings,
+                                                                      elem_embeder,
+                                                                      link_predictor,
+                                                                      random_batch,
+                                                                      batch_size,
+                                                                      K)
 
             train_acc = evaluate_no_classes(train_logits, train_labels)
 
             logp = nn.functional.log_softmax(train_logits, 1)
             loss = nn.functional.nll_loss(logp, train_labels)
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with phase("backward"):
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+            add_samples(batch_size)
 
             if batch_ind % 1 == 0:
                 print("\r%d/%d batches complete, acc: %.4f" % (batch_ind, num_batches, train_acc.item()), end="\n")
 
+        with phase("evaluation"):
+            if sampler is not None:
+                # evaluation requires embeddings for all test and validation nodes
+                with torch.no_grad():
+                    node_embeddings = model()
+
+            test_logits, test_labels = prepare_batch_no_classes(node_embeddings,
+                                                                elem_embeder,
+                                                                link_predictor,
+                                                                test_idx,
+                                                                test_idx.size,
+                                                                1)
+
+            val_logits, val_labels = prepare_batch_no_classes(node_embeddings,
+                                                              elem_embeder,
+                                                              link_predictor,
+                                                              val_idx,
+                                                              val_idx.size,
+                                                              1)
+
+            test_acc, val_acc = evaluate_no_classes(test_logits, test_labels), \
+                                evaluate_no_classes(val_logits, val_labels)
 
-        test_logits, test_labels = prepare_batch_no_classes(node_embeddings,
-                                                            elem_embeder,
-                                                            link_predictor,
-                                                            test_idx,
-                                                            test_idx.size,
-                                                            1)
+        track_best(epoch, loss, train_acc, val_acc, test_acc, best_val_acc, best_test_acc)
 
-        val_logits, val_labels = prepare_batch_no_classes(node_embeddings,
-                                                          elem_embeder,
-                                                          link_predictor,
-                                                          val_idx,
-                                                          val_idx.size,
-                                                          1)
+        with phase("checkpoint"):
+            checkpointer.save({
+                'm': model.state_dict(),
+                'ee': elem_embeder.state_dict(),
+                "lp": link_predictor.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "epoch": epoch
+            })
 
-        test_acc, val_acc = evaluate_no_classes(test_logits, test_labels), \
-                            evaluate_no_classes(val_logits, val_labels)
+        end_epoch(epoch, loss=loss.item(), val_acc=val_acc.item())
 
-        track_best(epoch, loss, train_acc, val_acc, test_acc, best_val_acc, best_test_acc)
+        if early_stopping is not None and early_stopping.step(epoch, val_acc.item()):
+            print(early_stopping.summary())
+            break
+
+    if early_stopping is not None:
+        early_stopping.finish()
 
-        torch.save({
-            'm': model.state_dict(),
-            'ee': elem_embeder.state_dict(),
-            "lp": link_predictor.state_dict(),
-            "epoch": epoch
-        }, "saved_state.pt")
+    # wait for the last checkpoint
+    checkpointer.close()
 
-def training_procedure(dataset, model, params, EPOCHS, data_file, restore_state):
+def training_procedure(dataset, model, params, EPOCHS, data_file, restore_state, fanout=None,
+                       early_stopping=None):
     NODE_EMB_SIZE = 100
     ELEM_EMB_SIZE = 100
 
@@ -227,18 +276,22 @@ def training_procedure(dataset, model, params, EPOCHS, data_file, restore_state)
     from LinkPredictor import LinkPredictor
     lp = LinkPredictor(ee.emb_size + m.emb_size)
 
+    resume = None
     if restore_state:
-        checkpoint = torch.load("saved_state.pt")
+        checkpoint = load_checkpoint("saved_state.pt")
         m.load_state_dict(checkpoint['m'])
         ee.load_state_dict(checkpoint['ee'])
         lp.load_state_dict(checkpoint['lp'])
         print(f"Restored from epoch {checkpoint['epoch']}")
+        # optimizer is created during training, keep only its state
+        resume = {key: checkpoint[key] for key in ("optimizer", "epoch") if key in checkpoint}
         checkpoint = None
 
     # from train_vector_sim_with_classifier import train_no_classes, final_evaluation_no_classes
 
     try:
-        train_no_classes(m, ee, lp, dataset.splits, EPOCHS)
+        train_no_classes(m, ee, lp, dataset.splits, EPOCHS, sampler=create_sampler(m, fanout), resume=resume,
+                         early_stopping=early_stopping)
     except KeyboardInterrupt:
         print("Training interrupted")
     finally: